@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Benchmark clean_table() throughput across table sizes, retention settings and strategies.
+
+For each table size, the benchmark table is filled with generated records
+(one per minute, going backwards from now), then cleaned with each scenario;
+rows/sec, peak Python memory and query count are collected, and written to a
+JSON file to be compared between releases.
+
+Usage:
+
+    ./benchmark.py [--sizes 10000 100000 ...] [--output benchmark.json]
+
+See benchmarks/settings.py to run the benchmark on PostgreSQL.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import django
+
+
+# (name, model_name, table settings, max table size); retention parameters
+# are computed from the table size (see retention())
+SCENARIOS = [
+    ('keep_records/bulk', 'tests.event', {'delete_strategy': 'bulk'}, None),
+    ('keep_since_hours/bulk', 'tests.event', {'delete_strategy': 'bulk', 'by_time': True}, None),
+    ('keep_records/bulk/batches', 'tests.event', {'delete_strategy': 'bulk', 'batch_size': 10000}, None),
+    ('keep_records/cascade/batches', 'tests.event', {'delete_strategy': 'cascade', 'batch_size': 10000}, None),
+    # tests.sample: no index on get_latest_by, and related models (collected by Django)
+    ('keep_records/bulk/sample', 'tests.sample', {'delete_strategy': 'bulk'}, None),
+    ('keep_records/instance', 'tests.event', {'delete_strategy': 'instance'}, 10 ** 4),
+]
+
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6]
+INSERT_CHUNK_SIZE = 10000
+
+
+def retention(size, by_time=False):
+    """
+    Keep the most recent 10% of the records
+    """
+    if by_time:
+        # one record per minute
+        return {'keep_records': 0, 'keep_since_days': 0, 'keep_since_hours': max(size // 600, 1)}
+    return {'keep_records': max(size // 10, 1), 'keep_since_days': 0, 'keep_since_hours': 0}
+
+
+def populate(model, field, size):
+    model._base_manager.all().delete()
+    now = datetime.datetime.now()
+    for start in range(0, size, INSERT_CHUNK_SIZE):
+        model._base_manager.bulk_create([
+            model(**{field: now - datetime.timedelta(minutes=i)})
+            for i in range(start, min(start + INSERT_CHUNK_SIZE, size))
+        ])
+
+
+def run_scenario(name, model_name, options, size):
+    from django.apps import apps
+    import tables_cleaner
+
+    model = apps.get_model(model_name)
+    field = 'timestamp' if model_name == 'tests.event' else 'created'
+    options = dict(options)
+    by_time = options.pop('by_time', False)
+
+    t0 = time.monotonic()
+    populate(model, field, size)
+    populate_elapsed = time.monotonic() - t0
+
+    tracemalloc.start()
+    t0 = time.monotonic()
+    result = tables_cleaner.clean_table(model_name=model_name, **retention(size, by_time), **options)
+    elapsed = time.monotonic() - t0
+    __, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'size': size,
+        'deleted': result.deleted,
+        'elapsed': elapsed,
+        'rows_per_second': result.deleted / elapsed if elapsed > 0 else 0,
+        'peak_memory': peak_memory,
+        'queries': result.queries,
+        'batches': result.batches,
+        'timings': result.timings,
+        'populate_elapsed': populate_elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark django-tables-cleaner')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Table sizes (default: %(default)s)')
+    parser.add_argument('--scenarios', nargs='+', default=None, help='Run only these scenarios')
+    parser.add_argument('--output', default='benchmark.json', help='Output file (default: %(default)s)')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+    import tables_cleaner
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    results = []
+    for size in args.sizes:
+        for name, model_name, options, max_size in SCENARIOS:
+            if args.scenarios and name not in args.scenarios:
+                continue
+            if max_size is not None and size > max_size:
+                continue
+            result = run_scenario(name, model_name, options, size)
+            results.append(result)
+            print('%-32s %10d rows: %10.0f rows/s, %6.2f s, peak memory %8.1f KB, %6d queries' % (
+                name, size, result['rows_per_second'], result['elapsed'], result['peak_memory'] / 1024, result['queries'],
+            ))
+            sys.stdout.flush()
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'version': tables_cleaner.__version__,
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'date': datetime.datetime.now().isoformat(),
+            'results': results,
+        }, f, indent=2)
+    print('Results written to "%s"' % args.output)
+
+
+if __name__ == "__main__":
+    main()
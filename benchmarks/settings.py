@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+# Settings used by benchmark.py
+#
+# SQLite is used by default; to benchmark PostgreSQL (or any other database),
+# set the BENCHMARK_DB_ENGINE, BENCHMARK_DB_NAME, BENCHMARK_DB_USER, BENCHMARK_DB_PASSWORD,
+# BENCHMARK_DB_HOST and BENCHMARK_DB_PORT environment variables; i.e.:
+#
+#   BENCHMARK_DB_ENGINE=django.db.backends.postgresql BENCHMARK_DB_NAME=benchmark ./benchmark.py
+
+SECRET_KEY = 'fake-key'
+INSTALLED_APPS = [
+    "tables_cleaner",
+    "tests",
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': os.environ.get('BENCHMARK_DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('BENCHMARK_DB_NAME', os.path.join(tempfile.gettempdir(), 'tables_cleaner_benchmark.sqlite3')),
+        'USER': os.environ.get('BENCHMARK_DB_USER', ''),
+        'PASSWORD': os.environ.get('BENCHMARK_DB_PASSWORD', ''),
+        'HOST': os.environ.get('BENCHMARK_DB_HOST', ''),
+        'PORT': os.environ.get('BENCHMARK_DB_PORT', ''),
+    }
+}
+
+TABLES_CLEANER_TABLES = []
@@ -22,7 +22,7 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='django-tables-cleaner',
     version=version,
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     include_package_data=True,
     license='MIT',
     description='A Django app used to remove oldest records from specific db tables.',
@@ -1,3 +1,5 @@
 __version__ = '0.1.4'
 from .clean import clean_tables
 from .clean import clean_table
+from .aio import aclean_tables
+from .aio import aclean_table
@@ -0,0 +1,201 @@
+"""
+Pre-flight checks: verify that the get_latest_by column of each configured
+model is indexed, and that the cleaning queries can actually use the index.
+
+Indexes are inspected with Django's database introspection, queries with EXPLAIN.
+"""
+import json
+import os
+from django.apps import apps
+from django.db import connections
+from django.db import migrations
+from django.db import models
+from django.db import router
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+from django.utils import timezone
+from .planner import estimate_count
+from .planner import plan_cleaning
+from .planner import resolve_get_latest_by
+from .tables import get_table_specs
+
+
+class TableCheck(object):
+
+    def __init__(self, model, column, indexed, filter_uses_index, order_uses_index, rows=None, cost=None, explain=''):
+        self.model = model
+        self.column = column
+        # an index on the get_latest_by column exists
+        self.indexed = indexed
+        # the range predicate and the ordering are resolved using an index
+        self.filter_uses_index = filter_uses_index
+        self.order_uses_index = order_uses_index
+        # estimated n. of records to be removed, and query cost (when available)
+        self.rows = rows
+        self.cost = cost
+        self.explain = explain
+
+    @property
+    def ok(self):
+        return self.indexed and self.filter_uses_index and self.order_uses_index
+
+    def __str__(self):
+        return '"%s" (%s): indexed=%s, filter uses index=%s, order uses index=%s, rows=%s, cost=%s' % (
+            self.model._meta.label_lower, self.column, self.indexed, self.filter_uses_index,
+            self.order_uses_index, self.rows, self.cost,
+        )
+
+
+def is_indexed(connection, model, column):
+    """
+    True when column is the first column of an index (or primary key) of the model's table
+    """
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+    for constraint in constraints.values():
+        if not (constraint.get('index') or constraint.get('unique') or constraint.get('primary_key')):
+            continue
+        columns = constraint.get('columns') or []
+        if columns and columns[0] == column:
+            return True
+    return False
+
+
+def explain(queryset, vendor):
+    if vendor in ('postgresql', 'mysql'):
+        return queryset.explain(format='json')
+    return queryset.explain()
+
+
+def analyze_explain(text, vendor):
+    """
+    Returns (uses_index, sorts, rows, cost) as guessed from EXPLAIN output
+    """
+    rows = cost = None
+    if vendor == 'postgresql':
+        plan = json.loads(text)[0]['Plan']
+        rows = plan.get('Plan Rows')
+        cost = plan.get('Total Cost')
+        uses_index = 'Index Scan' in text or 'Index Only Scan' in text
+        sorts = '"Node Type": "Sort"' in text
+    elif vendor == 'mysql':
+        data = json.loads(text)
+        cost = data.get('query_block', {}).get('cost_info', {}).get('query_cost')
+        rows = data.get('query_block', {}).get('table', {}).get('rows_examined_per_scan')
+        uses_index = '"key":' in text
+        sorts = '"using_filesort": true' in text
+    else:
+        uses_index = 'USING INDEX' in text or 'USING COVERING INDEX' in text or 'USING INTEGER PRIMARY KEY' in text
+        sorts = 'TEMP B-TREE FOR ORDER BY' in text
+    return uses_index, sorts, rows, cost
+
+
+def check_table(model_name, keep_records, keep_since_days, keep_since_hours, get_latest_by=None, **options):
+    """
+    Inspect the queries used to clean a table; returns a TableCheck
+    """
+    model = apps.get_model(model_name)
+    get_latest_by = resolve_get_latest_by(model, get_latest_by)
+    column = model._meta.get_field(get_latest_by).column
+    using = options.get('using') or router.db_for_write(model)
+    connection = connections[using]
+
+    plan = plan_cleaning(model, get_latest_by, keep_records, keep_since_days, keep_since_hours, using=using)
+    queryset = plan.queryset(using)
+    if plan.nothing_to_do or (plan.threshold is None and plan.boundary is None):
+        # No range predicate in the current plan; inspect a sample range query instead
+        queryset = model._default_manager.using(using).filter(**{get_latest_by + '__lt': timezone.now()}).order_by(get_latest_by, 'pk')
+
+    filter_text = explain(queryset.order_by(), connection.vendor)
+    order_text = explain(queryset, connection.vendor)
+    filter_uses_index, __, rows, cost = analyze_explain(filter_text, connection.vendor)
+    order_uses_index, sorts, __, __ = analyze_explain(order_text, connection.vendor)
+    if rows is None:
+        rows = estimate_count(plan.queryset(using))
+
+    return TableCheck(
+        model, column,
+        indexed=is_indexed(connection, model, column),
+        filter_uses_index=filter_uses_index,
+        order_uses_index=order_uses_index and not sorts,
+        rows=rows,
+        cost=cost,
+        explain=order_text,
+    )
+
+
+def index_migration(model, get_latest_by):
+    """
+    Build a migration which adds an index on get_latest_by;
+    returns (path, source), or None if the app doesn't use migrations.
+
+    The index is created with RunSQL, so that the migration state is left untouched;
+    declaring the index in the model (db_index=True or Meta.indexes) is preferable.
+    """
+    app_label = model._meta.app_label
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    if app_label not in loader.migrated_apps:
+        return None
+    leaf_nodes = loader.graph.leaf_nodes(app_label)
+
+    number = 1
+    if leaf_nodes:
+        number = (MigrationAutodetector.parse_number(leaf_nodes[0][1]) or 0) + 1
+
+    index = models.Index(fields=[get_latest_by])
+    index.set_name_with_model(model)
+    schema_editor = connections[router.db_for_write(model)].schema_editor(collect_sql=True)
+
+    name = '%04d_tables_cleaner_%s_%s' % (number, model._meta.model_name, get_latest_by)
+    migration = migrations.Migration(name, app_label)
+    migration.dependencies = leaf_nodes
+    migration.operations = [
+        migrations.RunSQL(
+            sql=str(index.create_sql(model, schema_editor)),
+            reverse_sql=str(index.remove_sql(model, schema_editor)),
+        ),
+    ]
+    writer = MigrationWriter(migration)
+    return writer.path, writer.as_string()
+
+
+def check_tables(logger=None, emit_migrations=False):
+    """
+    Check all tables listed in TABLES_CLEANER_TABLES; returns a list of TableCheck.
+
+    When emit_migrations is set, a migration adding the missing index is written
+    for each table whose get_latest_by column is not indexed.
+    """
+    checks = []
+    for spec in get_table_specs():
+        model_name = spec.model_name
+        try:
+            check = check_table(**spec.kwargs())
+        except Exception as e:
+            if logger:
+                logger.error('"%s": %s' % (model_name, str(e)))
+            continue
+        checks.append(check)
+
+        if logger is not None:
+            if check.ok:
+                logger.info('OK: %s' % check)
+            else:
+                logger.warning('WARNING: %s' % check)
+            logger.debug(check.explain)
+
+        if emit_migrations and not check.indexed:
+            migration = index_migration(check.model, spec.get_latest_by)
+            if migration is None:
+                if logger:
+                    logger.warning('"%s": app doesn\'t use migrations; add db_index=True to "%s"' % (model_name, check.column))
+                continue
+            path, source = migration
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(source)
+            if logger:
+                logger.info('"%s": migration written to %s' % (model_name, path))
+
+    return checks
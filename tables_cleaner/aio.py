@@ -0,0 +1,146 @@
+"""
+Async API, for ASGI applications and asyncio based schedulers.
+
+aclean_table() and aclean_tables() run the cleaning in worker threads (the
+default executor of the event loop), so that the loop is never blocked; each
+worker uses its own db connections, closed when the table is done.
+
+Cancelling them stops the deletion after the current batch (a table deleted in
+a single transaction can't be interrupted), and waits for it to be committed.
+astream_tables() yields the progress events of aclean_tables() as an async iterator.
+"""
+import asyncio
+import threading
+import time
+from django.db import connections
+from django.db import transaction
+from .clean import clean_table
+from .clean import get_tables
+from .clean import is_chunked
+from .clean import run_table
+from .workers import BufferedLogger
+from .workers import max_concurrency as max_database_concurrency
+
+
+def call_soon_threadsafe(loop, callback):
+    """
+    Wrap callback, so that it's executed by loop whatever thread calls it
+    """
+    if callback is None:
+        return None
+    return lambda *args: loop.call_soon_threadsafe(callback, *args)
+
+
+async def run_in_thread(func, stop):
+    """
+    Run func in a worker thread; when cancelled, set stop and wait for func to return
+    """
+
+    def run():
+        try:
+            return func()
+        finally:
+            # Close the connections opened by this thread
+            connections.close_all()
+
+    future = asyncio.get_event_loop().run_in_executor(None, run)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        stop.set()
+        await asyncio.wait([future])
+        raise
+
+
+async def aclean_table(model_name, keep_records, keep_since_days, keep_since_hours, progress=None, **options):
+    """
+    Async version of clean_table(); progress(event) is called from the event loop
+    """
+    stop = threading.Event()
+    progress = call_soon_threadsafe(asyncio.get_event_loop(), progress)
+    return await run_in_thread(
+        lambda: clean_table(model_name, keep_records, keep_since_days, keep_since_hours, stop=stop, progress=progress, **options),
+        stop,
+    )
+
+
+async def aclean_tables(logger=None, dry_run=False, batch_size=0, batch_sleep=0, max_rows_per_second=0, max_duration=0,
+                        max_concurrency=1, callback=None, using=None, progress=None, lock_timeout=0, statement_timeout=0,
+                        plan_using=None):
+    """
+    Async version of clean_tables(): up to max_concurrency tables are cleaned at the
+    same time (SQLite: one per database), each one in its own transaction, unless
+    batches are used; progress(event) is called from the event loop.
+
+    Returns a list of CleanResult, in the same order as TABLES_CLEANER_TABLES.
+    """
+    tables = get_tables({
+        'batch_size': batch_size,
+        'batch_sleep': batch_sleep,
+        'max_rows_per_second': max_rows_per_second,
+        'lock_timeout': lock_timeout,
+        'statement_timeout': statement_timeout,
+        'plan_using': plan_using,
+    }, using=using)
+    deadline = time.monotonic() + max_duration if max_duration > 0 else None
+    stop = threading.Event()
+    progress = call_soon_threadsafe(asyncio.get_event_loop(), progress)
+
+    semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+    database_semaphores = {}
+    for options in tables:
+        alias = options['using']
+        if alias not in database_semaphores:
+            cap = max_database_concurrency(alias, 0)
+            database_semaphores[alias] = asyncio.Semaphore(cap if cap > 0 else max(max_concurrency, 1))
+
+    async def clean(options):
+        buffered = BufferedLogger(logger) if logger is not None else None
+
+        def run():
+            kwargs = dict(logger=buffered, dry_run=dry_run, deadline=deadline, stop=stop, callback=callback, progress=progress)
+            if is_chunked(options):
+                return run_table(options, **kwargs)
+            with transaction.atomic(using=options['using']):
+                return run_table(options, **kwargs)
+
+        async with semaphore:
+            async with database_semaphores[options['using']]:
+                try:
+                    return await run_in_thread(run, stop)
+                finally:
+                    if buffered is not None:
+                        buffered.replay()
+
+    return list(await asyncio.gather(*[clean(options) for options in tables]))
+
+
+async def astream_tables(**kwargs):
+    """
+    Run aclean_tables(**kwargs), yielding its progress events (see tables_cleaner.progress)
+    as they occur; the last event of each table (kind "table") holds its CleanResult.
+    Leaving the iteration early cancels the cleaning.
+    """
+    queue = asyncio.Queue()
+    done = object()
+    callback = kwargs.pop('progress', None)
+
+    def progress(event):
+        if callback is not None:
+            callback(event)
+        queue.put_nowait(event)
+
+    task = asyncio.ensure_future(aclean_tables(progress=progress, **kwargs))
+    task.add_done_callback(lambda task: queue.put_nowait(done))
+    try:
+        while True:
+            event = await queue.get()
+            if event is done:
+                break
+            yield event
+        # Raise the exception of aclean_tables(), if any
+        task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
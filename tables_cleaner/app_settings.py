@@ -1,3 +1,15 @@
 from django.conf import settings
 
-TABLES = getattr(settings, 'TABLES_CLEANER_TABLES', [])
+
+def reload():
+    """
+    Read the settings again (see tables.settings_changed)
+    """
+    global TABLES, METRICS_JSON, METRICS_PROMETHEUS, STATE
+    TABLES = getattr(settings, 'TABLES_CLEANER_TABLES', [])
+    METRICS_JSON = getattr(settings, 'TABLES_CLEANER_METRICS_JSON', None)
+    METRICS_PROMETHEUS = getattr(settings, 'TABLES_CLEANER_METRICS_PROMETHEUS', None)
+    STATE = getattr(settings, 'TABLES_CLEANER_STATE', True)
+
+
+reload()
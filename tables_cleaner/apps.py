@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class TablesCleanerConfig(AppConfig):
     name = 'tables_cleaner'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        # Register the system check and the setting_changed receiver
+        from . import tables
@@ -0,0 +1,95 @@
+"""
+Archive records before deleting them.
+
+Records are streamed (with a server-side cursor, where supported) to a
+compressed JSONL or CSV file, one batch at a time. Each batch is appended
+to the archive as a separate compressed member (gzip) or frame (zstd), so the
+resulting file is a valid stream; the file is fsynced before the batch is
+deleted, so records are never lost: at worst, the records of an interrupted
+batch are archived again by the next run.
+
+zstd compression requires the optional "zstandard" package.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+
+ARCHIVE_FORMATS = ('jsonl', 'csv')
+ARCHIVE_COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    None: '',
+}
+
+# Records fetched for each roundtrip of the server-side cursor
+CURSOR_CHUNK_SIZE = 2000
+
+
+class Archiver(object):
+
+    def __init__(self, model, directory, format='jsonl', compression='gzip', now=None):
+        if format not in ARCHIVE_FORMATS:
+            raise Exception('Unknown archive_format "%s"; choices are: %s' % (format, ', '.join(ARCHIVE_FORMATS)))
+        if compression not in ARCHIVE_COMPRESSIONS:
+            raise Exception('Unknown archive_compression "%s"; choices are: gzip, zstd' % compression)
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('zstd compression requires the "zstandard" package')
+            self.zstandard = zstandard
+
+        self.model = model
+        self.format = format
+        self.compression = compression
+        self.fields = [field.attname for field in model._meta.concrete_fields]
+        if now is None:
+            now = timezone.now()
+        self.path = os.path.join(directory, '%s-%s.%s%s' % (
+            model._meta.label_lower, now.strftime('%Y%m%d-%H%M%S'), format, ARCHIVE_COMPRESSIONS[compression],
+        ))
+
+    def __str__(self):
+        return self.path
+
+    def open_stream(self, f):
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=f, mode='wb')
+        if self.compression == 'zstd':
+            return self.zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+        return f
+
+    def write(self, queryset):
+        """
+        Append the records of queryset to the archive, and flush them to disk;
+        returns the number of records archived
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        n = 0
+        with open(self.path, 'ab') as f:
+            is_new = f.tell() == 0
+            stream = self.open_stream(f)
+            text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+            if self.format == 'csv':
+                writer = csv.writer(text)
+                if is_new:
+                    writer.writerow(self.fields)
+            rows = queryset.order_by().values_list(*self.fields).iterator(chunk_size=CURSOR_CHUNK_SIZE)
+            for row in rows:
+                if self.format == 'csv':
+                    writer.writerow(row)
+                else:
+                    text.write(json.dumps(dict(zip(self.fields, row)), cls=DjangoJSONEncoder) + '\n')
+                n += 1
+            text.flush()
+            text.detach()
+            if stream is not f:
+                stream.close()
+            f.flush()
+            os.fsync(f.fileno())
+        return n
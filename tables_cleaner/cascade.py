@@ -0,0 +1,152 @@
+"""
+Cascade-aware deletion planning.
+
+The relations pointing to a model are walked once, and turned into a tree of
+steps; each step is then applied to a whole batch of parent records with a
+single set-based statement ("DELETE ... WHERE fk IN (SELECT ...)" or
+"UPDATE ... SET fk = NULL WHERE fk IN (SELECT ...)"), children first.
+
+Models which can't be handled this way (signal receivers, generic relations,
+multi-table inheritance, cyclic relations, SET() with a callable) are reported
+with UnsupportedRelation, and left to Django's Collector.
+"""
+from django.db import models
+from django.db.models import signals
+
+
+class UnsupportedRelation(Exception):
+    pass
+
+
+class CascadeStep(object):
+
+    def __init__(self, model, field, action, value=None, children=None):
+        # the related model, and its foreign key to the parent model
+        self.model = model
+        self.field = field
+        # one of: 'delete', 'update', 'protect', 'ignore'
+        self.action = action
+        # the value assigned by 'update'
+        self.value = value
+        self.children = children or []
+
+    def __repr__(self):
+        return '<CascadeStep %s.%s: %s>' % (self.model._meta.label, self.field.name, self.action)
+
+
+def has_delete_listeners(model):
+    return (
+        signals.pre_delete.has_listeners(model) or
+        signals.post_delete.has_listeners(model) or
+        signals.m2m_changed.has_listeners(model)
+    )
+
+
+def candidate_relations(model):
+    """
+    The reverse relations considered by Django's Collector
+    """
+    return [
+        f for f in model._meta.get_fields(include_hidden=True)
+        if f.auto_created and not f.concrete and (f.one_to_one or f.one_to_many)
+    ]
+
+
+def on_delete_action(field):
+    on_delete = field.remote_field.on_delete
+    if on_delete is models.CASCADE:
+        return 'delete', None
+    if on_delete is models.SET_NULL:
+        return 'update', None
+    if on_delete is models.SET_DEFAULT:
+        return 'update', field.get_default()
+    if on_delete in (models.PROTECT, models.RESTRICT):
+        return 'protect', None
+    if on_delete is models.DO_NOTHING:
+        return 'ignore', None
+    deconstruct = getattr(on_delete, 'deconstruct', None)
+    if deconstruct is not None:
+        path, args, kwargs = deconstruct()
+        if path == 'django.db.models.SET' and args and not callable(args[0]):
+            return 'update', args[0]
+    raise UnsupportedRelation('unsupported on_delete for "%s.%s"' % (field.model._meta.label, field.name))
+
+
+def plan_cascade(model, path=()):
+    """
+    Build the list of CascadeStep to be applied before deleting records of model
+    """
+    opts = model._meta
+    if model in path:
+        raise UnsupportedRelation('cyclic relation on "%s"' % opts.label)
+    if opts.parents:
+        raise UnsupportedRelation('"%s" uses multi-table inheritance' % opts.label)
+    if has_delete_listeners(model):
+        raise UnsupportedRelation('"%s" has delete signal receivers' % opts.label)
+    if any(hasattr(f, 'bulk_related_objects') for f in opts.private_fields):
+        raise UnsupportedRelation('"%s" has generic relations' % opts.label)
+
+    steps = []
+    for relation in candidate_relations(model):
+        field = relation.field
+        related_model = relation.related_model
+        action, value = on_delete_action(field)
+        children = []
+        if action == 'delete':
+            children = plan_cascade(related_model, path + (model, ))
+        elif action == 'update' and has_delete_listeners(related_model):
+            raise UnsupportedRelation('"%s" has delete signal receivers' % related_model._meta.label)
+        steps.append(CascadeStep(related_model, field, action, value=value, children=children))
+    return steps
+
+
+def apply_steps(steps, parents, counters, dry_run=False):
+    """
+    Apply steps to the records related to the parents queryset, children first.
+
+    Deleted records are accumulated in counters by model label; updated records
+    under "<label>.<field>". With dry_run, records are only counted.
+    """
+    for step in steps:
+        target = parents.order_by().values(step.field.target_field.attname)
+        related = step.model._base_manager.using(parents.db).filter(**{step.field.name + '__in': target})
+
+        if step.action == 'ignore':
+            continue
+
+        if step.action == 'protect':
+            if related.exists():
+                raise Exception('Cannot delete records referenced by "%s" through protected foreign key "%s"' % (
+                    step.model._meta.label, step.field.name,
+                ))
+            continue
+
+        if step.action == 'update':
+            key = '%s.%s' % (step.model._meta.label, step.field.name)
+            n = related.count() if dry_run else related.update(**{step.field.name: step.value})
+            counters[key] = counters.get(key, 0) + n
+            continue
+
+        apply_steps(step.children, related, counters, dry_run=dry_run)
+        label = step.model._meta.label
+        n = related.count() if dry_run else related._raw_delete(related.db)
+        counters[label] = counters.get(label, 0) + n
+
+
+def delete_cascade(queryset, counters=None, dry_run=False):
+    """
+    Delete queryset and its related records with set-based statements;
+    returns the number of records deleted from the queryset's model.
+    """
+    if counters is None:
+        counters = {}
+    model = queryset.model
+    steps = plan_cascade(model)
+    if queryset.query.is_sliced:
+        queryset = model._base_manager.using(queryset.db).filter(pk__in=list(queryset.values_list('pk', flat=True)))
+    queryset = queryset.order_by()
+
+    apply_steps(steps, queryset, counters, dry_run=dry_run)
+    n = queryset.count() if dry_run else queryset._raw_delete(queryset.db)
+    counters[model._meta.label] = counters.get(model._meta.label, 0) + n
+    return n
@@ -1,104 +1,734 @@
-from datetime import timedelta
+from collections import OrderedDict
+from contextlib import ExitStack
+from itertools import chain
+from itertools import islice
+import logging
+import threading
+import time
 import traceback
 from django.apps import apps
+from django.db import connections
+from django.db import router
+from django.db import transaction
 from django.utils import timezone
-from .app_settings import TABLES
+from .archive import Archiver
+from .cascade import delete_cascade
+from .cascade import UnsupportedRelation
+from .metrics import CleanResult
+from .metrics import QueryCounter
+from .partitions import clean_partitions
+from .planner import estimate_count
+from .profiling import active_profiler
+from .profiling import TableProfiler
+from .progress import ProgressEvent
+from .planner import plan_cleaning
+from .planner import keyset_page
+from .planner import nothing_older
+from .planner import resolve_get_latest_by
+from .planner import split_range
+from .planner import value_range
+from .signals import table_cleaned
+from .sizes import size_limit
+from .state import save_state
+from .strategies import get_delete_strategy
+from .swap import swap_table
+from .swap import SwapRefused
+from .swap import truncate_table
+from .tables import get_table_specs
+from .timeouts import retry_on_timeout
+from .timeouts import TimeoutsExceeded
+from .workers import max_concurrency
+from .workers import run_in_pool
 
 
-def clean_tables(logger=None, dry_run=False):
+# Default batch size when archiving records
+ARCHIVE_BATCH_SIZE = 1000
+# Default batch size for parallel deletion
+PARALLEL_BATCH_SIZE = 1000
 
-    for table in TABLES:
 
-        model_name = table.get('model_name', None)
+def clean_tables(logger=None, dry_run=False, batch_size=0, batch_sleep=0, max_rows_per_second=0, max_duration=0,
+                 max_workers=1, max_workers_per_database=0, callback=None, using=None, atomic=False, stop=None,
+                 progress=None, lock_timeout=0, statement_timeout=0, plan_using=None, profile_dir=None, profile_python=False):
+    """
+    Clean all tables listed in TABLES_CLEANER_TABLES.
 
-        # Support 'model' instead of 'model_name' for backward compatibility;
-        # To be deprecated
-        if model_name is None and 'model' in table:
-            model_name = table.get('model', None)
-            table.pop('model')
-            table['model_name'] = model_name
+    batch_size, batch_sleep, max_rows_per_second, lock_timeout and statement_timeout
+    are used as defaults for tables which do not specify their own values; max_duration (seconds) is a time budget
+    for the whole run: tables are skipped once it has been exhausted.
 
-        try:
-            if logger is not None:
-                logger.info('Cleaning table "%s"' % model_name)
-            n = clean_table(**table, logger=logger, dry_run=dry_run)
-            if logger:
-                if dry_run:
-                    logger.info('DRY-RUN: %d records would be removed from "%s"' % (n, model_name))
-                else:
-                    logger.info('%d records removed from "%s"' % (n, model_name))
-        except Exception as e:
+    With max_workers > 1, tables are cleaned concurrently by a pool of threads,
+    each one with its own db connection and transaction; max_workers_per_database
+    limits the number of concurrent workers on the same database (0=unlimited).
+
+    Each table is cleaned on the database given by its 'using' key, or by the
+    using argument, or as suggested by the database routers (plan_using, i.e. a read
+    replica, is used for planning tables which don't specify their own, see clean_table()); when using is supplied,
+    tables explicitly assigned to other databases are skipped. Different databases
+    are cleaned concurrently. With atomic=True, all tables of a database are cleaned
+    in a single transaction (each table in its own savepoint), unless batches are used;
+    with max_workers > 1, each table is cleaned in its own transaction.
+
+    stop is an optional threading.Event: once set, tables not yet started are skipped,
+    and batched deletions stop after the current batch.
+
+    Returns a list of CleanResult, in the same order as TABLES_CLEANER_TABLES;
+    raises ImproperlyConfigured, before cleaning any table, when the settings are invalid.
+    After each table, callback(result) is called (from the worker thread, when using
+    max_workers > 1) and the table_cleaned signal is sent; progress(event) receives
+    a ProgressEvent after each batch and each table (see tables_cleaner.progress).
+
+    With profile_dir, the queries of each table are recorded, and a report is written
+    into profile_dir (profile_python: profile the Python code too; see tables_cleaner.profiling).
+    """
+
+    defaults = {
+        'batch_size': batch_size,
+        'batch_sleep': batch_sleep,
+        'max_rows_per_second': max_rows_per_second,
+        'lock_timeout': lock_timeout,
+        'statement_timeout': statement_timeout,
+        'plan_using': plan_using,
+    }
+    deadline = time.monotonic() + max_duration if max_duration > 0 else None
+    tables = get_tables(defaults, using=using)
+
+    def clean(options, logger):
+        return run_table(
+            options, logger=logger, dry_run=dry_run, deadline=deadline, stop=stop, callback=callback, progress=progress,
+            save=False, profile_dir=profile_dir, profile_python=profile_python,
+        )
+
+    if max_workers > 1:
+        def clean_in_transaction(options, logger):
+            if is_chunked(options):
+                return clean(options, logger)
+            # Each worker has its own connection, hence its own transaction
+            with transaction.atomic(using=options['using']):
+                return clean(options, logger)
+        results = run_in_pool(tables, clean_in_transaction, logger, max_workers, max_workers_per_database)
+    else:
+        # Group tables by database
+        groups = OrderedDict()
+        for index, options in enumerate(tables):
+            groups.setdefault(options['using'], []).append((index, options))
+
+        def clean_database(group, logger):
+            alias, items = group
+            if not atomic or any(is_chunked(options) for __, options in items):
+                return [(index, clean(options, logger)) for index, options in items]
+            with transaction.atomic(using=alias):
+                return [(index, clean(options, logger)) for index, options in items]
+
+        if len(groups) > 1:
+            # One worker (and transaction) for each database
+            outcomes = run_in_pool(list(groups.items()), clean_database, logger, len(groups), database=lambda group: group[0])
+        else:
+            outcomes = [clean_database(group, logger) for group in groups.items()]
+        results = [result for __, result in sorted(sum(outcomes, []), key=lambda outcome: outcome[0])]
+
+    # Saved once the workers are done (and their transactions committed), so that writing
+    # the states doesn't contend with the transactions of the other databases, or tables
+    for result in results:
+        save_state(result, logger=logger)
+
+    if logger is not None and len(results) > 1:
+        logger.info('Summary:')
+        for result in results:
+            logger.info('    %-40s %s' % (result.model_name, 'FAILED' if result.failed else result.deleted))
+    return results
+
+
+def is_chunked(options):
+    """
+    True when the table is cleaned in batches, each one committed separately
+    (or swapped, in its own transaction)
+    """
+    return (
+        options.get('batch_size', 0) > 0 or bool(options.get('archive_dir')) or
+        options.get('delete_strategy') == 'swap' or options.get('parallelism', 0) > 1
+    )
+
+
+def run_table(options, logger=None, dry_run=False, deadline=None, stop=None, callback=None, progress=None, save=True,
+              profile_dir=None, profile_python=False):
+    """
+    Clean a single table of clean_tables() (options as returned by get_tables());
+    errors are reported in the returned CleanResult, which is saved in the table's
+    TableState (see tables_cleaner.state) unless save=False. Then callback(result)
+    is called, and the table_cleaned signal is sent.
+    """
+    if profile_dir is not None:
+        with TableProfiler(options, python=profile_python) as profiler:
+            result = _run_table(options, logger, dry_run, deadline, stop, progress)
+        profiler.write_report(profile_dir, result, logger=logger)
+    else:
+        result = _run_table(options, logger, dry_run, deadline, stop, progress)
+    if save:
+        save_state(result, logger=logger)
+    if callback is not None:
+        callback(result)
+    table_cleaned.send(sender=None, result=result)
+    if progress is not None:
+        progress(ProgressEvent.from_result(result))
+    return result
+
+
+def _run_table(options, logger, dry_run, deadline, stop, progress):
+    model_name = options['model_name']
+    if stop is not None and stop.is_set():
+        if logger:
+            logger.warning('Interrupted; table "%s" skipped' % model_name)
+        return CleanResult(model_name, dry_run=dry_run).finish(error='skipped: interrupted')
+    if deadline is not None:
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
             if logger:
-                logger.error(str(e))
-                logger.debug(traceback.format_exc())
+                logger.warning('max_duration exceeded; table "%s" skipped' % model_name)
+            return CleanResult(model_name, dry_run=dry_run).finish(error='skipped: max_duration exceeded')
+        table_max_duration = options.get('max_duration', 0)
+        options = dict(options, max_duration=min(table_max_duration, time_left) if table_max_duration > 0 else time_left)
 
+    try:
+        if logger is not None:
+            logger.info('Cleaning table "%s"' % model_name)
+        if transaction.get_connection(options['using']).in_atomic_block:
+            # Use a savepoint, so that a failure doesn't break the whole transaction
+            with transaction.atomic(using=options['using']):
+                result = clean_table(**options, logger=logger, dry_run=dry_run, stop=stop, progress=progress)
+        else:
+            result = clean_table(**options, logger=logger, dry_run=dry_run, stop=stop, progress=progress)
+        if logger:
+            if dry_run:
+                logger.info('DRY-RUN: %d records would be removed from "%s"' % (result.deleted, model_name))
+            else:
+                logger.info('%d records removed from "%s"' % (result.deleted, model_name))
+        return result
+    except Exception as e:
+        if logger:
+            logger.error(str(e))
+            logger.debug(traceback.format_exc())
+        return CleanResult(model_name, dry_run=dry_run).finish(error=e)
 
-def clean_table(model_name, keep_records, keep_since_days, keep_since_hours, get_latest_by=None, logger=None, dry_run=False):
 
-    def dump_queryset(queryset, get_latest_by):
-        first = queryset.first()
-        try:
-            last = queryset.last()
-        except TypeError as e:
-            if logger is not None:
-                logger.info(str(e))
-                logger.debug(traceback.format_exc())
-            # TypeError('Cannot reverse a query once a slice has been taken.')
-            n = len(queryset)
-            last = queryset[n - 1] if n > 0 else None
+def get_tables(defaults, using=None):
+    """
+    The clean_table() arguments for the tables listed in TABLES_CLEANER_TABLES,
+    merged with defaults (see clean_tables()); raises ImproperlyConfigured
+    when the settings are invalid
+    """
+    return [spec.kwargs(defaults) for spec in get_table_specs(using)]
+
+
+def clean_table(model_name, keep_records, keep_since_days, keep_since_hours, get_latest_by=None, logger=None, dry_run=False,
+                delete_strategy='bulk', batch_size=0, batch_sleep=0, max_rows_per_second=0, max_duration=0,
+                count_mode='exact', partitioned=False, partition_action='drop',
+                archive_dir=None, archive_format='jsonl', archive_compression='gzip', using=None,
+                max_batches=0, stop=None, max_records=0, max_table_bytes=0, max_table_percent=0, partition_by=None,
+                progress=None, lock_timeout=0, statement_timeout=0, max_retries=3, retry_backoff=1.0, plan_using=None,
+                swap_threshold=0.9, parallelism=1, plan=None, spec=None, keys=None):
+    """
+    Remove the oldest records from a single table; returns a CleanResult, which
+    also behaves as the number of records removed.
+
+    When batch_size > 0, records are deleted in chunks of batch_size primary keys,
+    each one committed in its own transaction; an interrupted run loses at most
+    the current batch, and the next run simply resumes from the oldest records left.
+    Batches can be paced with batch_sleep (seconds) and max_rows_per_second,
+    while max_duration (seconds), max_batches, or setting the stop event (a threading.Event)
+    stop the deletion after the current batch; progress(event) is called after each batch.
+
+    Records are counted only when required (dry run, or debug logging);
+    with count_mode='estimate' the database statistics are used instead of count().
+    Before counting, or deleting in any way more expensive than a single DELETE statement,
+    tables without records older than the cutoff are skipped (result.skipped), after a
+    single MIN(get_latest_by) query; a single DELETE removing nothing sets result.skipped too.
+
+    For range-partitioned tables (partitioned=True), partitions containing obsolete
+    records only are dropped (or truncated, with partition_action='truncate') before
+    deleting the remaining obsolete records from the boundary partition.
+
+    When archive_dir is set, records are appended to a compressed archive file
+    (see tables_cleaner.archive) before being deleted; archiving always proceeds
+    in batches (of ARCHIVE_BATCH_SIZE records, unless batch_size is specified),
+    and each batch is deleted only after it has been safely written to disk.
+
+    max_records, max_table_bytes and max_table_percent (of the tablespace) limit the
+    size of the table: the oldest records beyond the limits are removed, even if
+    preserved by keep_records or keep_since_*; sizes are estimated from the database
+    catalog (see tables_cleaner.sizes).
+
+    With partition_by (a field name, or a list of them), keep_records applies to each
+    group of records sharing the same values (see tables_cleaner.planner); when deleting
+    in batches, the records to be removed are ranked once (PostgreSQL), then deleted batch by batch.
 
+    lock_timeout and statement_timeout (seconds) bound each deletion, which then runs in its own
+    transaction or savepoint (see tables_cleaner.timeouts); on timeout, the deletion is retried up to max_retries times, after retry_backoff seconds
+    (doubled after each failure) and with batches of half the size; then the table is given up,
+    and result.error set, while the batches already committed are kept.
+
+    With delete_strategy='swap', when at least swap_threshold (a ratio) of the records
+    have to be removed, the records to be preserved are copied aside, and the table
+    swapped or truncated instead (see tables_cleaner.swap).
+
+    With parallelism > 1, the records to be removed are split into disjoint ranges of
+    get_latest_by (or of the primary key), deleted in batches (of PARALLEL_BATCH_SIZE records,
+    unless batch_size is specified) by a pool of parallelism threads, each one with its own
+    connection (see delete_in_parallel()).
+
+    All queries are executed on the database "using"; when not supplied, the
+    database suggested by the routers for writing model is used.
+    With plan_using (i.e. a read replica), the retention constraints are resolved, and
+    records counted (dry runs included) on that database instead; before deleting,
+    the boundaries are computed again on "using", and only the records selected by both
+    plans are removed, so that replication lag never widens the deletion.
+
+    The plan used is saved in result.plan; it can be supplied again with plan (a CleaningPlan),
+    to be reused without planning again (i.e. between the batches of the daemon).
+    With keys (an iterator over the primary keys of the records to be removed, oldest first,
+    i.e. cached by the daemon), batches are taken from it instead of querying the records again.
+    With spec (the TableSpec of the table, see tables.get_table_specs()), the model,
+    get_latest_by and the delete strategy it has resolved are used as they are.
+    """
+
+    def dump_queryset(queryset, get_latest_by, count):
+        # A single MIN/MAX aggregate, without reading the records
+        first, last = value_range(queryset, get_latest_by)
         return 'records: %d [%s ... %s]' % (
-            queryset.count(),
-            getattr(first, get_latest_by).isoformat() if first is not None else '',
-            getattr(last, get_latest_by).isoformat() if last is not None else '',
+            count,
+            first.isoformat() if hasattr(first, 'isoformat') else (first if first is not None else ''),
+            last.isoformat() if hasattr(last, 'isoformat') else (last if last is not None else ''),
         )
 
-    # Retrieve model
-    model = apps.get_model(model_name)
-
-    # Retrieve get_latest_by for model
-    if get_latest_by is None:
-        get_latest_by = getattr(model._meta, 'get_latest_by', None)
-    #get_latest_by = getattr(model._meta, 'get_latest_by', None)
-    if get_latest_by is None:
-        raise Exception('"%s": missing required attribute "get_latest_by"' % model_name)
-    if get_latest_by.startswith('-'):
-        get_latest_by = get_latest_by[1:]
-
-    # Prepare a queryset of all records to be deleted
-    queryset = model.objects.order_by(get_latest_by)
-    table_size = queryset.count()
-    if logger is not None:
-        logger.debug('"%s": records count before cleaning: %d' % (model_name, table_size))
-
-    # Filter queryset to preserve most recent records
-    if keep_since_hours > 0:
-        time_threshold = timezone.now() - timedelta(hours=keep_since_hours)
-        queryset = queryset.filter(**{get_latest_by + '__lt': time_threshold})
-    if keep_since_days > 0:
-        time_threshold = timezone.now() - timedelta(days=keep_since_days)
-        queryset = queryset.filter(**{get_latest_by + '__lt': time_threshold})
-
-    # Reduce the queryset to preserve at least 'keep_records' records
-    records_left = table_size - queryset.count()
-    if keep_records > 0 and records_left < keep_records:
-        records_to_remove = max(queryset.count() - (keep_records - records_left), 0)
-        queryset = queryset[0:records_to_remove]
+    result = CleanResult(model_name, dry_run=dry_run)
+
+    # Retrieve model and delete strategy
+    if spec is not None:
+        model = spec.model
+        get_latest_by = get_latest_by or spec.get_latest_by
+    else:
+        model = apps.get_model(model_name)
+    if spec is not None and delete_strategy == spec.options.get('delete_strategy', 'bulk'):
+        delete_records = spec.delete_records
+    else:
+        delete_records = get_delete_strategy(delete_strategy)
+    count_records = get_count_function(count_mode)
+    result.using = using or router.db_for_write(model)
+    plan_using = plan_using or result.using
+
+    reused = plan is not None
+    with ExitStack() as stack:
+        for alias in {result.using, plan_using}:
+            stack.enter_context(connections[alias].execute_wrapper(QueryCounter(result)))
+
+        # Retrieve get_latest_by for model
+        if spec is None:
+            get_latest_by = resolve_get_latest_by(model, get_latest_by)
+
+        # Compute the boundary of the records to be preserved,
+        # and prepare a queryset of all records to be deleted
+        with result.phase('plan'):
+            if plan is not None:
+                # Reused (i.e. by the daemon), without querying the database again
+                planned = plan.queryset(plan_using)
+            else:
+                if max_table_bytes > 0 or max_table_percent > 0:
+                    limit = size_limit(model, plan_using, max_table_bytes=max_table_bytes, max_table_percent=max_table_percent)
+                    if logger is not None:
+                        logger.debug('"%s": size limit: %s records' % (model_name, limit))
+                    if limit is not None:
+                        max_records = min(max_records, limit) if max_records > 0 else limit
+                now = timezone.now()
+                plan = plan_cleaning(
+                    model, get_latest_by, keep_records, keep_since_days, keep_since_hours, using=plan_using, now=now,
+                    max_records=max_records, partition_by=partition_by or (),
+                )
+                # The records to be removed, as seen by plan_using: for counts and reports
+                planned = plan.queryset(plan_using)
+                if plan_using != result.using and not dry_run:
+                    # Check the boundaries on the database we delete from
+                    plan = plan_cleaning(
+                        model, get_latest_by, keep_records, keep_since_days, keep_since_hours, using=result.using, now=now,
+                        max_records=max_records, partition_by=partition_by or (),
+                    ).restrict(plan)
+            queryset = plan.queryset(result.using)
+            result.plan = plan
+            result.cutoff = plan.cutoff
 
+        # Before counting, or anything more expensive than a single DELETE statement, look
+        # for records older than the cutoff with an index probe, and skip the table when
+        # there aren't any (a single DELETE tells by itself, see below)
+        debug = logger is not None and logger.isEnabledFor(logging.DEBUG)
+        if result.cutoff is not None and not reused and (
+            dry_run or debug or batch_size > 0 or archive_dir or parallelism > 1 or delete_strategy != 'bulk'
+        ):
+            with result.phase('plan'):
+                result.skipped = nothing_older(model, get_latest_by, result.cutoff, using=plan_using)
+            if result.skipped:
+                if logger is not None:
+                    logger.info('"%s": nothing to do; no records older than %s' % (model_name, result.cutoff))
+                return result.finish()
+
+        # Drop whole partitions first; the records they contain are estimated from the db statistics
+        dropped = 0
+        if partitioned:
+            with result.phase('partitions'):
+                partitions = clean_partitions(
+                    model_name, plan, result.using, action=partition_action, dry_run=dry_run, logger=logger,
+                )
+            if not dry_run:
+                dropped = sum(partition.rows or 0 for partition in partitions)
+
+        archiver = None
+        if archive_dir:
+            archiver = Archiver(model, archive_dir, format=archive_format, compression=archive_compression)
+            if batch_size <= 0:
+                batch_size = ARCHIVE_BATCH_SIZE
+        if parallelism > 1 and batch_size <= 0:
+            batch_size = PARALLEL_BATCH_SIZE
+
+        # Counting is expensive on large tables: do it only when explicitly requested
+        records_to_remove = table_size = None
+        if debug:
+            logger.debug('"%s": %r' % (model_name, plan))
+            try:
+                logger.debug('sql: ' + str(queryset.query))
+            #except EmptyResultSet:
+            except Exception as e:
+                logger.debug("sql: %s" % str(e))
+
+            with result.phase('count'):
+                table_size = count_records(model._default_manager.using(plan_using).all())
+                records_to_remove = count_records(planned)
+                logger.debug('"%s": records count before cleaning: %d' % (model_name, table_size))
+                logger.debug('"%s": records to keep: %d' % (model_name, table_size - records_to_remove))
+                logger.debug('"%s": records to be removed: %d' % (model_name, records_to_remove))
+                logger.debug(dump_queryset(planned, get_latest_by, records_to_remove))
+
+        # Swap the table, rather than deleting most of its records
+        swap = False
+        if delete_strategy == 'swap' and archiver is None and not plan.nothing_to_do:
+            with result.phase('count'):
+                if records_to_remove is None:
+                    table_size = count_records(model._default_manager.using(plan_using).all())
+                    records_to_remove = count_records(planned)
+            swap = table_size > 0 and records_to_remove >= swap_threshold * table_size
+            if logger is not None:
+                logger.debug('"%s": %d of %d records to be removed; swap: %s' % (model_name, records_to_remove, table_size, swap))
+
+        result.table_size = table_size
+
+        if dry_run:
+            if logger is not None and archiver is not None:
+                logger.info('DRY-RUN: records would be archived to "%s"' % archiver)
+            if logger is not None and swap:
+                logger.info('DRY-RUN: table "%s" would be %s' % (model_name, 'truncated' if plan.keeps_nothing else 'swapped'))
+            with result.phase('count'):
+                if delete_strategy == 'cascade':
+                    try:
+                        delete_cascade(planned, result.related, dry_run=True)
+                        result.related.pop(model._meta.label, None)
+                        if logger is not None:
+                            log_related_counters(logger, model, result.related, dry_run=True)
+                    except UnsupportedRelation as e:
+                        if logger is not None:
+                            logger.info('"%s": related records not counted (%s)' % (model_name, str(e)))
+                if records_to_remove is None:
+                    records_to_remove = count_records(planned)
+                result.deleted = result.scanned = records_to_remove
+            return result.finish()
+
+        total = records_to_remove
+        if progress is not None and batch_size > 0 and total is None:
+            # The records to be removed, for the ETA of the progress events
+            with result.phase('count'):
+                total = estimate_count(planned)
+
+        with result.phase('delete'):
+            n = None
+            if swap:
+                try:
+                    if plan.keeps_nothing:
+                        n = truncate_table(model, result.using, logger=logger)
+                    else:
+                        n = swap_table(plan.survivors(result.using), logger=logger)
+                except SwapRefused as e:
+                    if logger is not None:
+                        logger.warning('"%s": swap refused (%s); deleting records instead' % (model_name, str(e)))
+            if n is not None:
+                result.scanned = n
+                result.batches = 1 if n else 0
+            elif parallelism > 1 and archiver is None and max_batches <= 0 and not connections[result.using].in_atomic_block:
+                n = delete_in_parallel(
+                    model_name, queryset, delete_records, batch_size, parallelism,
+                    batch_sleep=batch_sleep, max_rows_per_second=max_rows_per_second,
+                    max_duration=max_duration, logger=logger, result=result,
+                    stop=stop, progress=progress, total=total,
+                    get_latest_by=get_latest_by, lock_timeout=lock_timeout, statement_timeout=statement_timeout,
+                    max_retries=max_retries, retry_backoff=retry_backoff,
+                )
+            elif batch_size > 0:
+                if keys is None and plan.partition_by and connections[result.using].vendor == 'postgresql':
+                    # Rank records once, rather than for every batch, reading them
+                    # from a server-side cursor
+                    keys = queryset.values_list('pk', flat=True).iterator(chunk_size=batch_size)
+                n = delete_in_batches(
+                    model_name, queryset, delete_records, batch_size,
+                    batch_sleep=batch_sleep, max_rows_per_second=max_rows_per_second,
+                    max_duration=max_duration, logger=logger, result=result, archiver=archiver,
+                    max_batches=max_batches, stop=stop, keys=keys, progress=progress, total=total,
+                    get_latest_by=get_latest_by, lock_timeout=lock_timeout, statement_timeout=statement_timeout,
+                    max_retries=max_retries, retry_backoff=retry_backoff,
+                )
+            elif lock_timeout > 0 or statement_timeout > 0:
+
+                def delete_all():
+                    related = dict(result.related)
+                    return delete_records(queryset, related), related
+
+                try:
+                    n, result.related = retry_on_timeout(
+                        delete_all, result.using, lock_timeout=lock_timeout, statement_timeout=statement_timeout,
+                        max_retries=max_retries, retry_backoff=retry_backoff, logger=logger,
+                        label='"%s": ' % model_name,
+                    )
+                except TimeoutsExceeded as e:
+                    n = 0
+                    result.error = 'skipped after %s' % str(e)
+                    if logger is not None:
+                        logger.error('"%s": %s' % (model_name, result.error))
+                result.scanned = n
+                result.batches = 1 if n else 0
+            else:
+                n = delete_records(queryset, result.related)
+                result.scanned = n
+                result.batches = 1 if n else 0
+                # A single statement, as cheap as the probe: nothing to do when nothing was removed
+                result.skipped = n == 0 and not dropped
+        result.related.pop(model._meta.label, None)
+        result.deleted = n + dropped
+
+    result.finish()
     if logger is not None:
+        logger.info('"%s": %d records deleted in %.3f s (%.1f records/s) [delete_strategy: %s]' % (
+            model_name, n, result.timings['delete'], result.rate, delete_strategy
+        ))
+        log_related_counters(logger, model, result.related)
+
+    return result
+
+
+def log_related_counters(logger, model, counters, dry_run=False):
+    prefix = 'DRY-RUN: ' if dry_run else ''
+    for label in sorted(counters.keys()):
+        if label == model._meta.label or counters[label] <= 0:
+            continue
+        if label.count('.') > 1:
+            # Records updated by SET_NULL, SET_DEFAULT or SET(): "<app_label>.<model>.<field>"
+            logger.info('%s%d related records %s in "%s"' % (prefix, counters[label], 'would be updated' if dry_run else 'updated', label))
+        else:
+            logger.info('%s%d related records %s from "%s"' % (prefix, counters[label], 'would be removed' if dry_run else 'removed', label))
+
+
+def get_count_function(count_mode):
+    if count_mode == 'exact':
+        return lambda queryset: queryset.count()
+    if count_mode == 'estimate':
+        return estimate_count
+    raise Exception('Unknown count_mode "%s"; choices are: estimate, exact' % count_mode)
+
+
+def delete_in_batches(model_name, candidates, delete_records, batch_size,
+                      batch_sleep=0, max_rows_per_second=0, max_duration=0, logger=None, result=None,
+                      archiver=None, max_batches=0, stop=None, keys=None, progress=None, total=None,
+                      lock_timeout=0, statement_timeout=0, max_retries=3, retry_backoff=1.0, get_latest_by=None):
+    """
+    Delete all records of the (ordered) candidates queryset, batch_size records
+    at a time, with a separate transaction for each batch; stops after max_batches
+    batches (0=unlimited), or when the stop event is set.
+
+    When keys (an iterator over the primary keys of candidates) is supplied, batches
+    are taken from it, instead of querying candidates again for each batch.
+    Otherwise, with get_latest_by (the first ordering field of candidates), each batch
+    is read by keyset pagination on (get_latest_by, pk), starting after the previous one,
+    so that neither the records left (i.e. not removed by the delete strategy) nor the
+    dead rows of the previous batches are scanned again; memory is bounded by batch_size.
+    Records with a NULL get_latest_by, if any, come first, by pk (see keyset_page()).
+
+    After each batch, progress(event) receives a ProgressEvent; total is the
+    (estimated) n. of records to be removed, used for the ETA.
+
+    Each batch runs with lock_timeout and statement_timeout (seconds, 0=unused);
+    on timeout, it's retried with half the records, after an exponential backoff;
+    after max_retries consecutive timeouts the table is skipped, and result.error set.
+
+    When an archiver is supplied, each batch is archived before being deleted.
+    Batches, records scanned and related records are accumulated in result.
+    """
+    if result is None:
+        result = CleanResult(model_name)
+    model = candidates.model
+    using = candidates.db
+    t0 = time.monotonic()
+    deleted = 0
+    # (get_latest_by, pk) of the last record of the previous batch
+    last = None
+    while True:
+
+        if max_duration > 0 and time.monotonic() - t0 >= max_duration:
+            if logger is not None:
+                logger.warning('"%s": max_duration exceeded; remaining records left for next run' % model_name)
+            break
+        if stop is not None and stop.is_set():
+            if logger is not None:
+                logger.warning('"%s": interrupted; remaining records left for next run' % model_name)
+            break
+
+        rows = None
+        if keys is not None:
+            pks = list(islice(keys, batch_size))
+        elif get_latest_by is not None:
+            rows = keyset_page(candidates, get_latest_by, last, batch_size)
+            pks = [pk for __, pk in rows]
+        else:
+            pks = list(candidates.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        if archiver is not None:
+            with result.phase('archive'):
+                archived = archiver.write(model._base_manager.using(using).filter(pk__in=pks))
+            if logger is not None:
+                logger.debug('"%s": %d records archived to "%s"' % (model_name, archived, archiver))
+
+        def delete_batch():
+            related = dict(result.related)
+            n = delete_records(model._base_manager.using(using).filter(pk__in=pks), related)
+            return n, related
+
+        def reduce_batch():
+            nonlocal pks, rows, keys, batch_size
+            batch_size = max(batch_size // 2, 1)
+            if keys is not None:
+                # Give the records left out back to the next batches
+                keys = chain(pks[batch_size:], keys)
+            pks = pks[:batch_size]
+            if rows is not None:
+                rows = rows[:batch_size]
+
         try:
-            logger.debug('sql: ' + str(queryset.query))
-        #except EmptyResultSet:
-        except Exception as e:
-            logger.debug("sql: %s" % str(e))
+            n, result.related = retry_on_timeout(
+                delete_batch, using, lock_timeout=lock_timeout, statement_timeout=statement_timeout,
+                max_retries=max_retries, retry_backoff=retry_backoff, on_retry=reduce_batch, logger=logger,
+                label='"%s": ' % model_name,
+            )
+        except TimeoutsExceeded as e:
+            result.error = 'skipped after %s' % str(e)
+            if logger is not None:
+                logger.error('"%s": %s; remaining records left for next run' % (model_name, result.error))
+            break
+        result.scanned += len(pks)
+        if rows is not None:
+            last = rows[-1]
+        deleted += n
+        result.batches += 1
+        if logger is not None:
+            logger.debug('"%s": batch committed; %d records deleted so far' % (model_name, deleted))
+        if progress is not None:
+            progress(ProgressEvent(
+                ProgressEvent.BATCH, model_name, deleted=deleted, batches=result.batches,
+                elapsed=time.monotonic() - t0, total=total,
+            ))
+
+        if len(pks) < batch_size or (n <= 0 and keys is None and rows is None):
+            # Either we're done, or records can't be removed (avoid looping forever)
+            break
+        if max_batches > 0 and result.batches >= max_batches:
+            break
+
+        # Pacing
+        pause = batch_sleep
+        if max_rows_per_second > 0:
+            pause = max(pause, deleted / max_rows_per_second - (time.monotonic() - t0))
+        if pause > 0:
+            if stop is not None:
+                stop.wait(pause)
+            else:
+                time.sleep(pause)
+
+    return deleted
+
+
+def delete_in_parallel(model_name, candidates, delete_records, batch_size, parallelism,
+                       max_rows_per_second=0, max_duration=0, logger=None, result=None,
+                       progress=None, total=None, get_latest_by=None, **options):
+    """
+    Split the (ordered) candidates queryset into up to parallelism disjoint ranges of
+    get_latest_by (see split_range()), and delete each one with delete_in_batches()
+    in a pool of threads; every thread uses its own connection, and commits each batch
+    separately. Returns the number of records deleted, exactly as delete_in_batches()
+    would on the whole queryset.
+
+    max_rows_per_second and max_duration apply to the whole table; progress(event)
+    receives the batches of all ranges. Other options are passed to delete_in_batches().
+    Not to be used inside a transaction: the threads wouldn't see its changes.
+    The queries of the threads are recorded by the active TableProfiler, if any.
+    """
+    if result is None:
+        result = CleanResult(model_name)
+    using = candidates.db
+    ranges = split_range(candidates, get_latest_by, parallelism)
+    # On SQLite (a single writer at a time), ranges are deleted one after the other
+    concurrency = max(1, min(max_concurrency(using, parallelism), len(ranges)))
+    if logger is not None:
+        logger.debug('"%s": %d ranges deleted by %d workers' % (model_name, len(ranges), concurrency))
+    profiler = active_profiler()
+    t0 = time.monotonic()
+    deadline = t0 + max_duration if max_duration > 0 else None
+    lock = threading.Lock()
+    # Records deleted so far, by range
+    deleted = [0] * len(ranges)
+    batches = [0] * len(ranges)
+
+    def clean_range(task, logger):
+        index, queryset = task
+        part = CleanResult(model_name)
+        time_left = 0
+        if deadline is not None:
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                return part.finish()
 
-        logger.debug('"%s": records to keep: %d' % (model_name, table_size - queryset.count()))
-        logger.debug('"%s": records to be removed: %d' % (model_name, queryset.count()))
-        logger.debug(dump_queryset(queryset, get_latest_by))
-    n = queryset.count()
+        def range_progress(event):
+            with lock:
+                deleted[index] = event.deleted
+                batches[index] = event.batches
+                if progress is not None:
+                    progress(ProgressEvent(
+                        ProgressEvent.BATCH, model_name, deleted=sum(deleted), batches=sum(batches),
+                        elapsed=time.monotonic() - t0, total=total,
+                    ))
 
-    if not dry_run:
-        for row in queryset.iterator():
-            row.delete()
+        with ExitStack() as stack:
+            stack.enter_context(connections[using].execute_wrapper(QueryCounter(part)))
+            if profiler is not None:
+                stack.enter_context(profiler.recording(connections[using]))
+            # The ranges deleted at the same time share the rate
+            part.deleted = delete_in_batches(
+                model_name, queryset, delete_records, batch_size,
+                max_rows_per_second=max_rows_per_second / concurrency, max_duration=time_left,
+                logger=logger, result=part, progress=range_progress, get_latest_by=get_latest_by, **options
+            )
+        return part.finish()
 
+    parts = run_in_pool(list(enumerate(ranges)), clean_range, logger, parallelism, database=lambda task: using)
+    n = 0
+    for part in parts:
+        n += part.deleted
+        result.scanned += part.scanned
+        result.batches += part.batches
+        result.queries += part.queries
+        for label, count in part.related.items():
+            result.related[label] = result.related.get(label, 0) + count
+        if part.error is not None and result.error is None:
+            result.error = part.error
     return n
@@ -0,0 +1,206 @@
+"""
+Continuous cleaning (clean_tables --daemon).
+
+Instead of removing all obsolete records at once, the daemon keeps every table
+near its retention target by deleting one small batch at a time from each table,
+in turn; the pause between batches adapts to the load of the database:
+
+- the time taken by the last batch, compared to target_latency
+- the replication lag, where available (PostgreSQL: pg_stat_replication on the primary)
+
+but it's never shorter than the batch_sleep of the table, nor than required to keep
+its max_rows_per_second (see Pacer.throttle()).
+
+The plan of each table (its boundary) is computed once, and reused by the following
+batches until they remove nothing more; then the table is planned again. Since records
+are only appended, a reused plan never removes more than a new one would.
+
+With partition_by, finding the records of a batch means ranking the whole table:
+the keys of the records to be removed are read at once for the next DAEMON_KEYS_TURNS
+turns, and consumed one batch per turn, so that the ranking isn't repeated at every turn.
+
+Only batches are used: the "swap" delete_strategy is replaced by "bulk", and partitions
+are not dropped (partitioned=False), since both would clean a whole table at once.
+
+When there is nothing left to delete, the daemon sleeps for idle_sleep seconds.
+It stops, after the current batch, when the stop event is set.
+"""
+import logging
+import time
+from django.db import connections
+from .clean import clean_table
+from .metrics import CleanResult
+
+
+# Default batch size in daemon mode
+DAEMON_BATCH_SIZE = 1000
+# Turns served by a single ranking of the records, for tables with partition_by
+DAEMON_KEYS_TURNS = 100
+
+
+def replication_lag(connection):
+    """
+    The replication lag (seconds) of the slowest replica, or None when not available
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT EXTRACT(EPOCH FROM MAX(replay_lag)) FROM pg_stat_replication')
+            row = cursor.fetchone()
+    except Exception:
+        # Not enough privileges, or PostgreSQL < 10
+        return None
+    return float(row[0]) if row and row[0] is not None else None
+
+
+class Pacer(object):
+    """
+    Adaptive pause between batches: doubled (and at least as long as the last batch)
+    when the database looks overloaded, halved otherwise
+    """
+
+    def __init__(self, target_latency=1.0, max_lag=10.0, min_sleep=0, max_sleep=60.0):
+        self.target_latency = target_latency
+        self.max_lag = max_lag
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.pause = min_sleep
+
+    def overloaded(self, latency, lag=None):
+        if self.target_latency > 0 and latency > self.target_latency:
+            return True
+        return lag is not None and self.max_lag > 0 and lag > self.max_lag
+
+    def update(self, latency, lag=None):
+        """
+        Adjust the pause after a batch which took latency seconds; returns the new pause
+        """
+        if self.overloaded(latency, lag):
+            self.pause = min(max(self.pause * 2, latency), self.max_sleep)
+        else:
+            self.pause = max(self.pause / 2, self.min_sleep)
+        return self.pause
+
+    @staticmethod
+    def throttle(pause, deleted, elapsed, batch_sleep=0, max_rows_per_second=0):
+        """
+        pause, made long enough to sleep at least batch_sleep seconds, and to remove
+        no more than max_rows_per_second, after a batch which deleted records in elapsed seconds
+        """
+        pause = max(pause, batch_sleep)
+        if max_rows_per_second > 0:
+            pause = max(pause, deleted / max_rows_per_second - elapsed)
+        return pause
+
+
+def daemon_options(options, logger=None):
+    """
+    options (see clean.get_tables()) restricted to small batches
+    """
+    options = dict(options)
+    if options.get('delete_strategy') == 'swap':
+        if logger is not None:
+            logger.warning('"%s": delete_strategy "swap" replaced by "bulk" in daemon mode' % options['model_name'])
+        options['delete_strategy'] = 'bulk'
+    if options.get('partitioned'):
+        if logger is not None:
+            logger.warning('"%s": partitions are not dropped in daemon mode' % options['model_name'])
+        options['partitioned'] = False
+    return options
+
+
+def run_daemon(tables, stop, batch_size=DAEMON_BATCH_SIZE, idle_sleep=60.0, target_latency=1.0, max_lag=10.0,
+               max_sleep=60.0, max_duration=0, logger=None):
+    """
+    Clean tables (a list of table options, see clean.get_tables()) continuously,
+    until stop (a threading.Event) is set, or max_duration seconds have elapsed;
+    returns a CleanResult for each table, with the totals of the run.
+    """
+    t0 = time.monotonic()
+    tables = [daemon_options(options, logger=logger) for options in tables]
+    totals = [CleanResult(options['model_name']) for options in tables]
+    # The plan of each table, reused until it's exhausted
+    plans = [None] * len(tables)
+    # The keys of the records to be removed by the next turns (partition_by only),
+    # and whether they are all the records of the plan
+    keys = [[] for options in tables]
+    complete = [False] * len(tables)
+    pacers = {}
+    # Per-batch messages are emitted in debug mode only
+    table_logger = logger if logger is not None and logger.isEnabledFor(logging.DEBUG) else None
+
+    def time_left():
+        if max_duration <= 0:
+            return None
+        return max(max_duration - (time.monotonic() - t0), 0)
+
+    def sleep(seconds):
+        left = time_left()
+        if left is not None:
+            seconds = min(seconds, left)
+        if seconds > 0:
+            stop.wait(seconds)
+
+    while not stop.is_set() and time_left() != 0:
+        deleted = 0
+        for index, (options, total) in enumerate(zip(tables, totals)):
+            if stop.is_set() or time_left() == 0:
+                break
+            options = dict(options, batch_size=options.get('batch_size') or batch_size, max_batches=1)
+            plan = plans[index]
+            try:
+                if plan is not None and plan.partition_by and not keys[index]:
+                    # Rank the records once for the next turns
+                    limit = options['batch_size'] * DAEMON_KEYS_TURNS
+                    keys[index] = list(plan.queryset(total.using).values_list('pk', flat=True)[:limit])
+                    complete[index] = len(keys[index]) < limit
+                result = clean_table(
+                    **options, logger=table_logger, stop=stop, plan=plan, keys=iter(keys[index]) if keys[index] else None,
+                )
+            except Exception as e:
+                if logger is not None:
+                    logger.error('"%s": %s' % (options['model_name'], str(e)))
+                total.finish(error=e)
+                plans[index] = None
+                keys[index] = []
+                continue
+            total.add(result)
+            if result.deleted <= 0:
+                # Plan again at the next turn
+                plans[index] = None
+                keys[index] = []
+                continue
+            plans[index] = result.plan
+            # The keys of the batch are consumed
+            keys[index] = keys[index][result.scanned:]
+            if complete[index] and not keys[index]:
+                # The plan is exhausted: plan again at the next turn
+                plans[index] = None
+                complete[index] = False
+            deleted += result.deleted
+
+            pacer = pacers.setdefault(result.using, Pacer(target_latency, max_lag, max_sleep=max_sleep))
+            lag = replication_lag(connections[result.using])
+            pause = pacer.update(result.timings.get('delete', 0), lag)
+            if logger is not None and pacer.overloaded(result.timings.get('delete', 0), lag):
+                logger.info('"%s": database busy (batch: %.3f s, replication lag: %s); pausing %.1f s' % (
+                    options['model_name'], result.timings.get('delete', 0), '%.1f s' % lag if lag is not None else 'n/a', pause,
+                ))
+            # A single batch per turn: delete_in_batches() never paces it
+            sleep(Pacer.throttle(
+                pause, result.deleted, result.elapsed,
+                batch_sleep=options.get('batch_sleep', 0), max_rows_per_second=options.get('max_rows_per_second', 0),
+            ))
+
+        if deleted > 0:
+            if logger is not None:
+                logger.info('%d records removed' % deleted)
+        else:
+            if logger is not None:
+                logger.debug('Nothing to do; sleeping %.1f s' % idle_sleep)
+            sleep(idle_sleep)
+
+    for total in totals:
+        total.finish(error=total.error)
+    return totals
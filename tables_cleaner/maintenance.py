@@ -0,0 +1,166 @@
+"""
+Table-scoped maintenance, executed after cleaning.
+
+- PostgreSQL: "VACUUM (ANALYZE) <table>"
+- MySQL: "OPTIMIZE TABLE <table>"
+- SQLite: "PRAGMA incremental_vacuum(N)", once per database (requires auto_vacuum=INCREMENTAL)
+
+Only tables where the ratio of deleted records exceeds a threshold are maintained.
+Maintenance statements can't run inside a transaction.
+"""
+import time
+from django.apps import apps
+from django.db import connections
+from .planner import estimate_count
+
+
+SUPPORTED_VENDORS = ('postgresql', 'mysql', 'sqlite')
+
+# SQLite PRAGMA auto_vacuum value for INCREMENTAL
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def deleted_ratio(result, model):
+    """
+    Ratio of the records deleted over the records before cleaning.
+
+    Right after a DELETE, the planner statistics may still describe the table before it
+    (PostgreSQL scales reltuples by the n. of pages, which doesn't change; InnoDB refreshes
+    its statistics asynchronously), so they can't tell the records left. Instead, the size
+    counted by the run itself is used, when available; otherwise, on PostgreSQL, the live
+    and dead tuples of pg_stat_user_tables (whose sum is the size before the DELETE, whether
+    or not its statistics have been reported yet); on MySQL, the statistics are refreshed
+    with ANALYZE TABLE before estimating the records left.
+    """
+    total = None
+    if result.table_size is not None:
+        total = result.table_size
+    else:
+        connection = connections[result.using]
+        if connection.vendor == 'postgresql':
+            total = table_tuples(connection, model)
+        elif connection.vendor == 'mysql':
+            analyze_table(connection, model)
+        if total is None:
+            total = result.deleted + estimate_count(model._default_manager.using(result.using).all())
+    return min(result.deleted / total, 1.0) if total > 0 else 0
+
+
+def table_tuples(connection, model):
+    """
+    Live plus dead tuples of the table (PostgreSQL), or None when not available
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT n_live_tup + n_dead_tup FROM pg_stat_user_tables WHERE relid = %s::regclass',
+            [connection.ops.quote_name(model._meta.db_table)],
+        )
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def analyze_table(connection, model):
+    """
+    Refresh the statistics of the table (MySQL)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE TABLE %s' % connection.ops.quote_name(model._meta.db_table))
+        # A result set, which must be consumed
+        cursor.fetchall()
+
+
+def maintain_table(connection, model, logger=None):
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    if connection.vendor == 'postgresql':
+        sql = 'VACUUM (ANALYZE) %s' % table
+    else:
+        sql = 'OPTIMIZE TABLE %s' % table
+    if logger is not None:
+        logger.info('Executing %s' % sql)
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        if connection.vendor == 'mysql':
+            # OPTIMIZE TABLE returns a result set, which must be consumed
+            cursor.fetchall()
+
+
+def incremental_vacuum(connection, pages=0, logger=None):
+    """
+    Release up to pages free pages (0=all) of a SQLite database;
+    returns False when the database doesn't use auto_vacuum=INCREMENTAL
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != SQLITE_AUTO_VACUUM_INCREMENTAL:
+            if logger is not None:
+                logger.warning('incremental_vacuum skipped: enable it with "PRAGMA auto_vacuum = INCREMENTAL" followed by a one-off "VACUUM"')
+            return False
+        if logger is not None:
+            logger.info('Executing PRAGMA incremental_vacuum(%d)' % pages)
+        cursor.execute('PRAGMA incremental_vacuum(%d)' % pages)
+        cursor.fetchall()
+    return True
+
+
+def maintain_tables(results, threshold=0.1, budget=0, deadline=None, pages=0, logger=None):
+    """
+    Run the maintenance of the tables listed in results (a list of CleanResult);
+    the elapsed time is added to the "vacuum" timing of each result.
+
+    threshold: min ratio of deleted records for a table to be maintained
+    budget: max seconds to spend in maintenance (0=unlimited)
+    deadline: a time.monotonic() value; no maintenance is started after it
+    pages: n. of pages released by SQLite incremental_vacuum (0=all)
+    """
+    t0 = time.monotonic()
+
+    def time_left():
+        if budget > 0 and time.monotonic() - t0 >= budget:
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        return True
+
+    sqlite_results = {}
+    for result in results:
+        if result.failed or result.dry_run or result.deleted <= 0:
+            continue
+        connection = connections[result.using]
+        if connection.vendor not in SUPPORTED_VENDORS:
+            if logger is not None:
+                logger.warning('"%s": maintenance not supported on %s' % (result.model_name, connection.vendor))
+            continue
+        if connection.in_atomic_block:
+            if logger is not None:
+                logger.warning('"%s": maintenance skipped inside a transaction' % result.model_name)
+            continue
+        if connection.vendor == 'sqlite':
+            # The free pages of a SQLite database are shared by all tables
+            sqlite_results.setdefault(result.using, []).append(result)
+            continue
+
+        if not time_left():
+            if logger is not None:
+                logger.warning('"%s": maintenance skipped (time limit)' % result.model_name)
+            continue
+
+        model = apps.get_model(result.model_name)
+        with result.phase('vacuum'):
+            ratio = deleted_ratio(result, model)
+            if ratio < threshold:
+                if logger is not None:
+                    logger.info('"%s": maintenance not required (%.1f%% records deleted)' % (result.model_name, 100 * ratio))
+                continue
+            maintain_table(connection, model, logger=logger)
+
+    for using, results in sqlite_results.items():
+        if not time_left():
+            if logger is not None:
+                logger.warning('incremental_vacuum on "%s" skipped (time limit)' % using)
+            continue
+        t1 = time.monotonic()
+        incremental_vacuum(connections[using], pages=pages, logger=logger)
+        elapsed = time.monotonic() - t1
+        for result in results:
+            result.timings['vacuum'] = result.timings.get('vacuum', 0) + elapsed
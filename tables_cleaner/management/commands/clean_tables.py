@@ -1,36 +1,105 @@
 import logging
+import os
 import sys
 import signal
-from django.db import transaction
-from django.db import connections
-from django.db import DEFAULT_DB_ALIAS
+import threading
+import time
 
 from tables_cleaner import clean_tables
+from tables_cleaner.advisor import check_tables
+from tables_cleaner.clean import get_tables
+from tables_cleaner.daemon import run_daemon
+from tables_cleaner.daemon import DAEMON_BATCH_SIZE
+from tables_cleaner.maintenance import maintain_tables
+from tables_cleaner.metrics import export_results
+from tables_cleaner.progress import ProgressLine
+from tables_cleaner.state import format_status
+from tables_cleaner.state import get_states
 
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
 
 logger = logging.getLogger(__name__)
 
 
-def signal_handler(signal, frame):
-    sys.exit(0)
-
-
 class Command(BaseCommand):
 
     def __init__(self, logger=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.logger = logger or logging.getLogger(__name__)
-        signal.signal(signal.SIGINT, signal_handler)
+        self.stop = threading.Event()
+
+    def signal_handler(self, signum, frame):
+        """
+        Stop gracefully, after the current batch (or table); a second signal exits immediately
+        """
+        if self.stop.is_set():
+            sys.exit(1)
+        self.logger.warning('Signal %d received; stopping after the current batch' % signum)
+        self.stop.set()
 
     def add_arguments(self, parser):
         parser.add_argument(
-            '--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
-            help='Nominates a specific database to load fixtures into. Defaults to the "default" database.',
+            '--database', action='store', dest='database', default=None,
+            help='Clean only the tables on this database (tables assigned to other databases with "using" are skipped). '
+                 'Defaults to all databases, as suggested by the routers.',
+        )
+        parser.add_argument(
+            '--plan-database', action='store', dest='plan_database', default=None,
+            help='Compute the records to be removed, and count them, on this database (i.e. a read replica); '
+                 'records are still deleted from the primary database, after checking the boundaries there.',
         )
         parser.add_argument('-d', '--dry-run', action='store_true', default=False, help="Don't actually delete records (default: False)")
         parser.add_argument('--vacuum', action='store_true', default=False, help="Run VACUUM after deletion")
+        parser.add_argument('--vacuum-threshold', type=float, default=0.1,
+            help="Run VACUUM only on tables where this ratio of records has been deleted (default: 0.1)")
+        parser.add_argument('--vacuum-budget', type=float, default=0,
+            help="Max seconds to spend in VACUUM; 0=unlimited (default: 0)")
+        parser.add_argument('--vacuum-pages', type=int, default=0,
+            help="SQLite only: max n. of pages released by incremental_vacuum; 0=all (default: 0)")
+        parser.add_argument('--batch-size', type=int, default=0,
+            help="Delete records in batches of this size, committing each batch separately; 0=single transaction (default: 0)")
+        parser.add_argument('--batch-sleep', type=float, default=0,
+            help="Seconds to sleep between batches (default: 0)")
+        parser.add_argument('--max-rows-per-second', type=float, default=0,
+            help="Throttle deletion to this rate; 0=unlimited (default: 0)")
+        parser.add_argument('--max-duration', type=float, default=0,
+            help="Stop cleaning after this many seconds; 0=unlimited (default: 0)")
+        parser.add_argument('--lock-timeout', type=float, default=0,
+            help="Give up a deletion waiting for locks longer than this many seconds, and retry it later; 0=unused (default: 0)")
+        parser.add_argument('--statement-timeout', type=float, default=0,
+            help="Give up a deletion running longer than this many seconds, and retry it later; 0=unused (default: 0)")
+        parser.add_argument('--workers', type=int, default=1,
+            help="Clean up to this many tables concurrently, each one in its own transaction (default: 1); "
+                 "different databases are always cleaned concurrently")
+        parser.add_argument('--workers-per-database', type=int, default=0,
+            help="Max n. of concurrent workers on the same database; 0=unlimited (default: 0)")
+        parser.add_argument('--check', action='store_true', default=False,
+            help="Don't clean; check that get_latest_by columns are indexed and used by the cleaning queries")
+        parser.add_argument('--status', action='store_true', default=False,
+            help="Don't clean; show the outcome of the last run for each table")
+        parser.add_argument('--profile', nargs='?', const='.', default=None, metavar='DIR',
+            help="Record the queries of each table, with their timings and execution plans, "
+                 "and write a report for each table into DIR (default: the current directory)")
+        parser.add_argument('--profile-python', action='store_true', default=False,
+            help="With --profile, profile the Python code too (cProfile)")
+        parser.add_argument('--emit-migrations', action='store_true', default=False,
+            help="With --check, write a migration adding each missing index")
+        parser.add_argument('--metrics-json', default=None,
+            help="Write the results of the run to this JSON file (default: settings.TABLES_CLEANER_METRICS_JSON)")
+        parser.add_argument('--metrics-prometheus', default=None,
+            help="Write the results of the run to this Prometheus text file (default: settings.TABLES_CLEANER_METRICS_PROMETHEUS)")
+        parser.add_argument('--daemon', action='store_true', default=False,
+            help="Run continuously, deleting small batches from each table in turn, until SIGTERM")
+        parser.add_argument('--idle-sleep', type=float, default=60,
+            help="Daemon mode: seconds to sleep when there is nothing to delete (default: 60)")
+        parser.add_argument('--target-latency', type=float, default=1.0,
+            help="Daemon mode: slow down when a batch takes longer than this many seconds; 0=unused (default: 1.0)")
+        parser.add_argument('--max-lag', type=float, default=10.0,
+            help="Daemon mode: slow down when the replication lag exceeds this many seconds; 0=unused (default: 10.0)")
+        parser.add_argument('--max-sleep', type=float, default=60,
+            help="Daemon mode: max pause between batches when slowing down (default: 60)")
 
     def set_logger(self, verbosity):
         """
@@ -57,46 +126,100 @@ class Command(BaseCommand):
         self.using = options['database']
         self.dry_run = options['dry_run']
         self.vacuum = options['vacuum']
-
-        self.logger.info("***** clean_tables started on db %s. *****" % self.using)
-
-        # Be transactional !
-        with transaction.atomic(using=self.using):
-
-            clean_tables(logger=self.logger, dry_run=self.dry_run)
-
-            # Close the DB connection -- unless we're still in a transaction. This
-            # is required as a workaround for an edge case in MySQL: if the same
-            # connection is used to create tables, load data, and query, the query
-            # can return incorrect results. See Django #7572, MySQL #37735.
-            if transaction.get_autocommit(self.using):
-                connections[self.using].close()
+        clean_options = {
+            'batch_size': options['batch_size'],
+            'batch_sleep': options['batch_sleep'],
+            'max_rows_per_second': options['max_rows_per_second'],
+            'max_duration': options['max_duration'],
+            'lock_timeout': options['lock_timeout'],
+            'statement_timeout': options['statement_timeout'],
+            'max_workers': options['workers'],
+            'max_workers_per_database': options['workers_per_database'],
+            'using': self.using,
+            'plan_using': options['plan_database'],
+        }
+
+        if options['status']:
+            states = get_states()
+            if self.using:
+                states = [state for state in states if state.using == self.using]
+            self.stdout.write(format_status(states))
+            return
+
+        if options['check']:
+            checks = check_tables(logger=self.logger, emit_migrations=options['emit_migrations'])
+            self.logger.info("*** clean_tables check done: %d tables checked, %d warnings." % (
+                len(checks), len([check for check in checks if not check.ok])
+            ))
+            return
+
+        if options['daemon'] and self.dry_run:
+            raise CommandError('--daemon cannot be used with --dry-run')
+        if options['daemon'] and options['profile'] is not None:
+            raise CommandError('--daemon cannot be used with --profile')
+        if options['profile'] is not None and not os.path.isdir(options['profile']):
+            raise CommandError('Profile directory "%s" not found' % options['profile'])
+        if options['profile_python'] and options['profile'] is None:
+            raise CommandError('--profile-python requires --profile')
+
+        self.logger.info("***** clean_tables started on db %s. *****" % (self.using or 'all'))
+        started = time.monotonic()
+
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            # Signal handlers can only be installed by the main thread
+            handlers = {signum: signal.signal(signum, self.signal_handler) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            if options['daemon']:
+                results = run_daemon(
+                    get_tables({
+                        'batch_sleep': options['batch_sleep'],
+                        'max_rows_per_second': options['max_rows_per_second'],
+                        'lock_timeout': options['lock_timeout'],
+                        'statement_timeout': options['statement_timeout'],
+                        'plan_using': options['plan_database'],
+                    }, using=self.using),
+                    self.stop,
+                    batch_size=options['batch_size'] or DAEMON_BATCH_SIZE,
+                    idle_sleep=options['idle_sleep'],
+                    target_latency=options['target_latency'],
+                    max_lag=options['max_lag'],
+                    max_sleep=options['max_sleep'],
+                    max_duration=options['max_duration'],
+                    logger=self.logger,
+                )
+            else:
+                # Be transactional: one transaction for each database, unless batches
+                # (or workers) are used, which commit each batch (or table) separately
+                progress = None
+                if options.get('verbosity') == 1 and self.stdout.isatty():
+                    # A live progress line for the tables deleted in batches
+                    progress = ProgressLine(self.stdout)
+                    # Log records are written on a new line
+                    self.logger.addFilter(progress)
+                try:
+                    results = clean_tables(
+                        logger=self.logger, dry_run=self.dry_run, atomic=True, stop=self.stop, progress=progress,
+                        profile_dir=options['profile'], profile_python=options['profile_python'], **clean_options
+                    )
+                finally:
+                    if progress is not None:
+                        self.logger.removeFilter(progress)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
 
         if self.vacuum and not self.dry_run:
-            self.vacuum_db(connections[self.using])
+            maintain_tables(
+                results,
+                threshold=options['vacuum_threshold'],
+                budget=options['vacuum_budget'],
+                deadline=started + options['max_duration'] if options['max_duration'] > 0 else None,
+                pages=options['vacuum_pages'],
+                logger=self.logger,
+            )
+
+        export_results(results, metrics_json=options['metrics_json'], metrics_prometheus=options['metrics_prometheus'], logger=self.logger)
 
         self.logger.info("*** clean_tables done.")
 
-    def vacuum_supported(self, connection):
-        supported_engines = [
-            'postgresql',
-            'postgis',
-            'sqlite',
-            'spatialite',
-        ]
-        engine_module = connection.__class__.__module__
-        for engine in supported_engines:
-            if engine in engine_module:
-                return True
-        self.logger.warn('Vacuum not supported on %s' % engine_module)
-        return False
-
-    def vacuum_db(self, connection):
-        if not self.vacuum_supported(connection):
-            self.logger.warn('VACUUM skipped')
-            return False
-        self.logger.info('Executing VACUUM')
-        cursor = connection.cursor()
-        cursor.execute('VACUUM')
-        cursor.close()
-        return True
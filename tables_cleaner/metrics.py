@@ -0,0 +1,232 @@
+"""
+Structured results of cleaning runs, and exporters for them.
+
+clean_table() returns a CleanResult for each table; the results of a run can be
+exported to a JSON file, or to a Prometheus text file (to be collected by
+node_exporter's textfile collector).
+"""
+from contextlib import contextmanager
+import functools
+import json
+import os
+import tempfile
+import time
+from django.utils import timezone
+from . import app_settings
+
+
+def as_number(value):
+    """
+    value as a number (the records removed, for a CleanResult), or None
+    """
+    if isinstance(value, CleanResult):
+        return value.deleted
+    if isinstance(value, (int, float)):
+        return value
+    return None
+
+
+@functools.total_ordering
+class CleanResult(object):
+    """
+    The outcome of cleaning a single table.
+
+    For backward compatibility, it behaves like an int (the number of records
+    removed, or to be removed in dry-run mode): it can be tested for truth, compared,
+    added (i.e. sum(results)) and hashed as such.
+    """
+
+    def __init__(self, model_name, dry_run=False):
+        self.model_name = model_name
+        self.dry_run = dry_run
+        self.using = None
+        # records removed (or to be removed, in dry-run mode)
+        self.deleted = 0
+        # records in the table before cleaning, when counted
+        self.table_size = None
+        # records examined while selecting the records to be removed
+        self.scanned = 0
+        # records removed from (or updated in) related models, by label
+        self.related = {}
+        self.batches = 0
+        self.queries = 0
+        # elapsed time (seconds) by phase: plan, count, partitions, archive, delete, vacuum
+        self.timings = {}
+        self.error = None
+        # the most recent value of get_latest_by which could be removed, when known
+        self.cutoff = None
+        # True when there was nothing to do (see clean_table())
+        self.skipped = False
+        # the CleaningPlan used, when computed (see clean_table())
+        self.plan = None
+        self.started = timezone.now()
+        self.elapsed = 0
+        self._t0 = time.monotonic()
+
+    def __repr__(self):
+        return '<CleanResult %s: %s>' % (self.model_name, 'FAILED' if self.failed else self.deleted)
+
+    def __int__(self):
+        return self.deleted
+
+    __index__ = __int__
+
+    def __bool__(self):
+        return self.deleted != 0
+
+    def __eq__(self, other):
+        other = as_number(other)
+        return NotImplemented if other is None else self.deleted == other
+
+    def __lt__(self, other):
+        other = as_number(other)
+        return NotImplemented if other is None else self.deleted < other
+
+    def __hash__(self):
+        return hash(self.deleted)
+
+    def __add__(self, other):
+        other = as_number(other)
+        return NotImplemented if other is None else self.deleted + other
+
+    __radd__ = __add__
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def rate(self):
+        """
+        Records removed per second
+        """
+        elapsed = self.timings.get('delete', 0)
+        return self.deleted / elapsed if elapsed > 0 else 0
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.monotonic() - t0
+
+    def add(self, other):
+        """
+        Accumulate the counters of other (a CleanResult of the same table)
+        """
+        self.deleted += other.deleted
+        self.scanned += other.scanned
+        self.batches += other.batches
+        self.queries += other.queries
+        for label, n in other.related.items():
+            self.related[label] = self.related.get(label, 0) + n
+        for name, elapsed in other.timings.items():
+            self.timings[name] = self.timings.get(name, 0) + elapsed
+        self.using = other.using
+        self.error = other.error
+        return self
+
+    def finish(self, error=None):
+        if error is not None:
+            self.error = str(error)
+        self.elapsed = time.monotonic() - self._t0
+        return self
+
+    def as_dict(self):
+        return {
+            'model_name': self.model_name,
+            'using': self.using,
+            'dry_run': self.dry_run,
+            'deleted': self.deleted,
+            'scanned': self.scanned,
+            'related': dict(self.related),
+            'batches': self.batches,
+            'queries': self.queries,
+            'timings': dict(self.timings),
+            'elapsed': self.elapsed,
+            'rate': self.rate,
+            'started': self.started.isoformat(),
+            'cutoff': self.cutoff.isoformat() if hasattr(self.cutoff, 'isoformat') else self.cutoff,
+            'skipped': self.skipped,
+            'error': self.error,
+        }
+
+
+class QueryCounter(object):
+    """
+    A connection.execute_wrapper() counting the queries executed
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def __call__(self, execute, sql, params, many, context):
+        self.result.queries += 1
+        return execute(sql, params, many, context)
+
+
+def write_atomically(path, content):
+    """
+    Write content to path via a temporary file, so that readers never see a partial file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tables_cleaner-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def export_json(results, path):
+    write_atomically(path, json.dumps([result.as_dict() for result in results], indent=2) + '\n')
+
+
+def export_prometheus(results, path):
+    """
+    Write results in the Prometheus text exposition format
+    """
+    metrics = [
+        ('tables_cleaner_deleted_records', 'gauge', 'Records removed by the last run', lambda r: r.deleted),
+        ('tables_cleaner_scanned_records', 'gauge', 'Records examined by the last run', lambda r: r.scanned),
+        ('tables_cleaner_batches', 'gauge', 'Batches committed by the last run', lambda r: r.batches),
+        ('tables_cleaner_queries', 'gauge', 'Queries executed by the last run', lambda r: r.queries),
+        ('tables_cleaner_elapsed_seconds', 'gauge', 'Duration of the last run', lambda r: r.elapsed),
+        ('tables_cleaner_failed', 'gauge', '1 if the last run failed', lambda r: int(r.failed)),
+        ('tables_cleaner_last_run_timestamp_seconds', 'gauge', 'Start time of the last run', lambda r: r.started.timestamp()),
+    ]
+    lines = []
+    for name, kind, help, value in metrics:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for result in results:
+            lines.append('%s{table="%s"} %s' % (name, result.model_name, value(result)))
+
+    name = 'tables_cleaner_phase_seconds'
+    lines.append('# HELP %s Duration of each phase of the last run' % name)
+    lines.append('# TYPE %s gauge' % name)
+    for result in results:
+        for phase in sorted(result.timings.keys()):
+            lines.append('%s{table="%s",phase="%s"} %s' % (name, result.model_name, phase, result.timings[phase]))
+
+    write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def export_results(results, metrics_json=None, metrics_prometheus=None, logger=None):
+    """
+    Export results to metrics_json and/or metrics_prometheus files (default:
+    TABLES_CLEANER_METRICS_JSON and TABLES_CLEANER_METRICS_PROMETHEUS settings)
+    """
+    metrics_json = metrics_json or app_settings.METRICS_JSON
+    metrics_prometheus = metrics_prometheus or app_settings.METRICS_PROMETHEUS
+    if metrics_json:
+        export_json(results, metrics_json)
+        if logger is not None:
+            logger.info('Metrics written to "%s"' % metrics_json)
+    if metrics_prometheus:
+        export_prometheus(results, metrics_prometheus)
+        if logger is not None:
+            logger.info('Metrics written to "%s"' % metrics_prometheus)
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=100, verbose_name='model name')),
+                ('using', models.CharField(max_length=100, verbose_name='database')),
+                ('last_run', models.DateTimeField(blank=True, null=True, verbose_name='last run')),
+                ('cutoff', models.CharField(blank=True, max_length=100, verbose_name='cutoff')),
+                ('deleted', models.BigIntegerField(default=0, verbose_name='records removed')),
+                ('duration', models.FloatField(default=0, verbose_name='duration (s)')),
+                ('skipped', models.BooleanField(default=False, verbose_name='skipped')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('runs', models.PositiveIntegerField(default=0, verbose_name='runs')),
+                ('total_deleted', models.BigIntegerField(default=0, verbose_name='total records removed')),
+            ],
+            options={
+                'verbose_name': 'table state',
+                'ordering': ('model_name', 'using'),
+                'unique_together': {('model_name', 'using')},
+            },
+        ),
+    ]
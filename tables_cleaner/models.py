@@ -0,0 +1,28 @@
+from django.db import models
+
+
+class TableState(models.Model):
+    """
+    The outcome of the last cleaning of each table (see tables_cleaner.state)
+    """
+
+    model_name = models.CharField('model name', max_length=100)
+    using = models.CharField('database', max_length=100)
+    last_run = models.DateTimeField('last run', null=True, blank=True)
+    # the most recent value of get_latest_by which could be removed, as text
+    cutoff = models.CharField('cutoff', max_length=100, blank=True)
+    deleted = models.BigIntegerField('records removed', default=0)
+    duration = models.FloatField('duration (s)', default=0)
+    # True when the last run found nothing to do
+    skipped = models.BooleanField('skipped', default=False)
+    error = models.TextField('error', blank=True)
+    runs = models.PositiveIntegerField('runs', default=0)
+    total_deleted = models.BigIntegerField('total records removed', default=0)
+
+    class Meta:
+        verbose_name = 'table state'
+        ordering = ('model_name', 'using')
+        unique_together = (('model_name', 'using'), )
+
+    def __str__(self):
+        return '%s@%s' % (self.model_name, self.using)
@@ -0,0 +1,251 @@
+"""
+Partition-aware retention for range-partitioned tables.
+
+Partitions whose upper bound is not more recent than the cleaning boundary
+only contain obsolete records, so they can be dropped (or truncated) as a whole;
+row-level deletion is then left with the boundary partition only.
+
+Supported backends: PostgreSQL (declarative RANGE partitioning) and MySQL (RANGE
+COLUMNS, and RANGE(TO_DAYS(...))); the partition key must be the get_latest_by
+column (a date or datetime), or TO_DAYS() of it. Any other scheme (i.e. RANGE(YEAR(...)),
+RANGE(UNIX_TIMESTAMP(...))) is refused, since its bounds can't be read as dates.
+"""
+import datetime
+import re
+from django.db import connections
+from django.utils import dateparse
+from django.utils import timezone
+
+
+# MySQL PARTITION_EXPRESSION of RANGE(TO_DAYS(column))
+TO_DAYS = re.compile(r'^to_days\(\s*`?(\w+)`?\s*\)$', re.IGNORECASE)
+
+
+class UnsupportedPartitioning(Exception):
+    pass
+
+
+class Partition(object):
+
+    def __init__(self, name, upper_bound, rows=None):
+        self.name = name
+        # exclusive upper bound; None for MAXVALUE and DEFAULT partitions
+        self.upper_bound = upper_bound
+        # estimated n. of records, from the database statistics
+        self.rows = rows
+
+    def __repr__(self):
+        return '<Partition %s: < %s>' % (self.name, self.upper_bound)
+
+
+def parse_bound(value, to_days=False):
+    """
+    Convert a partition bound literal into a date or datetime (with to_days, a
+    MySQL TO_DAYS() value); None if unbounded. Raises UnsupportedPartitioning
+    when value can't be read as such
+    """
+    if value is None:
+        return None
+    value = str(value).strip().strip("'").strip()
+    if value.upper() in ('MAXVALUE', 'MINVALUE', ''):
+        return None
+    if to_days:
+        if not value.isdigit():
+            raise UnsupportedPartitioning('unexpected TO_DAYS() bound "%s"' % value)
+        # TO_DAYS('0001-01-01') == 366
+        return datetime.date.fromordinal(int(value) - 365)
+    try:
+        bound = dateparse.parse_date(value)
+    except ValueError:
+        bound = None
+    if bound is None:
+        try:
+            bound = dateparse.parse_datetime(value)
+        except ValueError:
+            bound = None
+    if bound is None:
+        raise UnsupportedPartitioning('bound "%s" is not a date' % value)
+    return bound
+
+
+def partition_scheme(vendor, method, expression, column):
+    """
+    How the bounds of a table partitioned (with method, i.e. "RANGE COLUMNS", on
+    expression) are read, when get_latest_by is column: 'to_days' (MySQL
+    RANGE(TO_DAYS(column))) or 'dates' (date or datetime literals);
+    raises UnsupportedPartitioning for any other scheme
+    """
+    method = (method or '').strip().upper()
+    expression = (expression or '').strip()
+    if vendor == 'mysql':
+        if method == 'RANGE':
+            match = TO_DAYS.match(expression)
+            if match is not None and match.group(1) == column:
+                return 'to_days'
+        elif method == 'RANGE COLUMNS' and expression.strip('`') == column:
+            return 'dates'
+    elif vendor == 'postgresql':
+        if method == 'RANGE' and expression.strip('"') == column:
+            return 'dates'
+    raise UnsupportedPartitioning(
+        'partitioning by %s (%s) is not supported; partition by RANGE on the get_latest_by column "%s"%s' % (
+            method or '?', expression, column, ' (or on TO_DAYS() of it)' if vendor == 'mysql' else '',
+        )
+    )
+
+
+def comparable(value, reference):
+    """
+    Convert value to be compared with reference (date vs datetime, naive vs aware)
+    """
+    if isinstance(reference, datetime.datetime):
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time.min)
+        if timezone.is_aware(reference) and timezone.is_naive(value):
+            value = timezone.make_aware(value, datetime.timezone.utc)
+        elif timezone.is_naive(reference) and timezone.is_aware(value):
+            value = timezone.make_naive(value, datetime.timezone.utc)
+    elif isinstance(value, datetime.datetime):
+        value = value.date()
+    return value
+
+
+def is_expired(partition, plan):
+    """
+    True when all records of the partition would be removed by plan
+    """
+    if plan.nothing_to_do or partition.upper_bound is None:
+        return False
+    if not all(is_expired(partition, other) for other in plan.restrictions):
+        return False
+    if plan.cap is not None:
+        if comparable(partition.upper_bound, plan.cap[0]) <= plan.cap[0]:
+            return True
+        if not plan.retains:
+            return False
+    if plan.partition_by:
+        # Records are ranked within their group: can't tell from the bounds
+        return False
+    limits = []
+    if plan.threshold is not None:
+        limits.append(plan.threshold)
+    if plan.boundary is not None:
+        limits.append(plan.boundary[0])
+    for limit in limits:
+        if comparable(partition.upper_bound, limit) > limit:
+            return False
+    return True
+
+
+def list_partitions(connection, table, column):
+    """
+    List the partitions of table, ordered by upper bound; raises UnsupportedPartitioning
+    unless table is partitioned on column (see partition_scheme())
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_get_partkeydef(oid) FROM pg_class WHERE relname = %s AND relkind = 'p'", [table])
+            row = cursor.fetchone()
+        if row is None:
+            raise UnsupportedPartitioning('table "%s" is not partitioned' % table)
+        # i.e. "RANGE (created)"
+        method, __, expression = row[0].partition(' (')
+        partition_scheme(connection.vendor, method, expression[:-1], column)
+        sql = """
+            SELECT child.relname,
+                   pg_get_expr(child.relpartbound, child.oid),
+                   child.reltuples
+            FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = %s
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            rows = cursor.fetchall()
+        partitions = []
+        for name, expression, rows_estimate in rows:
+            # i.e.: "FOR VALUES FROM ('2020-01-01') TO ('2020-01-02')", or "DEFAULT"
+            upper_bound = None
+            if ' TO (' in expression:
+                upper_bound = parse_bound(expression.rsplit(' TO (', 1)[1].rstrip(')'))
+            partitions.append(Partition(name, upper_bound, max(int(rows_estimate), 0)))
+
+    elif connection.vendor == 'mysql':
+        sql = """
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS, PARTITION_METHOD, PARTITION_EXPRESSION
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            rows = cursor.fetchall()
+        if not rows:
+            raise UnsupportedPartitioning('table "%s" is not partitioned' % table)
+        schemes = set(partition_scheme(connection.vendor, method, expression, column) for __, __, __, method, expression in rows)
+        partitions = [
+            Partition(name, parse_bound(description, to_days=schemes == {'to_days'}), rows_estimate)
+            for name, description, rows_estimate, __, __ in rows
+        ]
+
+    else:
+        raise Exception('Partitioned tables are supported on PostgreSQL and MySQL only')
+
+    return sorted(
+        partitions,
+        key=lambda partition: (partition.upper_bound is None, str(partition.upper_bound)),
+    )
+
+
+def remove_partition(connection, table, partition, action='drop'):
+    quote = connection.ops.quote_name
+    if connection.vendor == 'postgresql':
+        if action == 'truncate':
+            statements = ['TRUNCATE TABLE %s' % quote(partition.name)]
+        else:
+            statements = [
+                'ALTER TABLE %s DETACH PARTITION %s' % (quote(table), quote(partition.name)),
+                'DROP TABLE %s' % quote(partition.name),
+            ]
+    else:
+        statements = ['ALTER TABLE %s %s PARTITION %s' % (
+            quote(table), 'TRUNCATE' if action == 'truncate' else 'DROP', quote(partition.name),
+        )]
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def clean_partitions(model_name, plan, using, action='drop', dry_run=False, logger=None):
+    """
+    Drop (or truncate) the partitions containing obsolete records only;
+    returns the list of partitions removed (or to be removed, when dry_run is set)
+    """
+    if action not in ('drop', 'truncate'):
+        raise Exception('"%s": unknown partition_action "%s"; choices are: drop, truncate' % (model_name, action))
+
+    connection = connections[using]
+    table = plan.model._meta.db_table
+    field = plan.model._meta.get_field(plan.get_latest_by)
+    if field.get_internal_type() not in ('DateField', 'DateTimeField'):
+        raise UnsupportedPartitioning('"%s": get_latest_by "%s" is not a date or datetime' % (model_name, field.name))
+    try:
+        partitions = list_partitions(connection, table, field.column)
+    except UnsupportedPartitioning as e:
+        raise UnsupportedPartitioning('"%s": %s' % (model_name, str(e)))
+    expired = [partition for partition in partitions if is_expired(partition, plan)]
+
+    for partition in expired:
+        if dry_run:
+            if logger is not None:
+                logger.info('DRY-RUN: partition "%s" (~%d records) would be %s from "%s"' % (
+                    partition.name, partition.rows or 0, 'truncated' if action == 'truncate' else 'dropped', model_name,
+                ))
+        else:
+            remove_partition(connection, table, partition, action=action)
+            if logger is not None:
+                logger.info('"%s": partition "%s" (~%d records) %s' % (
+                    model_name, partition.name, partition.rows or 0, 'truncated' if action == 'truncate' else 'dropped',
+                ))
+
+    return expired
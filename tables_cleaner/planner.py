@@ -0,0 +1,445 @@
+"""
+Compute which records have to be removed from a table.
+
+The retention constraints (keep_records, keep_since_days, keep_since_hours) are
+resolved into a range predicate on (get_latest_by, pk): every record older than
+the boundary is obsolete. The Nth most recent record is found with one indexed
+query, so the records to be removed can be selected with a plain range predicate
+(no LIMIT/OFFSET subqueries, no counting).
+
+Row-count and size limits (max_records, see also tables_cleaner.sizes) are resolved
+the same way, into the boundary of the newest records to be preserved; unlike
+the retention constraints, they take precedence: records beyond the limit are
+removed even if they are preserved by keep_records or keep_since_*.
+
+With partition_by, keep_records applies to each group of records (i.e. "keep the
+last 1000 records of each device"): records are ranked within their group with
+ROW_NUMBER() OVER (PARTITION BY ...), or, when the database doesn't support window
+functions, with a correlated subquery looking for keep_records more recent records
+in the same group; either way, the records to be removed are selected by a single
+set-based query.
+
+Records with a NULL get_latest_by (or partition_by) are never removed by a time or count constraint.
+
+A plan computed on a read replica can be restricted to the records selected by the
+same plan computed on the primary (see CleaningPlan.restrict()), so that replication
+lag never widens the records to be removed.
+"""
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import json
+from django.db import connections
+from django.db import router
+from django.db.models import Exists
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import OuterRef
+from django.db.models import Q
+from django.db.models import Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from .partitions import comparable
+
+
+class CleaningPlan(object):
+
+    def __init__(self, model, get_latest_by, threshold=None, boundary=None, nothing_to_do=False, cap=None,
+                 partition_by=(), keep_per_group=0, using=None):
+        self.model = model
+        self.get_latest_by = get_latest_by
+        # keep the keep_per_group most recent records of each group of records sharing partition_by
+        self.partition_by = tuple(partition_by)
+        self.keep_per_group = keep_per_group
+        # the database used to rank records
+        self.using = using
+        # records older than threshold can be removed
+        self.threshold = threshold
+        # (value, pk) of the oldest record to be preserved by keep_records
+        self.boundary = boundary
+        # (value, pk) of the oldest record allowed by max_records
+        self.cap = cap
+        self.nothing_to_do = nothing_to_do
+        # other plans whose records to be removed must include ours (see restrict())
+        self.restrictions = []
+
+    def __repr__(self):
+        if self.nothing_to_do:
+            return '<CleaningPlan %s: nothing to do>' % self.model._meta.label
+        text = 'threshold=%r boundary=%r' % (self.threshold, self.boundary)
+        if self.partition_by:
+            text += ' keep_per_group=%d partition_by=%s' % (self.keep_per_group, ','.join(self.partition_by))
+        if self.cap is not None:
+            text += ' cap=%r' % (self.cap, )
+        for other in self.restrictions:
+            text += ' restricted to %r' % other
+        return '<CleaningPlan %s: %s>' % (self.model._meta.label, text)
+
+    @property
+    def retains(self):
+        """
+        True when any retention constraint (besides the limits) applies
+        """
+        return self.threshold is not None or self.boundary is not None or bool(self.partition_by)
+
+    def older_than(self, boundary):
+        value, pk = boundary
+        return Q(**{self.get_latest_by + '__lt': value}) | Q(**{self.get_latest_by: value, 'pk__lt': pk})
+
+    @property
+    def predicate(self):
+        """
+        A Q object selecting the records to be removed
+        """
+        predicate = self.bounds(outranked=True)
+        for other in self.restrictions:
+            # The ranking of the same groups is evaluated once
+            predicate &= other.bounds(outranked=other.partition_by != self.partition_by)
+        return predicate
+
+    def bounds(self, outranked=True):
+        predicate = Q()
+        if self.threshold is not None:
+            predicate &= Q(**{self.get_latest_by + '__lt': self.threshold})
+        if self.boundary is not None:
+            predicate &= self.older_than(self.boundary)
+        if self.partition_by and outranked:
+            predicate &= self.outranked()
+        if self.cap is not None:
+            if not self.retains:
+                # Only the limits apply
+                return self.older_than(self.cap)
+            predicate |= self.older_than(self.cap)
+        return predicate
+
+    @property
+    def cutoff(self):
+        """
+        No record more recent than cutoff (a value of get_latest_by) has to be removed;
+        None when unknown
+        """
+        if self.nothing_to_do:
+            return None
+        limits = [limit for limit in (self.threshold, self.boundary[0] if self.boundary else None) if limit is not None]
+        try:
+            cutoff = min(limits) if limits else None
+            if self.cap is not None:
+                if not self.retains:
+                    return self.cap[0]
+                if cutoff is None:
+                    return None
+                cutoff = max(cutoff, self.cap[0])
+        except TypeError:
+            # i.e. DateField vs datetime
+            return None
+        return cutoff
+
+    @property
+    def keeps_nothing(self):
+        """
+        True when all records are to be removed
+        """
+        return (
+            not self.nothing_to_do and not self.retains and self.cap is None and
+            all(other.keeps_nothing for other in self.restrictions)
+        )
+
+    def survivors(self, using=None):
+        """
+        The records to be preserved (see tables_cleaner.swap)
+        """
+        queryset = self.model._base_manager.all()
+        if using is not None:
+            queryset = queryset.using(using)
+        if self.nothing_to_do:
+            return queryset
+        return queryset.exclude(self.predicate)
+
+    def restrict(self, other):
+        """
+        Remove only the records which other (i.e. the same plan, computed on a replica)
+        would remove too; returns self
+        """
+        if other.nothing_to_do:
+            self.nothing_to_do = True
+        else:
+            self.restrictions.append(other)
+        return self
+
+    def outranked(self):
+        """
+        A Q object selecting the records preceded by at least keep_per_group more recent
+        records of the same group
+        """
+        using = self.using or router.db_for_write(self.model)
+        connection = connections[using]
+        not_null = {name + '__isnull': False for name in (self.get_latest_by, ) + self.partition_by}
+        queryset = self.model._default_manager.using(using).filter(**not_null).order_by()
+
+        if connection.features.supports_over_clause:
+            ranked = queryset.annotate(row_number=Window(
+                expression=RowNumber(),
+                partition_by=[F(name) for name in self.partition_by],
+                order_by=[F(self.get_latest_by).desc(), F('pk').desc()],
+            )).values('pk', 'row_number')
+            sql, params = ranked.query.get_compiler(using=using).as_sql()
+            return Q(pk__in=RawSQL('SELECT ranked.%s FROM (%s) ranked WHERE ranked.%s > %%s' % (
+                connection.ops.quote_name(self.model._meta.pk.column), sql, connection.ops.quote_name('row_number'),
+            ), tuple(params) + (self.keep_per_group, )))
+
+        # Correlated fallback: at least keep_per_group more recent records in the same group
+        more_recent = self.model._default_manager.using(using).filter(
+            Q(**{self.get_latest_by + '__gt': OuterRef(self.get_latest_by)}) |
+            Q(**{self.get_latest_by: OuterRef(self.get_latest_by), 'pk__gt': OuterRef('pk')}),
+            **{name: OuterRef(name) for name in self.partition_by}
+        ).order_by().values('pk')[self.keep_per_group - 1:self.keep_per_group]
+        outranked = queryset.annotate(outranked=Exists(more_recent)).filter(outranked=True).values('pk')
+        sql, params = outranked.query.get_compiler(using=using).as_sql()
+        # A derived table, so that MySQL accepts it in a DELETE from the same table
+        return Q(pk__in=RawSQL('SELECT outranked.%s FROM (%s) outranked' % (
+            connection.ops.quote_name(self.model._meta.pk.column), sql,
+        ), tuple(params)))
+
+    def queryset(self, using=None):
+        """
+        The records to be removed, oldest first
+        """
+        queryset = self.model._default_manager.all()
+        if using is not None:
+            queryset = queryset.using(using)
+        if self.nothing_to_do:
+            return queryset.none()
+        return queryset.filter(self.predicate).order_by(self.get_latest_by, 'pk')
+
+
+def resolve_get_latest_by(model, get_latest_by=None):
+    """
+    The name of the field used to sort records (default: Model's Meta get_latest_by)
+    """
+    if get_latest_by is None:
+        get_latest_by = getattr(model._meta, 'get_latest_by', None)
+    if get_latest_by is None:
+        raise Exception('"%s": missing required attribute "get_latest_by"' % model._meta.label_lower)
+    if get_latest_by.startswith('-'):
+        get_latest_by = get_latest_by[1:]
+    return get_latest_by
+
+
+def time_threshold(keep_since_days, keep_since_hours, now=None):
+    """
+    The most restrictive of the time constraints, or None
+    """
+    if now is None:
+        now = timezone.now()
+    thresholds = []
+    if keep_since_hours > 0:
+        thresholds.append(now - timedelta(hours=keep_since_hours))
+    if keep_since_days > 0:
+        thresholds.append(now - timedelta(days=keep_since_days))
+    return min(thresholds) if thresholds else None
+
+
+def nth_most_recent(model, get_latest_by, n, using=None):
+    """
+    (value, pk) of the nth most recent record, or None
+    """
+    queryset = model._default_manager.all()
+    if using is not None:
+        queryset = queryset.using(using)
+    nth = list(
+        queryset
+        .filter(**{get_latest_by + '__isnull': False})
+        .order_by('-' + get_latest_by, '-pk')
+        .values_list(get_latest_by, 'pk')[n - 1:n]
+    )
+    return nth[0] if nth else None
+
+
+def following(get_latest_by, key):
+    """
+    A Q object selecting the records after key, a (value, pk) of get_latest_by,
+    for keyset pagination on (get_latest_by, pk)
+    """
+    value, pk = key
+    return Q(**{get_latest_by + '__gt': value}) | Q(**{get_latest_by: value, 'pk__gt': pk})
+
+
+def keyset_page(candidates, get_latest_by, last, size):
+    """
+    The (get_latest_by, pk) of the next size records of the (ordered) candidates queryset
+    after last, the (get_latest_by, pk) of the last record of the previous page (None for
+    the first page), by keyset pagination: records with a NULL get_latest_by first, by pk
+    (a NULL can't be compared), then by (get_latest_by, pk)
+    """
+    if last is not None and last[0] is not None:
+        return list(candidates.filter(following(get_latest_by, last)).values_list(get_latest_by, 'pk')[:size])
+    rows = []
+    nullable = candidates.model._meta.get_field(get_latest_by).null
+    if nullable:
+        nulls = candidates.filter(**{get_latest_by + '__isnull': True})
+        if last is not None:
+            nulls = nulls.filter(pk__gt=last[1])
+        rows = list(nulls.order_by('pk').values_list(get_latest_by, 'pk')[:size])
+    if len(rows) < size:
+        if nullable:
+            candidates = candidates.filter(**{get_latest_by + '__isnull': False})
+        rows += list(candidates.values_list(get_latest_by, 'pk')[:size - len(rows)])
+    return rows
+
+
+def nothing_older(model, get_latest_by, cutoff, using=None):
+    """
+    True when no record of model is older than cutoff (or no record at all), with
+    a single MIN() aggregate, answered by the index on get_latest_by
+    """
+    queryset = model._default_manager.all()
+    if using is not None:
+        queryset = queryset.using(using)
+    oldest = queryset.order_by().aggregate(oldest=Min(get_latest_by))['oldest']
+    if oldest is None:
+        return True
+    try:
+        return comparable(oldest, cutoff) > cutoff
+    except TypeError:
+        return False
+
+
+def value_range(queryset, get_latest_by):
+    """
+    (min, max) of get_latest_by in queryset, with a single aggregate query
+    """
+    values = queryset.order_by().aggregate(first=Min(get_latest_by), last=Max(get_latest_by))
+    return values['first'], values['last']
+
+
+def split_points(first, last, parts):
+    """
+    Up to parts - 1 increasing values splitting [first, last] into even intervals,
+    or None when values of that type can't be split
+    """
+    if first is None or last is None or isinstance(first, bool):
+        return None
+    if isinstance(first, datetime):
+        point = lambda i: first + (last - first) * i / parts
+    elif isinstance(first, date):
+        point = lambda i: first + timedelta(days=(last - first).days * i // parts)
+    elif isinstance(first, int):
+        point = lambda i: first + (last - first) * i // parts
+    elif isinstance(first, (float, Decimal)):
+        point = lambda i: first + (last - first) * i / parts
+    else:
+        return None
+    points = []
+    for i in range(1, parts):
+        value = point(i)
+        if value > (points[-1] if points else first):
+            points.append(value)
+    return points
+
+
+def split_range(queryset, get_latest_by, parts):
+    """
+    Split queryset into up to parts disjoint querysets, together selecting all of
+    its records, on even intervals of get_latest_by (or of the primary key, when
+    the values of get_latest_by can't be split); one or two aggregate queries
+    """
+    field = get_latest_by
+    points = split_points(*value_range(queryset, field), parts)
+    if points is None:
+        field = 'pk'
+        points = split_points(*value_range(queryset, field), parts) or []
+    bounds = [Q(**{field + '__gte': point}) for point in points]
+    ranges = []
+    for lower, upper in zip([None] + bounds, bounds + [None]):
+        part = queryset
+        if lower is not None:
+            part = part.filter(lower)
+        if upper is not None:
+            # exclude(): the first range also selects NULL values, if any
+            part = part.exclude(upper)
+        ranges.append(part)
+    return ranges
+
+
+def plan_cleaning(model, get_latest_by, keep_records, keep_since_days, keep_since_hours, using=None, now=None,
+                  max_records=0, partition_by=()):
+    """
+    Resolve the retention constraints into a CleaningPlan;
+    at most one query is executed for keep_records, and one for max_records.
+
+    With partition_by (a field name, or a list of them), keep_records applies to
+    each group of records; no query is required.
+    """
+    threshold = time_threshold(keep_since_days, keep_since_hours, now=now)
+    boundary = None
+    if isinstance(partition_by, str):
+        partition_by = (partition_by, )
+
+    cap = None
+    if max_records > 0:
+        cap = nth_most_recent(model, get_latest_by, max_records, using=using)
+        if threshold is None and keep_records <= 0:
+            # No retention constraints: only the limit applies
+            if cap is None:
+                return CleaningPlan(model, get_latest_by, nothing_to_do=True)
+            return CleaningPlan(model, get_latest_by, cap=cap)
+
+    if keep_records > 0 and partition_by:
+        return CleaningPlan(
+            model, get_latest_by, threshold=threshold, cap=cap,
+            partition_by=partition_by, keep_per_group=keep_records, using=using,
+        )
+
+    if keep_records > 0:
+        boundary = nth_most_recent(model, get_latest_by, keep_records, using=using)
+        if boundary is None:
+            # Less than keep_records records available
+            if cap is not None:
+                return CleaningPlan(model, get_latest_by, cap=cap)
+            return CleaningPlan(model, get_latest_by, nothing_to_do=True)
+        # When both constraints apply, keep only the most restrictive one if possible
+        if threshold is not None:
+            try:
+                if boundary[0] < threshold:
+                    threshold = None
+                else:
+                    boundary = None
+            except TypeError:
+                # i.e. DateField vs datetime: let the database compare them
+                pass
+
+    return CleaningPlan(model, get_latest_by, threshold=threshold, boundary=boundary, cap=cap)
+
+
+def estimate_count(queryset):
+    """
+    Estimate the number of records in queryset from the query planner statistics.
+
+    Supported on PostgreSQL and MySQL; falls back to an exact count() otherwise.
+    """
+    connection = connections[queryset.db]
+    try:
+        sql, params = queryset.order_by().query.get_compiler(using=queryset.db).as_sql()
+    except Exception:
+        # EmptyResultSet
+        return 0
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    if connection.vendor == 'mysql':
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [col[0].lower() for col in cursor.description]
+            row = cursor.fetchone()
+        return int(row[columns.index('rows')] or 0)
+
+    return queryset.count()
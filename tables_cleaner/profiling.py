@@ -0,0 +1,313 @@
+"""
+Query-level profiling of the cleaning runs ("clean_tables --profile").
+
+While a table is cleaned, every SQL statement executed on its databases is
+recorded (via connection.execute_wrapper()) with its duration and row count;
+the first time a statement is seen (i.e. the planning queries, and the
+statements of the first batch), its execution plan is captured as well:
+
+- PostgreSQL: EXPLAIN (ANALYZE, BUFFERS), in a savepoint which is rolled back
+  (so that an explained DELETE doesn't remove anything)
+- MySQL: EXPLAIN ANALYZE for SELECT statements, EXPLAIN FORMAT=TREE otherwise
+  (which doesn't execute them)
+- SQLite: EXPLAIN QUERY PLAN
+
+Explained statements are executed twice on PostgreSQL and MySQL; optionally,
+the Python side is profiled with cProfile. A report is written for each table,
+so that runs can be compared.
+
+The queries of the threads deleting a table in parallel (see delete_in_parallel())
+are recorded as well, with active_profiler().recording(); cProfile only profiles
+the calling thread.
+"""
+from contextlib import contextmanager
+from contextlib import ExitStack
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from django.db import connections
+from django.db import DatabaseError
+from django.db import transaction
+from django.utils import timezone
+from .metrics import write_atomically
+
+
+# Statements explained for each table, at most
+MAX_EXPLAINS = 10
+# Functions listed in the Python profile
+PYTHON_PROFILE_LIMIT = 40
+EXPLAINED_STATEMENTS = ('SELECT', 'DELETE', 'UPDATE')
+
+# The TableProfiler of each thread
+_active = threading.local()
+
+
+class _Rollback(Exception):
+    pass
+
+
+def normalize_sql(sql):
+    """
+    sql with the lists of placeholders collapsed (so that batches of different sizes
+    match), and without the savepoint ids
+    """
+    sql = re.sub(r'SAVEPOINT "s\d+_x\d+"', 'SAVEPOINT "..."', sql)
+    return re.sub(r'%s(, %s)+', '%s, ...', sql)
+
+
+def explain(connection, sql, params):
+    """
+    The execution plan of sql (a list of lines)
+    """
+    if connection.vendor == 'postgresql':
+        lines = []
+        try:
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+                    lines = [row[0] for row in cursor.fetchall()]
+                raise _Rollback()
+        except _Rollback:
+            pass
+        return lines
+    if connection.vendor == 'mysql':
+        if sql.lstrip().upper().startswith('SELECT'):
+            prefix = 'EXPLAIN ANALYZE '
+        else:
+            prefix = 'EXPLAIN FORMAT=TREE '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall()).splitlines()
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+    return ['EXPLAIN not supported on %s' % connection.vendor]
+
+
+class RecordedQuery(object):
+
+    def __init__(self, using, sql, params, many, duration, rowcount, error=None):
+        self.using = using
+        self.sql = sql
+        self.params = params
+        self.many = many
+        # seconds
+        self.duration = duration
+        # as reported by the cursor; None when unknown
+        self.rowcount = rowcount
+        self.error = error
+        # the execution plan (a list of lines), when captured
+        self.plan = None
+        # time.perf_counter() at the start
+        self.started = None
+
+
+class QueryRecorder(object):
+    """
+    A connection.execute_wrapper() recording the queries executed, and the plan
+    of the first ones (see explain())
+    """
+
+    def __init__(self, connection, explain=True, max_explains=MAX_EXPLAINS, explained=None):
+        self.connection = connection
+        self.explain = explain
+        self.max_explains = max_explains
+        self.queries = []
+        # the statements explained so far (normalized), possibly shared with other recorders
+        self.explained = set() if explained is None else explained
+        self.busy = False
+
+    def should_explain(self, sql, many):
+        if not self.explain or many or len(self.explained) >= self.max_explains:
+            return False
+        words = sql.split(None, 1)
+        if not words or words[0].upper() not in EXPLAINED_STATEMENTS:
+            return False
+        if words[0].upper() == 'SELECT' and ' FROM ' not in sql.upper():
+            # i.e. the timeouts' settings
+            return False
+        return normalize_sql(sql) not in self.explained
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.busy:
+            # the queries of explain()
+            return execute(sql, params, many, context)
+
+        plan = None
+        if self.should_explain(sql, many):
+            self.explained.add(normalize_sql(sql))
+            self.busy = True
+            try:
+                plan = explain(self.connection, sql, params)
+            except DatabaseError as e:
+                plan = ['EXPLAIN failed: %s' % str(e).strip()]
+            finally:
+                self.busy = False
+
+        query = RecordedQuery(self.connection.alias, sql, params, many, 0, None)
+        query.plan = plan
+        t0 = query.started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except Exception as e:
+            query.error = str(e).strip()
+            raise
+        finally:
+            query.duration = time.perf_counter() - t0
+            rowcount = getattr(context.get('cursor'), 'rowcount', -1)
+            query.rowcount = rowcount if isinstance(rowcount, int) and rowcount >= 0 else None
+            self.queries.append(query)
+
+
+def active_profiler():
+    """
+    The TableProfiler active in the current thread, if any
+    """
+    return getattr(_active, 'profiler', None)
+
+
+class TableProfiler(object):
+    """
+    A context manager recording the queries executed while cleaning a table (options
+    as returned by get_tables()) on its databases, and optionally profiling the
+    Python code with cProfile; then call write_report()
+    """
+
+    def __init__(self, options, explain=True, python=False):
+        self.model_name = options['model_name']
+        self.aliases = []
+        for alias in (options.get('using'), options.get('plan_using')):
+            if alias and alias not in self.aliases:
+                self.aliases.append(alias)
+        self.explain = explain
+        # the statements explained, by database
+        self.explained = {alias: set() for alias in self.aliases}
+        self.recorders = [
+            QueryRecorder(connections[alias], explain=explain, explained=self.explained[alias]) for alias in self.aliases
+        ]
+        self.lock = threading.Lock()
+        self.python = python
+        self.profile = None
+        self.python_error = None
+        self.started = None
+        self.previous = None
+        self.stack = ExitStack()
+
+    def __enter__(self):
+        self.started = timezone.now()
+        self.previous = active_profiler()
+        _active.profiler = self
+        for recorder in self.recorders:
+            self.stack.enter_context(recorder.connection.execute_wrapper(recorder))
+        if self.python:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError as e:
+                # i.e. another profiler is active (another worker)
+                self.profile = None
+                self.python_error = str(e)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+        self.stack.close()
+        _active.profiler = self.previous
+        return False
+
+    @contextmanager
+    def recording(self, connection):
+        """
+        Record the queries executed on connection by another thread (i.e. a worker
+        of delete_in_parallel()) into this report
+        """
+        with self.lock:
+            explained = self.explained.setdefault(connection.alias, set())
+            recorder = QueryRecorder(connection, explain=self.explain, explained=explained)
+            self.recorders.append(recorder)
+        with connection.execute_wrapper(recorder):
+            yield recorder
+
+    def report(self, result=None):
+        """
+        The text of the report
+        """
+        with self.lock:
+            queries = sum([recorder.queries for recorder in self.recorders], [])
+        queries.sort(key=lambda query: query.started)
+        lines = [
+            'Profile of "%s"' % self.model_name,
+            'Started: %s' % self.started.isoformat(),
+            'Databases: %s' % ', '.join(self.aliases),
+        ]
+        if result is not None:
+            lines.append('Records %s: %d; batches: %d; elapsed: %.3f s%s' % (
+                'to be removed' if result.dry_run else 'removed',
+                result.deleted, result.batches, result.elapsed,
+                '; FAILED: %s' % result.error if result.failed else '',
+            ))
+            if result.timings:
+                lines.append('Phases: %s' % ', '.join('%s %.3f s' % item for item in result.timings.items()))
+        lines.append('Queries: %d; total %.3f s' % (len(queries), sum(query.duration for query in queries)))
+
+        # Statements, slowest first
+        statements = {}
+        for query in queries:
+            key = (query.using, normalize_sql(query.sql))
+            count, total, slowest, rows = statements.get(key, (0, 0, 0, 0))
+            statements[key] = (count + 1, total + query.duration, max(slowest, query.duration), rows + (query.rowcount or 0))
+        lines += ['', 'Statements (slowest first):', '%8s %10s %10s %10s  %s' % ('COUNT', 'TOTAL s', 'MAX s', 'ROWS', 'STATEMENT')]
+        for (using, sql), (count, total, slowest, rows) in sorted(statements.items(), key=lambda item: item[1][1], reverse=True):
+            lines.append('%8d %10.4f %10.4f %10d  [%s] %s' % (count, total, slowest, rows, using, sql))
+
+        lines += ['', 'Execution plans:']
+        for query in queries:
+            if query.plan is None:
+                continue
+            lines += ['', '[%s] %s' % (query.using, query.sql), 'params: %s' % format_params(query.params)]
+            lines += ['    ' + line for line in query.plan]
+
+        lines += ['', 'Queries (in order):']
+        for index, query in enumerate(queries, 1):
+            lines.append('%d. [%s] %.4f s, rows: %s%s: %s; params: %s' % (
+                index, query.using, query.duration, '?' if query.rowcount is None else query.rowcount,
+                ' (FAILED: %s)' % query.error if query.error else '', query.sql, format_params(query.params),
+            ))
+
+        if self.python:
+            lines += ['', 'Python profile:']
+            if self.profile is not None:
+                stream = io.StringIO()
+                pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(PYTHON_PROFILE_LIMIT)
+                lines += stream.getvalue().strip('\n').splitlines()
+            else:
+                lines.append('not available (%s)' % self.python_error)
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, directory, result=None, logger=None):
+        """
+        Write the report into directory; returns its path
+        """
+        path = os.path.join(directory, '%s-%s.profile.txt' % (
+            self.model_name.lower(), self.started.strftime('%Y%m%d-%H%M%S'),
+        ))
+        write_atomically(path, self.report(result))
+        if logger is not None:
+            logger.info('"%s": profile written to "%s"' % (self.model_name, path))
+        return path
+
+
+def format_params(params, limit=10):
+    if params is None:
+        return '-'
+    params = list(params)
+    text = ', '.join(repr(param) for param in params[:limit])
+    if len(params) > limit:
+        text += ', ... (%d params)' % len(params)
+    return '[%s]' % text
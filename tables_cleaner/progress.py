@@ -0,0 +1,125 @@
+"""
+Progress events, emitted while cleaning.
+
+A ProgressEvent is passed to the progress callback of clean_table() after
+each batch, and of clean_tables() also when a table is done; the management
+command shows them as a live progress line (see ProgressLine).
+"""
+import threading
+import time
+
+
+class ProgressEvent(object):
+
+    # a batch has been committed
+    BATCH = 'batch'
+    # a table is done (result holds its CleanResult)
+    TABLE = 'table'
+
+    def __init__(self, kind, model_name, deleted=0, batches=0, elapsed=0, total=None, result=None):
+        self.kind = kind
+        self.model_name = model_name
+        # records removed so far from the table
+        self.deleted = deleted
+        self.batches = batches
+        # seconds spent deleting so far
+        self.elapsed = elapsed
+        # records to be removed from the table (estimated), when known
+        self.total = total
+        self.result = result
+
+    def __repr__(self):
+        return '<ProgressEvent %s %s: %d>' % (self.kind, self.model_name, self.deleted)
+
+    def __str__(self):
+        text = '"%s": %d' % (self.model_name, self.deleted)
+        if self.total is not None:
+            text += '/%d (%.0f%%)' % (self.total, self.percent)
+        text += ' records removed, %.1f records/s' % self.rate
+        if self.eta is not None:
+            text += ', ETA %s' % format_seconds(self.eta)
+        return text
+
+    @classmethod
+    def from_result(cls, result):
+        return cls(
+            cls.TABLE, result.model_name, deleted=result.deleted, batches=result.batches,
+            elapsed=result.elapsed, total=result.deleted, result=result,
+        )
+
+    @property
+    def rate(self):
+        """
+        Records removed per second
+        """
+        return self.deleted / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def remaining(self):
+        if self.total is None:
+            return None
+        return max(self.total - self.deleted, 0)
+
+    @property
+    def percent(self):
+        if not self.total:
+            return 100.0
+        return min(100.0 * self.deleted / self.total, 100.0)
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds to completion, or None
+        """
+        if self.remaining is None or self.rate <= 0:
+            return None
+        return self.remaining / self.rate
+
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressLine(object):
+    """
+    A progress callback rewriting a single line of stream (a terminal) after each batch,
+    at most every interval seconds; the line is cleared when a table is done.
+
+    It's also a logging filter (see logger.addFilter()): the line is cleared before
+    each log record is emitted, so that records don't get appended to it
+    """
+
+    def __init__(self, stream, interval=0.5):
+        self.stream = stream
+        self.interval = interval
+        self.width = 0
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            if event.kind == ProgressEvent.TABLE:
+                self.clear()
+                return
+            now = time.monotonic()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            self.write(str(event))
+
+    def filter(self, record):
+        with self.lock:
+            self.clear()
+        return True
+
+    def write(self, text):
+        self.stream.write('\r' + text.ljust(self.width), ending='')
+        self.stream.flush()
+        self.width = len(text)
+
+    def clear(self):
+        if self.width > 0:
+            self.stream.write('\r' + ' ' * self.width + '\r', ending='')
+            self.stream.flush()
+            self.width = 0
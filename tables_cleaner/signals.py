@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+
+# Sent after each table has been cleaned; providing_args: ["result"] (a CleanResult)
+table_cleaned = Signal()
@@ -0,0 +1,112 @@
+"""
+Table sizes, for the size-based retention policies (max_table_bytes, max_table_percent).
+
+Sizes are estimated from the database catalog, without reading the records:
+
+- PostgreSQL: pg_stats (average row width), pg_class, pg_total_relation_size(), pg_tablespace_size()
+- MySQL: information_schema.TABLES
+- SQLite: the dbstat virtual table
+
+A size limit is turned into the max n. of records fitting in it (average record
+size, indexes included); space not yet released after deletion (before VACUUM FULL
+or OPTIMIZE TABLE) isn't counted, so repeated runs don't remove more and more records.
+"""
+from django.db import connections
+
+
+# PostgreSQL heap tuple header and line pointer
+PG_TUPLE_OVERHEAD = 28
+
+
+def row_size(connection, model):
+    """
+    The average size (bytes) of a record of model, indexes included; 0 when unknown
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+
+        if connection.vendor == 'postgresql':
+            cursor.execute("""
+                SELECT (SELECT SUM(s.avg_width) FROM pg_stats s WHERE s.schemaname = n.nspname AND s.tablename = c.relname),
+                       pg_relation_size(c.oid), pg_total_relation_size(c.oid), c.reltuples
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE c.oid = %s::regclass
+            """, [connection.ops.quote_name(table)])
+            width, heap, total, rows = cursor.fetchone()
+            if width is None:
+                # Not analyzed yet
+                return total / rows if rows and rows > 0 else 0
+            return (float(width) + PG_TUPLE_OVERHEAD) * (total / heap if heap else 1)
+
+        if connection.vendor == 'mysql':
+            cursor.execute("""
+                SELECT avg_row_length, data_length, index_length FROM information_schema.TABLES
+                WHERE table_schema = DATABASE() AND table_name = %s
+            """, [table])
+            row = cursor.fetchone()
+            if row is None:
+                return 0
+            avg_row_length, data_length, index_length = row
+            return float(avg_row_length or 0) * (1 + (index_length or 0) / data_length if data_length else 1)
+
+        if connection.vendor == 'sqlite':
+            cursor.execute("""
+                SELECT SUM(payload) FROM dbstat
+                WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = %s)
+            """, [table])
+            size = cursor.fetchone()[0] or 0
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(table))
+            rows = cursor.fetchone()[0]
+            return size / rows if rows > 0 else 0
+
+    raise Exception('size-based retention not supported on %s' % connection.vendor)
+
+
+def tablespace_size(connection, model):
+    """
+    The size (bytes) of the tablespace (PostgreSQL), schema (MySQL) or database file (SQLite) of model
+    """
+    with connection.cursor() as cursor:
+
+        if connection.vendor == 'postgresql':
+            cursor.execute("""
+                SELECT pg_tablespace_size(CASE WHEN c.reltablespace = 0 THEN d.dattablespace ELSE c.reltablespace END)
+                FROM pg_class c, pg_database d
+                WHERE c.oid = %s::regclass AND d.datname = current_database()
+            """, [connection.ops.quote_name(model._meta.db_table)])
+            return cursor.fetchone()[0]
+
+        if connection.vendor == 'mysql':
+            cursor.execute("""
+                SELECT SUM(data_length + index_length) FROM information_schema.TABLES
+                WHERE table_schema = DATABASE()
+            """)
+            return cursor.fetchone()[0] or 0
+
+        if connection.vendor == 'sqlite':
+            cursor.execute('PRAGMA page_count')
+            page_count = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_size')
+            return page_count * cursor.fetchone()[0]
+
+    raise Exception('size-based retention not supported on %s' % connection.vendor)
+
+
+def size_limit(model, using, max_table_bytes=0, max_table_percent=0):
+    """
+    The max n. of records of model fitting in max_table_bytes and in max_table_percent
+    of the tablespace (0=unused); None when the record size is unknown
+    """
+    connection = connections[using]
+    limits = []
+    if max_table_bytes > 0:
+        limits.append(max_table_bytes)
+    if max_table_percent > 0:
+        limits.append(tablespace_size(connection, model) * max_table_percent / 100)
+    if not limits:
+        return None
+    size = row_size(connection, model)
+    if size <= 0:
+        return None
+    # Always preserve the most recent record
+    return max(int(min(limits) // size), 1)
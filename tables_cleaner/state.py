@@ -0,0 +1,85 @@
+"""
+Persistent per-table state (watermarks).
+
+At the end of each run of clean_tables() (dry runs excluded), the outcome of each
+table is saved in a TableState record: the last cutoff, records removed, duration and
+timestamp, plus the totals; the history is shown by "clean_tables --status".
+
+Set TABLES_CLEANER_STATE = False to disable it (i.e. when the migrations of
+tables_cleaner can't be applied); saving errors, of any kind, are logged, never raised.
+"""
+from django.db import router
+from django.db import transaction
+from django.db.models import F
+from . import app_settings
+from .progress import format_seconds
+
+
+def format_cutoff(cutoff):
+    if cutoff is None:
+        return ''
+    return cutoff.isoformat() if hasattr(cutoff, 'isoformat') else str(cutoff)
+
+
+def save_state(result, logger=None):
+    """
+    Save the outcome of a table (a CleanResult) into its TableState
+    """
+    from .models import TableState
+
+    if not app_settings.STATE or result.dry_run:
+        return
+    using = router.db_for_write(TableState)
+    try:
+        with transaction.atomic(using=using):
+            state, __ = TableState.objects.using(using).get_or_create(model_name=result.model_name, using=result.using or '')
+            TableState.objects.using(using).filter(pk=state.pk).update(
+                last_run=result.started,
+                cutoff=format_cutoff(result.cutoff),
+                deleted=result.deleted,
+                duration=result.elapsed,
+                skipped=result.skipped,
+                error=result.error or '',
+                runs=F('runs') + 1,
+                total_deleted=F('total_deleted') + result.deleted,
+            )
+    except Exception as e:
+        # The table has been cleaned anyway
+        if logger is not None:
+            logger.warning('"%s": state not saved (%s)' % (result.model_name, str(e)))
+
+
+def get_states():
+    from .models import TableState
+
+    return list(TableState.objects.using(router.db_for_read(TableState)).all())
+
+
+def format_status(states):
+    """
+    A text table describing states (a list of TableState)
+    """
+    rows = [('TABLE', 'DATABASE', 'LAST RUN', 'CUTOFF', 'REMOVED', 'DURATION', 'RUNS', 'TOTAL REMOVED', 'STATUS')]
+    for state in states:
+        if state.error:
+            status = 'FAILED: %s' % state.error
+        elif state.skipped:
+            status = 'nothing to do'
+        else:
+            status = 'ok'
+        rows.append((
+            state.model_name,
+            state.using,
+            state.last_run.strftime('%Y-%m-%d %H:%M:%S') if state.last_run else '',
+            state.cutoff,
+            str(state.deleted),
+            format_seconds(state.duration),
+            str(state.runs),
+            str(state.total_deleted),
+            status,
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    return '\n'.join(
+        '  '.join(value.ljust(width) for value, width in zip(row, widths)) + '  ' + row[-1]
+        for row in rows
+    )
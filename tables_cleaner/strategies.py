@@ -0,0 +1,101 @@
+"""
+Delete strategies used by clean_table().
+
+Each strategy receives the queryset of records to be removed and returns
+the number of records deleted from the queryset's model; when a counters
+dict is supplied, the records deleted from each model (related ones included)
+are accumulated into it, by model label.
+"""
+from django.db import transaction
+from .cascade import delete_cascade
+from .cascade import UnsupportedRelation
+
+
+# Max number of primary keys bound in a single "DELETE ... WHERE pk IN (...)";
+# stays well below the host parameters limit of older SQLite builds (999)
+PK_CHUNK_SIZE = 500
+
+
+def accumulate(counters, deleted):
+    if counters is not None:
+        for label, n in deleted.items():
+            counters[label] = counters.get(label, 0) + n
+
+
+def delete_bulk(queryset, counters=None):
+    """
+    Set-based deletion.
+
+    Unsliced querysets are deleted with a single "DELETE ... WHERE <filters>";
+    sliced querysets (which Django refuses to delete) are first resolved into
+    primary keys, then deleted with "DELETE ... WHERE pk IN (...)" in chunks.
+
+    Django's Collector is still used, so on_delete rules are honored; models
+    without signals or cascades are deleted without fetching any instance.
+    """
+    model = queryset.model
+    label = model._meta.label
+
+    if not queryset.query.is_sliced:
+        __, deleted = queryset.order_by().delete()
+        accumulate(counters, deleted)
+        return deleted.get(label, 0)
+
+    pks = list(queryset.values_list('pk', flat=True))
+    n = 0
+    for i in range(0, len(pks), PK_CHUNK_SIZE):
+        __, deleted = model._base_manager.filter(pk__in=pks[i:i + PK_CHUNK_SIZE]).delete()
+        accumulate(counters, deleted)
+        n += deleted.get(label, 0)
+    return n
+
+
+def delete_instances(queryset, counters=None):
+    """
+    Per-instance deletion: call delete() on every record.
+
+    Much slower than delete_bulk(), but honors overridden Model.delete()
+    methods in addition to pre_delete/post_delete signals.
+    """
+    n = 0
+    for row in queryset.iterator():
+        result = row.delete()
+        if isinstance(result, tuple):
+            # Overridden delete() methods might not return the counters
+            accumulate(counters, result[1])
+        n += 1
+    return n
+
+
+def delete_cascading(queryset, counters=None):
+    """
+    Set-based deletion of the records and their related records, walking the
+    relations once instead of letting the Collector fetch related objects.
+
+    Falls back to delete_bulk() when the relations can't be handled with
+    set-based statements (see tables_cleaner.cascade).
+    """
+    try:
+        with transaction.atomic(using=queryset.db):
+            return delete_cascade(queryset, counters)
+    except UnsupportedRelation:
+        return delete_bulk(queryset, counters)
+
+
+DELETE_STRATEGIES = {
+    'bulk': delete_bulk,
+    'cascade': delete_cascading,
+    'instance': delete_instances,
+    # The table is swapped by clean_table() when most records have to be removed
+    # (see tables_cleaner.swap); otherwise, records are deleted by delete_bulk()
+    'swap': delete_bulk,
+}
+
+
+def get_delete_strategy(name):
+    try:
+        return DELETE_STRATEGIES[name]
+    except KeyError:
+        raise Exception('Unknown delete_strategy "%s"; choices are: %s' % (
+            name, ', '.join(sorted(DELETE_STRATEGIES.keys())),
+        ))
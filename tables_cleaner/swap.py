@@ -0,0 +1,148 @@
+"""
+The "swap" strategy, for tables where most records have to be removed.
+
+Rather than deleting the obsolete records, the records to be preserved (the
+survivors) are copied aside, and the table is emptied as a whole:
+
+- PostgreSQL: under an ACCESS EXCLUSIVE lock, survivors are copied to a temporary
+  table, the table is truncated and the survivors copied back, in a single
+  transaction; indexes, constraints, sequences, grants and triggers are preserved
+- MySQL: survivors are copied into a new table (CREATE TABLE ... LIKE, i.e. the
+  same structure and indexes) while the table is write-locked, then the two tables
+  are swapped atomically with RENAME TABLE, and the old one is dropped
+- SQLite: as PostgreSQL, with "DELETE FROM" (SQLite's truncate optimization)
+
+When nothing has to be preserved, the table is just truncated.
+
+Tables referenced by foreign keys are refused; on MySQL, also tables with
+foreign keys (CREATE TABLE ... LIKE doesn't copy them). Records are removed without
+sending pre_delete/post_delete signals, and (PostgreSQL, SQLite) survivors are
+inserted again, firing the INSERT triggers of the table, if any.
+"""
+from contextlib import nullcontext
+from django.db import connections
+from django.db import transaction
+
+
+SWAP_SUFFIX = '__swap'
+OLD_SUFFIX = '__old'
+TEMP_TABLE = 'tables_cleaner_survivors'
+
+
+class SwapRefused(Exception):
+    pass
+
+
+def check_swap(model, connection):
+    """
+    Raise SwapRefused when the table of model can't be swapped
+    """
+    if connection.vendor not in ('postgresql', 'mysql', 'sqlite'):
+        raise SwapRefused('not supported on %s' % connection.vendor)
+    referenced = sorted(set(
+        field.related_model._meta.label
+        for field in model._meta.get_fields(include_hidden=True)
+        if field.auto_created and not field.concrete and (field.one_to_many or field.one_to_one)
+    ))
+    if referenced:
+        raise SwapRefused('table referenced by foreign keys (%s)' % ', '.join(referenced))
+    if connection.vendor == 'mysql':
+        if any(field.remote_field is not None and getattr(field, 'db_constraint', False) for field in model._meta.concrete_fields):
+            raise SwapRefused('tables with foreign keys are not supported on MySQL')
+        if connection.in_atomic_block:
+            # DDL statements commit implicitly
+            raise SwapRefused("can't run inside a transaction on MySQL")
+
+
+def swap_table(survivors, logger=None):
+    """
+    Keep only the records of survivors (a queryset) in their table; returns the
+    number of records removed, or raises SwapRefused
+    """
+    model = survivors.model
+    using = survivors.db
+    connection = connections[using]
+    check_swap(model, connection)
+
+    quote = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = ', '.join(quote(field.column) for field in model._meta.concrete_fields)
+    # Compiled for the database of survivors (sql_with_params() would use the default one)
+    sql, params = survivors.order_by().values_list(
+        *[field.attname for field in model._meta.concrete_fields]
+    ).query.get_compiler(using=using).as_sql()
+
+    if connection.vendor == 'mysql':
+        return swap_mysql(connection, table, columns, sql, params, logger=logger)
+
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % quote(table))
+            cursor.execute('SELECT COUNT(*) FROM %s' % quote(table))
+            total = cursor.fetchone()[0]
+            cursor.execute('CREATE TEMPORARY TABLE %s AS %s' % (quote(TEMP_TABLE), sql), params)
+            cursor.execute('SELECT COUNT(*) FROM %s' % quote(TEMP_TABLE))
+            kept = cursor.fetchone()[0]
+            if logger is not None:
+                logger.info('"%s": %d of %d records copied aside; truncating' % (model._meta.label_lower, kept, total))
+            if connection.vendor == 'postgresql':
+                cursor.execute('TRUNCATE TABLE %s' % quote(table))
+            else:
+                cursor.execute('DELETE FROM %s' % quote(table))
+            if kept:
+                cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (quote(table), columns, columns, quote(TEMP_TABLE)))
+            cursor.execute('DROP TABLE %s' % quote(TEMP_TABLE))
+    return total - kept
+
+
+def swap_mysql(connection, table, columns, sql, params, logger=None):
+    quote = connection.ops.quote_name
+    # MySQL identifiers are limited to 64 characters
+    new = table[:64 - len(SWAP_SUFFIX)] + SWAP_SUFFIX
+    old = table[:64 - len(OLD_SUFFIX)] + OLD_SUFFIX
+    with connection.cursor() as cursor:
+        # Leftovers of an interrupted run
+        cursor.execute('DROP TABLE IF EXISTS %s, %s' % (quote(new), quote(old)))
+        cursor.execute('CREATE TABLE %s LIKE %s' % (quote(new), quote(table)))
+        cursor.execute('LOCK TABLES %s WRITE, %s WRITE' % (quote(table), quote(new)))
+        try:
+            cursor.execute('SELECT COUNT(*) FROM %s' % quote(table))
+            total = cursor.fetchone()[0]
+            cursor.execute('INSERT INTO %s (%s) %s' % (quote(new), columns, sql), params)
+            kept = cursor.rowcount
+            cursor.execute("""
+                SELECT AUTO_INCREMENT FROM information_schema.TABLES
+                WHERE table_schema = DATABASE() AND table_name = %s
+            """, [table])
+            row = cursor.fetchone()
+            if row is not None and row[0]:
+                cursor.execute('ALTER TABLE %s AUTO_INCREMENT = %d' % (quote(new), row[0]))
+            if logger is not None:
+                logger.info('"%s": %d of %d records copied; swapping tables' % (table, kept, total))
+            cursor.execute('RENAME TABLE %s TO %s, %s TO %s' % (quote(table), quote(old), quote(new), quote(table)))
+        finally:
+            cursor.execute('UNLOCK TABLES')
+        cursor.execute('DROP TABLE %s' % quote(old))
+    return total - kept
+
+
+def truncate_table(model, using, logger=None):
+    """
+    Remove all records of model; returns the number of records removed, or raises SwapRefused
+    """
+    connection = connections[using]
+    check_swap(model, connection)
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    # TRUNCATE commits implicitly on MySQL
+    with transaction.atomic(using=using) if connection.vendor != 'mysql' else nullcontext():
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % table)
+            cursor.execute('SELECT COUNT(*) FROM %s' % table)
+            total = cursor.fetchone()[0]
+            if logger is not None:
+                logger.info('"%s": truncating %d records' % (model._meta.label_lower, total))
+            cursor.execute('%s %s' % ('DELETE FROM' if connection.vendor == 'sqlite' else 'TRUNCATE TABLE', table))
+    return total
@@ -0,0 +1,216 @@
+"""
+Compiled TABLES_CLEANER_TABLES.
+
+Each table entry is validated and compiled once into an immutable TableSpec,
+holding the model class, the resolved get_latest_by field, the delete strategy,
+the database alias and the validated options; compiled specs are cached and reused
+by every run (clean_tables(), the daemon, django-cron jobs ...), and invalidated when
+settings change (setting_changed). The spec itself is passed to clean_table(), which
+doesn't resolve them again.
+
+Configuration errors are reported all at once, with ImproperlyConfigured,
+and by the "tables_cleaner" system check at startup.
+"""
+import threading
+from types import MappingProxyType
+from django.apps import apps
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from . import app_settings
+from .archive import ARCHIVE_COMPRESSIONS
+from .archive import ARCHIVE_FORMATS
+from .planner import resolve_get_latest_by
+from .strategies import DELETE_STRATEGIES
+from .strategies import get_delete_strategy
+from .workers import database_for
+
+
+REQUIRED_OPTIONS = ('keep_records', 'keep_since_days', 'keep_since_hours')
+
+# Table options accepted by clean_table(), other than the required ones
+OPTIONS = (
+    'get_latest_by', 'using', 'plan_using', 'delete_strategy', 'count_mode',
+    'batch_size', 'batch_sleep', 'max_rows_per_second', 'max_duration',
+    'partitioned', 'partition_action',
+    'archive_dir', 'archive_format', 'archive_compression',
+    'max_records', 'max_table_bytes', 'max_table_percent',
+    'partition_by',
+    'lock_timeout', 'statement_timeout', 'max_retries', 'retry_backoff',
+    'swap_threshold', 'parallelism',
+)
+
+CHOICES = {
+    'delete_strategy': tuple(DELETE_STRATEGIES),
+    'count_mode': ('exact', 'estimate'),
+    'partition_action': ('drop', 'truncate'),
+    'archive_format': ARCHIVE_FORMATS,
+    'archive_compression': tuple(ARCHIVE_COMPRESSIONS),
+}
+
+NUMERIC_OPTIONS = REQUIRED_OPTIONS + (
+    'batch_size', 'batch_sleep', 'max_rows_per_second', 'max_duration',
+    'max_records', 'max_table_bytes', 'max_table_percent',
+    'lock_timeout', 'statement_timeout', 'max_retries', 'retry_backoff',
+    'swap_threshold', 'parallelism',
+)
+
+SETTINGS = ('TABLES_CLEANER_TABLES', 'DATABASES', 'DATABASE_ROUTERS')
+
+
+class TableSpec(object):
+    """
+    A validated table entry of TABLES_CLEANER_TABLES; immutable
+    """
+
+    __slots__ = ('model_name', 'model', 'field', 'using', 'options', 'delete_records')
+
+    def __init__(self, model, field, using, options):
+        set_attr = super().__setattr__
+        set_attr('model_name', model._meta.label_lower)
+        set_attr('model', model)
+        set_attr('field', field)
+        set_attr('using', using)
+        set_attr('options', MappingProxyType(dict(options)))
+        # the function of the delete strategy
+        set_attr('delete_records', get_delete_strategy(options.get('delete_strategy', 'bulk')))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TableSpec is immutable')
+
+    def __repr__(self):
+        return '<TableSpec %s.%s@%s>' % (self.model_name, self.field.name, self.using)
+
+    @property
+    def get_latest_by(self):
+        return self.field.name
+
+    def kwargs(self, defaults=None):
+        """
+        The arguments for clean_table(), with defaults for the options not specified
+        """
+        kwargs = dict(defaults or {})
+        kwargs.update(self.options)
+        kwargs.update(model_name=self.model_name, get_latest_by=self.field.name, using=self.using, spec=self)
+        return kwargs
+
+
+def compile_table(table, using=None):
+    """
+    Validate a table entry of TABLES_CLEANER_TABLES; returns a TableSpec,
+    or raises ImproperlyConfigured
+    """
+    options = dict(table)
+    # Support 'model' instead of 'model_name' for backward compatibility; to be deprecated
+    model_name = options.pop('model_name', None) or options.pop('model', None)
+    options.pop('model', None)
+    if not model_name:
+        raise ImproperlyConfigured('missing "model_name"')
+    try:
+        model = apps.get_model(model_name)
+    except (LookupError, ValueError):
+        raise ImproperlyConfigured('"%s": unknown model' % model_name)
+
+    unknown = sorted(set(options) - set(REQUIRED_OPTIONS) - set(OPTIONS))
+    if unknown:
+        raise ImproperlyConfigured('"%s": unknown options: %s' % (model_name, ', '.join(unknown)))
+    for name in REQUIRED_OPTIONS:
+        if name not in options:
+            raise ImproperlyConfigured('"%s": missing "%s"' % (model_name, name))
+    for name in NUMERIC_OPTIONS:
+        value = options.get(name, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ImproperlyConfigured('"%s": "%s" must be a number >= 0' % (model_name, name))
+    if options.get('max_table_percent', 0) > 100:
+        raise ImproperlyConfigured('"%s": "max_table_percent" must be <= 100' % model_name)
+    if options.get('swap_threshold', 0) > 1:
+        raise ImproperlyConfigured('"%s": "swap_threshold" must be <= 1' % model_name)
+    if int(options.get('parallelism', 0)) != options.get('parallelism', 0):
+        raise ImproperlyConfigured('"%s": "parallelism" must be an integer' % model_name)
+    if options.get('parallelism', 0) > 1 and options.get('archive_dir'):
+        raise ImproperlyConfigured('"%s": "parallelism" can\'t be used with "archive_dir"' % model_name)
+    for name, choices in CHOICES.items():
+        if name in options and options[name] not in choices:
+            raise ImproperlyConfigured('"%s": unknown %s "%s"; choices are: %s' % (
+                model_name, name, options[name], ', '.join(str(choice) for choice in choices),
+            ))
+
+    try:
+        field = model._meta.get_field(resolve_get_latest_by(model, options.pop('get_latest_by', None)))
+    except FieldDoesNotExist as e:
+        raise ImproperlyConfigured('"%s": %s' % (model_name, str(e)))
+    except Exception as e:
+        raise ImproperlyConfigured(str(e))
+
+    partition_by = options.get('partition_by') or ()
+    for name in ([partition_by] if isinstance(partition_by, str) else partition_by):
+        try:
+            model._meta.get_field(name)
+        except FieldDoesNotExist as e:
+            raise ImproperlyConfigured('"%s": partition_by: %s' % (model_name, str(e)))
+
+    alias = database_for(model_name, options.pop('using', None) or using)
+    if alias not in connections:
+        raise ImproperlyConfigured('"%s": unknown database "%s"' % (model_name, alias))
+    if options.get('plan_using') and options['plan_using'] not in connections:
+        raise ImproperlyConfigured('"%s": unknown plan_using database "%s"' % (model_name, options['plan_using']))
+
+    return TableSpec(model, field, alias, options)
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_table_specs(using=None):
+    """
+    The compiled TABLES_CLEANER_TABLES (cached); with using, only the tables
+    to be cleaned on that database (see clean_tables())
+    """
+    key = using or None
+    with _lock:
+        if key not in _cache:
+            specs = []
+            errors = []
+            for table in app_settings.TABLES:
+                if using and table.get('using', using) != using:
+                    continue
+                try:
+                    specs.append(compile_table(table, using=using))
+                except ImproperlyConfigured as e:
+                    errors.append(str(e))
+            if errors:
+                raise ImproperlyConfigured('Invalid TABLES_CLEANER_TABLES: %s' % '; '.join(errors))
+            _cache[key] = tuple(specs)
+        return _cache[key]
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+@receiver(setting_changed)
+def settings_changed(setting, **kwargs):
+    if setting in SETTINGS or setting.startswith('TABLES_CLEANER_'):
+        app_settings.reload()
+        clear_cache()
+
+
+@checks.register()
+def check_settings(app_configs=None, **kwargs):
+    """
+    Report invalid TABLES_CLEANER_TABLES at startup
+    """
+    errors = []
+    for table in app_settings.TABLES:
+        try:
+            compile_table(table)
+        except ImproperlyConfigured as e:
+            errors.append(checks.Error(
+                str(e), hint='Fix the entry in settings.TABLES_CLEANER_TABLES', id='tables_cleaner.E001',
+            ))
+    return errors
@@ -0,0 +1,139 @@
+"""
+Lock and statement timeouts for the cleaning queries.
+
+Each batch (or the whole deletion, when batches aren't used) runs in its own
+transaction (or savepoint) with:
+
+- PostgreSQL: lock_timeout and statement_timeout (set_config(..., is_local=true))
+- MySQL: innodb_lock_wait_timeout (whole seconds) and max_execution_time
+  (which MySQL applies to SELECT statements only)
+- SQLite: busy_timeout, for lock_timeout
+
+Previous values are restored afterwards. When a timeout occurs, the transaction is
+rolled back, and the batch retried after an exponential backoff (see retry_on_timeout()).
+"""
+from contextlib import contextmanager
+import math
+import time
+from django.db import connections
+from django.db import DatabaseError
+from django.db import transaction
+
+
+# PostgreSQL SQLSTATE: lock_not_available, query_canceled
+PG_TIMEOUT_CODES = ('55P03', '57014')
+# MySQL: lock wait timeout, deadlock, max_execution_time exceeded
+MYSQL_TIMEOUT_CODES = (1205, 1213, 3024)
+
+
+class TimeoutsExceeded(Exception):
+    pass
+
+
+def is_timeout(error, connection):
+    """
+    True when error is a lock or statement timeout
+    """
+    cause = error.__cause__ or error
+    if connection.vendor == 'postgresql':
+        code = getattr(cause, 'pgcode', None) or getattr(cause, 'sqlstate', None)
+        return code in PG_TIMEOUT_CODES
+    if connection.vendor == 'mysql':
+        args = getattr(cause, 'args', ())
+        return bool(args) and args[0] in MYSQL_TIMEOUT_CODES
+    if connection.vendor == 'sqlite':
+        return 'database is locked' in str(cause)
+    return False
+
+
+@contextmanager
+def timeouts(connection, lock_timeout=0, statement_timeout=0):
+    """
+    Set the timeouts (seconds; 0=unchanged) for the statements executed in the block;
+    to be used inside a transaction
+    """
+    if lock_timeout <= 0 and statement_timeout <= 0:
+        yield
+        return
+
+    settings = {}
+    if connection.vendor == 'postgresql':
+        if lock_timeout > 0:
+            settings['lock_timeout'] = '%dms' % math.ceil(lock_timeout * 1000)
+        if statement_timeout > 0:
+            settings['statement_timeout'] = '%dms' % math.ceil(statement_timeout * 1000)
+        previous = {}
+        with connection.cursor() as cursor:
+            for name, value in settings.items():
+                cursor.execute("SELECT current_setting(%s), set_config(%s, %s, true)", [name, name, value])
+                previous[name] = cursor.fetchone()[0]
+        # Local settings are reverted by a rollback; otherwise they would last until
+        # the end of the transaction (i.e. the outer one, when in a savepoint)
+        yield
+        with connection.cursor() as cursor:
+            for name, value in previous.items():
+                cursor.execute("SELECT set_config(%s, %s, true)", [name, value])
+        return
+
+    if connection.vendor == 'mysql':
+        if lock_timeout > 0:
+            settings['innodb_lock_wait_timeout'] = max(int(math.ceil(lock_timeout)), 1)
+        if statement_timeout > 0:
+            settings['max_execution_time'] = int(math.ceil(statement_timeout * 1000))
+    elif connection.vendor == 'sqlite':
+        if lock_timeout > 0:
+            settings['busy_timeout'] = int(math.ceil(lock_timeout * 1000))
+    if not settings:
+        yield
+        return
+
+    previous = {}
+    with connection.cursor() as cursor:
+        for name, value in settings.items():
+            if connection.vendor == 'mysql':
+                cursor.execute('SELECT @@SESSION.%s' % name)
+                previous[name] = cursor.fetchone()[0]
+                cursor.execute('SET SESSION %s = %d' % (name, value))
+            else:
+                cursor.execute('PRAGMA %s' % name)
+                previous[name] = cursor.fetchone()[0]
+                cursor.execute('PRAGMA %s = %d' % (name, value))
+    try:
+        yield
+    finally:
+        # Session settings are not transactional: always restore them
+        with connection.cursor() as cursor:
+            for name, value in previous.items():
+                if connection.vendor == 'mysql':
+                    cursor.execute('SET SESSION %s = %d' % (name, value))
+                else:
+                    cursor.execute('PRAGMA %s = %d' % (name, value))
+
+
+def retry_on_timeout(func, using, lock_timeout=0, statement_timeout=0, max_retries=3, retry_backoff=1.0,
+                     on_retry=None, logger=None, label=''):
+    """
+    Call func() in a transaction (or savepoint) with the timeouts set; on timeout,
+    call on_retry() (i.e. to reduce the batch), sleep retry_backoff seconds (doubled
+    after each failure) and try again, up to max_retries times, then raise TimeoutsExceeded.
+    Returns the value of func().
+    """
+    connection = connections[using]
+    failures = 0
+    while True:
+        try:
+            with transaction.atomic(using=using):
+                with timeouts(connection, lock_timeout=lock_timeout, statement_timeout=statement_timeout):
+                    return func()
+        except DatabaseError as e:
+            if not is_timeout(e, connection):
+                raise
+            failures += 1
+            if failures > max_retries:
+                raise TimeoutsExceeded('%d timeouts (%s)' % (failures, str(e).strip()))
+            pause = retry_backoff * 2 ** (failures - 1)
+            if logger is not None:
+                logger.warning('%s%s; retrying in %.1f s' % (label, str(e).strip(), pause))
+            if on_retry is not None:
+                on_retry()
+            time.sleep(pause)
@@ -0,0 +1,102 @@
+"""
+Run table cleaning concurrently with a pool of threads.
+
+Every worker thread uses its own database connections (Django connections
+are thread-local), and the number of concurrent workers on the same database
+can be capped. Log messages are buffered per table and replayed in the
+original order, so the output doesn't depend on scheduling.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from django.apps import apps
+from django.db import connections
+from django.db import router
+from django.db import DEFAULT_DB_ALIAS
+
+
+class BufferedLogger(object):
+    """
+    Collects log messages to be replayed later on the wrapped logger
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.records = []
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args):
+        self.records.append(('debug', msg, args))
+
+    def info(self, msg, *args):
+        self.records.append(('info', msg, args))
+
+    def warning(self, msg, *args):
+        self.records.append(('warning', msg, args))
+
+    def error(self, msg, *args):
+        self.records.append(('error', msg, args))
+
+    def replay(self):
+        for method, msg, args in self.records:
+            getattr(self.logger, method)(msg, *args)
+        self.records = []
+
+
+def database_for(model_name, using=None):
+    """
+    The database alias for model_name: using, if supplied, or as suggested by the routers
+    """
+    if using:
+        return using
+    try:
+        return router.db_for_write(apps.get_model(model_name))
+    except Exception:
+        # An invalid model will be reported by the worker itself
+        return DEFAULT_DB_ALIAS
+
+
+def max_concurrency(using, max_workers_per_database):
+    """
+    SQLite allows a single writer at a time
+    """
+    if connections[using].vendor == 'sqlite':
+        return 1
+    return max_workers_per_database
+
+
+def run_in_pool(tasks, func, logger, max_workers, max_workers_per_database=0, database=None):
+    """
+    Call func(task, logger) for each task in a pool of max_workers threads;
+    returns the results in the same order as tasks.
+
+    database(task) returns the database alias used by task (default: task['using']).
+    """
+    if database is None:
+        database = lambda task: task['using']
+    databases = [database(task) for task in tasks]
+    semaphores = {}
+    for using in set(databases):
+        cap = max_concurrency(using, max_workers_per_database)
+        semaphores[using] = threading.BoundedSemaphore(cap if cap > 0 else max_workers)
+
+    def run(task, using):
+        buffered = BufferedLogger(logger) if logger is not None else None
+        with semaphores[using]:
+            try:
+                return func(task, buffered), buffered
+            finally:
+                # Close the connections opened by this thread
+                connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run, task, using) for task, using in zip(tasks, databases)]
+        results = []
+        for future in futures:
+            result, buffered = future.result()
+            if buffered is not None:
+                buffered.replay()
+            results.append(result)
+
+    return results
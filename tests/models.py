@@ -8,3 +8,38 @@ class Sample(models.Model):
     class Meta:
         ordering = ('-created', )  # better choice for UI
         get_latest_by = "-created"
+
+
+class Event(models.Model):
+
+    timestamp = models.DateTimeField('timestamp', db_index=True)
+
+    class Meta:
+        get_latest_by = "timestamp"
+
+
+class Attachment(models.Model):
+
+    sample = models.ForeignKey(Sample, on_delete=models.CASCADE, related_name='attachments')
+
+
+class AttachmentLine(models.Model):
+
+    attachment = models.ForeignKey(Attachment, on_delete=models.CASCADE, related_name='lines')
+
+
+class Note(models.Model):
+
+    sample = models.ForeignKey(Sample, on_delete=models.SET_NULL, null=True, blank=True, related_name='notes')
+
+
+class Reading(models.Model):
+
+    device = models.IntegerField('device', null=True, blank=True, )
+    timestamp = models.DateTimeField('timestamp')
+
+    class Meta:
+        get_latest_by = "timestamp"
+        indexes = [
+            models.Index(fields=['device', 'timestamp']),
+        ]
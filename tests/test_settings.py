@@ -2,6 +2,7 @@ import os
 
 SECRET_KEY = 'fake-key'
 INSTALLED_APPS = [
+    "tables_cleaner",
     "tests",
 ]
 
@@ -11,7 +12,11 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         #'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
         'NAME': ':memory:',
-    }
+    },
+    'other': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 
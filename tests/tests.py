@@ -1,7 +1,22 @@
+import csv
 import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
 import django
 from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
+from django.test import TransactionTestCase
+from unittest import mock
+from tests.models import Attachment
+from tests.models import AttachmentLine
+from tests.models import Event
+from tests.models import Note
+from tests.models import Reading
 from tests.models import Sample
 import tables_cleaner
 
@@ -19,6 +34,12 @@ class BaseTestCase(TestCase):
     def tearDown(self):
         pass
 
+    def run_clean_table(self, table_settings, expected_removed_count):
+        expected_left_count = Sample.objects.count() - expected_removed_count
+        n = tables_cleaner.clean_table(**table_settings)
+        self.assertEqual(expected_removed_count, n)
+        self.assertEqual(expected_left_count, Sample.objects.count())
+
     def populateModels(self):
         now = datetime.datetime.now().date()
         for i in range(NUM_RECORDS):
@@ -41,12 +62,6 @@ class SimpleTestCase(BaseTestCase):
         tables_cleaner.clean_tables()
         self.assertEqual(min(to_keep, NUM_RECORDS), Sample.objects.count())
 
-    def run_clean_table(self, table_settings, expected_removed_count):
-        expected_left_count = Sample.objects.count() - expected_removed_count
-        n = tables_cleaner.clean_table(**table_settings)
-        self.assertEqual(expected_removed_count, n)
-        self.assertEqual(expected_left_count, Sample.objects.count())
-
     def test_remove_all(self):
         self.run_clean_table(
             table_settings={'model_name': 'tests.sample', 'keep_records': 0, 'keep_since_days': 0, 'keep_since_hours': 0, },
@@ -116,3 +131,1414 @@ class SimpleTestCase(BaseTestCase):
             table_settings={'model_name': 'tests.sample', 'keep_records': 20, 'keep_since_days': 10, 'keep_since_hours': 0, },
             expected_removed_count=NUM_RECORDS - 20,
         )
+
+    def test_delete_strategy_instance(self):
+        self.run_clean_table(
+            table_settings={'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, 'delete_strategy': 'instance', },
+            expected_removed_count=NUM_RECORDS - 10,
+        )
+
+    def test_delete_strategy_bulk_by_days(self):
+        self.run_clean_table(
+            table_settings={'model_name': 'tests.sample', 'keep_records': 0, 'keep_since_days': 10, 'keep_since_hours': 0, 'delete_strategy': 'bulk', },
+            expected_removed_count=NUM_RECORDS - 10,
+        )
+
+    def test_delete_strategy_unknown(self):
+        with self.assertRaises(Exception):
+            tables_cleaner.clean_table(model_name='tests.sample', keep_records=0, keep_since_days=0, keep_since_hours=0, delete_strategy='nope')
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+    def test_batches(self):
+        self.run_clean_table(
+            table_settings={'model_name': 'tests.sample', 'keep_records': 25, 'keep_since_days': 0, 'keep_since_hours': 0, 'batch_size': 7, },
+            expected_removed_count=NUM_RECORDS - 25,
+        )
+        oldest = Sample.objects.order_by('created').first().created.date()
+        self.assertEqual((datetime.datetime.now().date() - oldest).days, 24)
+
+    def test_batches_max_rows_per_second(self):
+        self.run_clean_table(
+            table_settings={'model_name': 'tests.sample', 'keep_records': 0, 'keep_since_days': 90, 'keep_since_hours': 0, 'batch_size': 5, 'max_rows_per_second': 1000, },
+            expected_removed_count=NUM_RECORDS - 90,
+        )
+
+    def test_batches_max_duration(self):
+        # The first batch always runs; max_duration is checked before the following ones
+        n = tables_cleaner.clean_table(
+            model_name='tests.sample', keep_records=0, keep_since_days=0, keep_since_hours=0,
+            batch_size=10, batch_sleep=0.2, max_duration=0.1,
+        )
+        self.assertEqual(10, n)
+        self.assertEqual(NUM_RECORDS - 10, Sample.objects.count())
+
+    def test_batches_keyset_pagination(self):
+        from tables_cleaner.strategies import delete_bulk
+
+        def delete_some(queryset, counters):
+            # Records which can't be removed must not be scanned again
+            return delete_bulk(queryset.filter(id__in=[pk for pk in queryset.values_list('pk', flat=True) if pk % 2]), counters)
+
+        with mock.patch('tables_cleaner.clean.get_delete_strategy', return_value=delete_some):
+            result = tables_cleaner.clean_table('tests.sample', 10, 0, 0, batch_size=40)
+        self.assertEqual(3, result.batches)
+        self.assertEqual(NUM_RECORDS - 10, result.scanned)
+        self.assertEqual((NUM_RECORDS - 10) // 2, result.deleted)
+
+    def test_dump_queryset(self):
+        logger = logging.getLogger('tests.dump')
+        with self.assertLogs(logger, level='DEBUG') as cm:
+            with self.assertNumQueries(5):
+                # boundary, MIN() probe, counts and a single MIN/MAX aggregate
+                tables_cleaner.clean_table('tests.sample', 10, 0, 0, logger=logger, dry_run=True)
+        today = datetime.datetime.now().date()
+        self.assertIn('records: 90 [%sT00:00:00 ... %sT00:00:00]' % (
+            today - datetime.timedelta(days=NUM_RECORDS - 1), today - datetime.timedelta(days=10),
+        ), '\n'.join(cm.output))
+
+    def test_batches_null_keys(self):
+        Sample.objects.all().delete()
+        now = datetime.datetime.now()
+        Sample.objects.bulk_create([Sample(created=None) for i in range(3)])
+        Sample.objects.bulk_create([Sample(created=now - datetime.timedelta(days=i)) for i in range(10)])
+        # Batches smaller than the records with a NULL get_latest_by
+        n = tables_cleaner.clean_table('tests.sample', 0, 0, 0, batch_size=2)
+        self.assertEqual(13, n)
+        self.assertFalse(Sample.objects.exists())
+
+    def test_archive_null_keys(self):
+        Sample.objects.bulk_create([Sample(created=None) for i in range(3)])
+        directory = tempfile.mkdtemp()
+        try:
+            n = tables_cleaner.clean_table('tests.sample', 0, 0, 0, batch_size=2, archive_dir=directory)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(NUM_RECORDS + 3, n)
+        self.assertFalse(Sample.objects.exists())
+
+    def test_command_batch_size(self):
+        call_command('clean_tables', batch_size=10, verbosity=0)
+        self.assertEqual(settings.TABLES_CLEANER_TABLES[0]['keep_records'], Sample.objects.count())
+
+    def populateEvents(self):
+        now = datetime.datetime.now()
+        Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)])
+
+    def test_plan_single_query(self):
+        # One query to locate the keep_records boundary, one DELETE
+        self.populateEvents()
+        with self.assertNumQueries(2):
+            n = tables_cleaner.clean_table(model_name='tests.event', keep_records=30, keep_since_days=10, keep_since_hours=0)
+        self.assertEqual(NUM_RECORDS - 30, n)
+
+    def test_plan_time_threshold_only(self):
+        # No query is required to plan a time based cleaning
+        self.populateEvents()
+        with self.assertNumQueries(1):
+            n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=10, keep_since_hours=0)
+        self.assertEqual(NUM_RECORDS - 10, n)
+
+    def test_plan_keeps_null_records(self):
+        Sample.objects.create(created=None)
+        self.run_clean_table(
+            table_settings={'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, },
+            expected_removed_count=NUM_RECORDS - 10,
+        )
+        self.assertEqual(1, Sample.objects.filter(created=None).count())
+
+    def test_max_records(self):
+        # max_records takes precedence over keep_since_days
+        self.populateEvents()
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=50, keep_since_hours=0, max_records=20)
+        self.assertEqual(NUM_RECORDS - 20, n)
+        self.assertEqual(20, Event.objects.count())
+
+    def test_max_records_combined(self):
+        # keep_since_days is more restrictive than max_records
+        self.populateEvents()
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=10, keep_since_hours=0, max_records=20)
+        self.assertEqual(NUM_RECORDS - 10, n)
+
+    def test_max_records_within_limit(self):
+        self.populateEvents()
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=0, keep_since_hours=0, max_records=NUM_RECORDS)
+        self.assertEqual(0, n)
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=NUM_RECORDS + 1, keep_since_days=0, keep_since_hours=0, max_records=30)
+        self.assertEqual(NUM_RECORDS - 30, n)
+
+    def test_max_table_bytes(self):
+        from django.db import connection
+        from tables_cleaner.sizes import row_size
+        self.populateEvents()
+        size = row_size(connection, Event)
+        self.assertGreater(size, 0)
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=0, keep_since_hours=0, max_table_bytes=size * 25.5)
+        self.assertEqual(25, Event.objects.count())
+        # Within the limit
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=0, keep_since_hours=0, max_table_bytes=size * 25.5)
+        self.assertEqual(0, n)
+
+    def test_max_table_percent(self):
+        from django.db import connection
+        from tables_cleaner.sizes import tablespace_size
+        self.populateEvents()
+        self.assertGreater(tablespace_size(connection, Event), 0)
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=0, keep_since_hours=0, max_table_percent=100)
+        self.assertEqual(0, n)
+        n = tables_cleaner.clean_table(model_name='tests.event', keep_records=0, keep_since_days=0, keep_since_hours=0, max_table_percent=0.001)
+        # The most recent record is always preserved
+        self.assertEqual(1, Event.objects.count())
+
+    def test_dry_run_estimate(self):
+        n = tables_cleaner.clean_table(model_name='tests.sample', keep_records=10, keep_since_days=0, keep_since_hours=0, dry_run=True, count_mode='estimate')
+        # sqlite has no statistics: falls back to an exact count
+        self.assertEqual(NUM_RECORDS - 10, n)
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+
+class GroupsTestCase(TestCase):
+
+    DEVICES = 10
+    READINGS = 20
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        Reading.objects.bulk_create([
+            Reading(device=device, timestamp=now - datetime.timedelta(days=i))
+            for device in list(range(self.DEVICES)) + [None]
+            for i in range(self.READINGS)
+        ])
+
+    def clean_readings(self, **options):
+        table = {'model_name': 'tests.reading', 'keep_records': 5, 'keep_since_days': 0, 'keep_since_hours': 0, 'partition_by': 'device', }
+        table.update(options)
+        return tables_cleaner.clean_table(**table)
+
+    def test_partition_by_swap(self):
+        n = self.clean_readings(delete_strategy='swap', swap_threshold=0.5)
+        self.assertEqual(self.DEVICES * (self.READINGS - 5), n)
+        self.assertReadingsPerDevice(5)
+
+    def assertReadingsPerDevice(self, expected):
+        for device in range(self.DEVICES):
+            self.assertEqual(expected, Reading.objects.filter(device=device).count())
+        # Records without a device are never removed
+        self.assertEqual(self.READINGS, Reading.objects.filter(device=None).count())
+
+    def test_partition_by(self):
+        # A single DELETE statement
+        with self.assertNumQueries(1):
+            n = self.clean_readings()
+        self.assertEqual(self.DEVICES * (self.READINGS - 5), n)
+        self.assertReadingsPerDevice(5)
+        # The most recent records are preserved
+        newest = Reading.objects.filter(device=0).order_by('-timestamp')[:5]
+        self.assertEqual(set(newest.values_list('pk', flat=True)), set(Reading.objects.filter(device=0).values_list('pk', flat=True)))
+
+    def test_partition_by_keep_since(self):
+        n = self.clean_readings(keep_since_days=8)
+        self.assertEqual(self.DEVICES * (self.READINGS - 8), n)
+        self.assertReadingsPerDevice(8)
+        n = self.clean_readings(keep_since_days=2)
+        self.assertEqual(self.DEVICES * 3, n)
+        self.assertReadingsPerDevice(5)
+
+    def test_partition_by_batches(self):
+        n = self.clean_readings(batch_size=7)
+        self.assertEqual(self.DEVICES * (self.READINGS - 5), n)
+        self.assertEqual(22, n.batches)
+        self.assertReadingsPerDevice(5)
+
+    def test_partition_by_daemon(self):
+        import threading
+        from django.db import connection
+        from tables_cleaner.daemon import run_daemon
+        rankings = []
+
+        def wrapper(execute, sql, params, many, context):
+            if 'ROW_NUMBER' in sql.upper():
+                rankings.append(sql)
+            return execute(sql, params, many, context)
+
+        table = {'model_name': 'tests.reading', 'keep_records': 5, 'keep_since_days': 0, 'keep_since_hours': 0,
+                 'partition_by': 'device', 'using': 'default'}
+        with connection.execute_wrapper(wrapper):
+            results = run_daemon([table], threading.Event(), batch_size=7, idle_sleep=10, max_duration=0.5)
+        self.assertEqual(self.DEVICES * (self.READINGS - 5), results[0].deleted)
+        self.assertEqual(22, results[0].batches)
+        self.assertReadingsPerDevice(5)
+        # The first turn, the keys for the next ones, and the last turn (planned again), which finds nothing more
+        self.assertEqual(3, len(rankings))
+
+    def test_partition_by_dry_run(self):
+        n = self.clean_readings(dry_run=True)
+        self.assertEqual(self.DEVICES * (self.READINGS - 5), n)
+        self.assertReadingsPerDevice(self.READINGS)
+
+    def test_partition_by_without_window_functions(self):
+        from django.db import connection
+        with mock.patch.object(connection.features, 'supports_over_clause', False):
+            n = self.clean_readings()
+        self.assertEqual(self.DEVICES * (self.READINGS - 5), n)
+        self.assertReadingsPerDevice(5)
+
+    def test_partition_by_max_records(self):
+        # The limit applies to the whole table
+        n = self.clean_readings(max_records=30)
+        self.assertEqual(Reading.objects.count(), 30)
+        self.assertEqual(self.DEVICES * self.READINGS + self.READINGS - 30, n)
+
+
+class ParallelTestCase(TransactionTestCase):
+
+    TABLES = [
+        {'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, },
+        {'model_name': 'tests.event', 'keep_records': 0, 'keep_since_days': 5, 'keep_since_hours': 0, },
+        # Fails at runtime: partitions are not supported on SQLite
+        {'model_name': 'tests.event', 'keep_records': 0, 'keep_since_days': 5, 'keep_since_hours': 0, 'partitioned': True, },
+    ]
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        for i in range(NUM_RECORDS):
+            Sample.objects.create(created=now - datetime.timedelta(days=i))
+            Event.objects.create(timestamp=now - datetime.timedelta(days=i, minutes=1))
+
+    def test_clean_tables_workers(self):
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            results = tables_cleaner.clean_tables(max_workers=3)
+        self.assertEqual([
+            ('tests.sample', NUM_RECORDS - 10, False),
+            ('tests.event', NUM_RECORDS - 5, False),
+            ('tests.event', 0, True),
+        ], [(result.model_name, result.deleted, result.failed) for result in results])
+        self.assertEqual(10, Sample.objects.count())
+        self.assertEqual(5, Event.objects.count())
+
+    def test_clean_tables_workers_log_order(self):
+        logger = logging.getLogger('tests.parallel')
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            with self.assertLogs(logger, level='INFO') as cm:
+                tables_cleaner.clean_tables(logger=logger, dry_run=True, max_workers=3)
+        messages = [record.getMessage() for record in cm.records]
+        self.assertEqual([
+            'Cleaning table "tests.sample"',
+            'DRY-RUN: %d records would be removed from "tests.sample"' % (NUM_RECORDS - 10),
+            'Cleaning table "tests.event"',
+            'DRY-RUN: %d records would be removed from "tests.event"' % (NUM_RECORDS - 5),
+            'Cleaning table "tests.event"',
+        ], messages[:5])
+
+    def test_split_range(self):
+        from tables_cleaner.planner import split_range
+        # Records sharing the same timestamp always fall in the same range
+        Event.objects.bulk_create([Event(timestamp=Event.objects.earliest().timestamp) for i in range(10)])
+        queryset = Event.objects.filter(timestamp__lt=datetime.datetime.now() - datetime.timedelta(days=10))
+        ranges = split_range(queryset, 'timestamp', 4)
+        self.assertEqual(4, len(ranges))
+        pks = [set(part.values_list('pk', flat=True)) for part in ranges]
+        self.assertTrue(all(pks))
+        self.assertEqual(set(queryset.values_list('pk', flat=True)), set.union(*pks))
+        self.assertEqual(queryset.count(), sum(len(part) for part in pks))
+        # Values which can't be split: a single range
+        self.assertEqual(1, len(split_range(queryset.filter(pk=0), 'timestamp', 4)))
+
+    def test_parallelism(self):
+        results = []
+        for parallelism in (1, 4):
+            Event.objects.all().delete()
+            now = datetime.datetime.now()
+            Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(hours=i * 7)) for i in range(NUM_RECORDS * 3)])
+            results.append(tables_cleaner.clean_table(
+                'tests.event', 25, 0, 0, batch_size=9, parallelism=parallelism, max_rows_per_second=10000,
+            ))
+            self.assertEqual(25, Event.objects.count())
+        serial, parallel = results
+        self.assertEqual(NUM_RECORDS * 3 - 25, serial.deleted)
+        self.assertEqual(serial.deleted, parallel.deleted)
+        self.assertEqual(serial.scanned, parallel.scanned)
+        self.assertGreater(parallel.batches, serial.batches)
+
+    def test_parallelism_null_keys(self):
+        Sample.objects.bulk_create([Sample(created=None) for i in range(3)])
+        result = tables_cleaner.clean_table('tests.sample', 0, 0, 0, batch_size=2, parallelism=2)
+        self.assertEqual(NUM_RECORDS + 3, result.deleted)
+        self.assertFalse(Sample.objects.exists())
+
+    def test_parallelism_rate(self):
+        from tables_cleaner.clean import delete_in_batches
+        with mock.patch('tables_cleaner.clean.delete_in_batches', wraps=delete_in_batches) as wrapped:
+            tables_cleaner.clean_table('tests.sample', 10, 0, 0, batch_size=10, parallelism=4, max_rows_per_second=1000)
+        # SQLite: the ranges are deleted one after the other, each one at the full rate
+        self.assertEqual(4, wrapped.call_count)
+        self.assertEqual({1000}, set(call[1]['max_rows_per_second'] for call in wrapped.call_args_list))
+        with mock.patch('tables_cleaner.clean.max_concurrency', return_value=4):
+            with mock.patch('tables_cleaner.clean.delete_in_batches', wraps=delete_in_batches) as wrapped:
+                tables_cleaner.clean_table('tests.event', 0, 5, 0, batch_size=10, parallelism=4, max_rows_per_second=1000)
+        self.assertEqual({250}, set(call[1]['max_rows_per_second'] for call in wrapped.call_args_list))
+
+    def test_parallelism_profile(self):
+        from tables_cleaner.profiling import TableProfiler
+        options = {'model_name': 'tests.sample', 'using': 'default'}
+        with TableProfiler(options, explain=False) as profiler:
+            result = tables_cleaner.clean_table('tests.sample', 10, 0, 0, batch_size=10, parallelism=3)
+        self.assertEqual(NUM_RECORDS - 10, result.deleted)
+        # The queries of the workers are recorded too
+        deletes = [
+            query for recorder in profiler.recorders for query in recorder.queries
+            if query.sql.startswith('DELETE FROM "tests_sample"')
+        ]
+        self.assertEqual(result.batches, len(deletes))
+        report = profiler.report(result)
+        self.assertIn('DELETE FROM "tests_sample"', report)
+
+    def test_parallelism_progress(self):
+        events = []
+        result = tables_cleaner.clean_table('tests.sample', 10, 0, 0, parallelism=3, batch_size=10, progress=events.append)
+        self.assertEqual(NUM_RECORDS - 10, result.deleted)
+        self.assertEqual(NUM_RECORDS - 10, events[-1].deleted)
+        self.assertEqual(result.batches, events[-1].batches)
+        self.assertEqual(sorted(event.deleted for event in events), [event.deleted for event in events])
+
+
+class TablesTestCase(TestCase):
+
+    TABLE = {'model_name': 'tests.event', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, }
+
+    def test_compile_table(self):
+        from tables_cleaner.tables import compile_table
+        spec = compile_table({'model': 'tests.Sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, })
+        self.assertEqual('tests.sample', spec.model_name)
+        self.assertIs(Sample, spec.model)
+        self.assertEqual('created', spec.get_latest_by)
+        self.assertEqual('default', spec.using)
+        self.assertEqual(
+            {'model_name': 'tests.sample', 'get_latest_by': 'created', 'using': 'default',
+             'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, 'batch_size': 100, 'spec': spec, },
+            spec.kwargs({'batch_size': 100}),
+        )
+        from tables_cleaner.strategies import delete_bulk
+        self.assertIs(delete_bulk, spec.delete_records)
+        with self.assertRaises(AttributeError):
+            spec.using = 'other'
+        with self.assertRaises(TypeError):
+            spec.options['keep_records'] = 0
+
+    def test_clean_table_spec(self):
+        import threading
+        from tables_cleaner.daemon import run_daemon
+        from tables_cleaner.tables import get_table_specs
+        now = datetime.datetime.now()
+        Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)])
+        with self.settings(TABLES_CLEANER_TABLES=[self.TABLE]):
+            get_table_specs()
+            # The model, get_latest_by and the strategy are resolved once, by the spec
+            with mock.patch('tables_cleaner.clean.apps.get_model') as get_model, \
+                    mock.patch('tables_cleaner.clean.resolve_get_latest_by') as resolve_get_latest_by, \
+                    mock.patch('tables_cleaner.clean.get_delete_strategy') as get_delete_strategy:
+                totals = run_daemon(tables_cleaner.clean.get_tables({}), threading.Event(), batch_size=7, idle_sleep=0.01, max_duration=0.3)
+                Event.objects.create(timestamp=now - datetime.timedelta(days=NUM_RECORDS))
+                results = tables_cleaner.clean_tables(batch_size=40)
+        self.assertEqual(NUM_RECORDS - 10, totals[0].deleted)
+        self.assertEqual(1, results[0].deleted)
+        get_model.assert_not_called()
+        resolve_get_latest_by.assert_not_called()
+        get_delete_strategy.assert_not_called()
+
+    def test_compile_table_errors(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from tables_cleaner.tables import compile_table
+        for table, message in [
+            (dict(self.TABLE, model_name='tests.missing'), 'unknown model'),
+            (dict(self.TABLE, keep_record=1), 'unknown options: keep_record'),
+            (dict(self.TABLE, keep_records=-1), '"keep_records" must be a number >= 0'),
+            ({'model_name': 'tests.event', 'keep_records': 10}, 'missing "keep_since_days"'),
+            (dict(self.TABLE, get_latest_by='missing'), 'has no field named'),
+            (dict(self.TABLE, delete_strategy='fast'), 'unknown delete_strategy "fast"'),
+            (dict(self.TABLE, using='missing'), 'unknown database "missing"'),
+            (dict(self.TABLE, parallelism=2.5), '"parallelism" must be an integer'),
+            (dict(self.TABLE, parallelism=2, archive_dir='/tmp'), '"parallelism" can\'t be used with "archive_dir"'),
+        ]:
+            with self.assertRaisesMessage(ImproperlyConfigured, message):
+                compile_table(table)
+
+    def test_specs_cached(self):
+        from tables_cleaner.tables import get_table_specs
+        with self.settings(TABLES_CLEANER_TABLES=[self.TABLE]):
+            specs = get_table_specs()
+            self.assertIs(specs, get_table_specs())
+            self.assertEqual(['tests.event'], [spec.model_name for spec in specs])
+        # Invalidated when settings change
+        self.assertEqual(['tests.sample'], [spec.model_name for spec in get_table_specs()])
+
+    def test_invalid_settings(self):
+        from django.core.exceptions import ImproperlyConfigured
+        Event.objects.create(timestamp=datetime.datetime.now())
+        with self.settings(TABLES_CLEANER_TABLES=[dict(self.TABLE, keep_records=0, keep_since_days=0), dict(self.TABLE, model_name='tests.missing')]):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'Invalid TABLES_CLEANER_TABLES: "tests.missing": unknown model'):
+                tables_cleaner.clean_tables()
+        # Nothing has been cleaned
+        self.assertEqual(1, Event.objects.count())
+
+    def test_system_check(self):
+        from tables_cleaner.tables import check_settings
+        self.assertEqual([], check_settings())
+        with self.settings(TABLES_CLEANER_TABLES=[dict(self.TABLE, count_mode='fast')]):
+            errors = check_settings()
+        self.assertEqual(['tables_cleaner.E001'], [error.id for error in errors])
+
+
+class OtherDatabaseRouter(object):
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label_lower == 'tests.event':
+            return 'other'
+        return None
+
+
+class MultiDatabaseTestCase(TransactionTestCase):
+
+    databases = {'default', 'other'}
+
+    TABLES = [
+        {'model_name': 'tests.event', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, },
+        {'model_name': 'tests.event', 'keep_records': 5, 'keep_since_days': 0, 'keep_since_hours': 0, 'using': 'other', },
+    ]
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        for using in ('default', 'other'):
+            Event.objects.using(using).bulk_create([
+                Event(timestamp=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)
+            ])
+
+    def test_clean_table_using(self):
+        n = tables_cleaner.clean_table('tests.event', 5, 0, 0, using='other')
+        self.assertEqual(NUM_RECORDS - 5, n)
+        self.assertEqual('other', n.using)
+        self.assertEqual(5, Event.objects.using('other').count())
+        self.assertEqual(NUM_RECORDS, Event.objects.using('default').count())
+
+    def test_clean_table_using_batches(self):
+        n = tables_cleaner.clean_table('tests.event', 5, 0, 0, using='other', batch_size=7)
+        self.assertEqual(NUM_RECORDS - 5, n)
+        self.assertEqual(5, Event.objects.using('other').count())
+        self.assertEqual(NUM_RECORDS, Event.objects.using('default').count())
+
+    def test_estimate_count_using(self):
+        from django.db.models.sql.query import Query
+        from tables_cleaner.planner import estimate_count
+        get_compiler = Query.get_compiler
+        with mock.patch.object(Query, 'get_compiler', autospec=True, side_effect=get_compiler) as wrapped:
+            self.assertEqual(NUM_RECORDS, estimate_count(Event.objects.using('other').all()))
+        # Never compiled for the default database
+        self.assertEqual({'other'}, set(call[1].get('using') or call[0][1] for call in wrapped.call_args_list))
+
+    def test_swap_table_using(self):
+        from django.db import connections
+        from tables_cleaner.swap import swap_table
+        survivors = Event.objects.using('other').order_by('-timestamp')[:5]
+        survivors = Event.objects.using('other').filter(pk__in=list(survivors.values_list('pk', flat=True)))
+        # A default database quoting differently: the survivors must be compiled for "other"
+        with mock.patch.object(connections['default'].ops, 'quote_name', side_effect=lambda name: '"default_%s"' % name):
+            n = swap_table(survivors)
+        self.assertEqual(NUM_RECORDS - 5, n)
+        self.assertEqual(5, Event.objects.using('other').count())
+        self.assertEqual(NUM_RECORDS, Event.objects.using('default').count())
+
+    def test_plan_using_dry_run(self):
+        Event.objects.using('other').filter(timestamp__lt=datetime.datetime.now() - datetime.timedelta(days=49, hours=12)).delete()
+        with self.assertNumQueries(0, using='default'):
+            n = tables_cleaner.clean_table('tests.event', 10, 0, 0, using='default', plan_using='other', dry_run=True)
+        self.assertEqual(50 - 10, n)
+
+    def test_plan_using_primary_ahead(self):
+        # The most recent records have already been removed from the primary, not from the replica yet
+        newest = Event.objects.using('default').order_by('-timestamp').values_list('pk', flat=True)[:20]
+        Event.objects.using('default').filter(pk__in=list(newest)).delete()
+        n = tables_cleaner.clean_table('tests.event', 10, 0, 0, using='default', plan_using='other', batch_size=30)
+        self.assertEqual(NUM_RECORDS - 20 - 10, n)
+        self.assertEqual(10, Event.objects.using('default').count())
+        self.assertEqual(NUM_RECORDS, Event.objects.using('other').count())
+
+    def test_plan_using_replica_behind(self):
+        # The most recent records haven't reached the replica yet
+        newest = Event.objects.using('other').order_by('-timestamp').values_list('pk', flat=True)[:20]
+        Event.objects.using('other').filter(pk__in=list(newest)).delete()
+        n = tables_cleaner.clean_table('tests.event', 10, 0, 0, using='default', plan_using='other')
+        # Never more than planned on the replica
+        self.assertEqual(NUM_RECORDS - 20 - 10, n)
+        self.assertEqual(30, Event.objects.using('default').count())
+
+    def test_clean_tables_all_databases(self):
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            results = tables_cleaner.clean_tables(atomic=True)
+        self.assertEqual([('default', NUM_RECORDS - 10), ('other', NUM_RECORDS - 5)], [(result.using, result.deleted) for result in results])
+        self.assertEqual(10, Event.objects.using('default').count())
+        self.assertEqual(5, Event.objects.using('other').count())
+
+    def test_clean_tables_restricted_to_database(self):
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            results = tables_cleaner.clean_tables(using='other')
+        # Both tables are cleaned on "other"
+        self.assertEqual([('other', NUM_RECORDS - 10), ('other', 5)], [(result.using, result.deleted) for result in results])
+        self.assertEqual(NUM_RECORDS, Event.objects.using('default').count())
+        self.assertEqual(5, Event.objects.using('other').count())
+
+    def test_clean_tables_router(self):
+        with self.settings(DATABASE_ROUTERS=[OtherDatabaseRouter()]):
+            with self.settings(TABLES_CLEANER_TABLES=self.TABLES[:1]):
+                results = tables_cleaner.clean_tables()
+        self.assertEqual('other', results[0].using)
+        self.assertEqual(NUM_RECORDS, Event.objects.using('default').count())
+        self.assertEqual(10, Event.objects.using('other').count())
+
+
+class PartitionsTestCase(TestCase):
+
+    def test_parse_bound(self):
+        from tables_cleaner.partitions import parse_bound
+        self.assertEqual(datetime.date(2020, 1, 2), parse_bound("'2020-01-02'"))
+        self.assertEqual(datetime.datetime(2020, 1, 2, 10, 30), parse_bound("'2020-01-02 10:30:00'"))
+        self.assertEqual(datetime.date(2020, 1, 2), parse_bound(str(datetime.date(2020, 1, 2).toordinal() + 365), to_days=True))
+        self.assertIsNone(parse_bound('MAXVALUE'))
+        self.assertIsNone(parse_bound(None))
+
+    def fake_connection(self, vendor, rows, key=None):
+        connection = mock.MagicMock(vendor=vendor)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = rows
+        cursor.fetchone.return_value = key
+        return connection
+
+    def test_mysql_partitions(self):
+        from tables_cleaner.partitions import list_partitions
+        connection = self.fake_connection('mysql', [
+            ('p2', str(datetime.date(2020, 1, 3).toordinal() + 365), 10, 'RANGE', 'to_days(`created`)'),
+            ('pmax', 'MAXVALUE', 0, 'RANGE', 'to_days(`created`)'),
+        ])
+        self.assertEqual([datetime.date(2020, 1, 3), None], [p.upper_bound for p in list_partitions(connection, 't', 'created')])
+        connection = self.fake_connection('mysql', [('p2', "'2020-01-03'", 10, 'RANGE COLUMNS', '`created`')])
+        self.assertEqual([datetime.date(2020, 1, 3)], [p.upper_bound for p in list_partitions(connection, 't', 'created')])
+
+    def test_unsupported_partitioning(self):
+        from tables_cleaner.partitions import list_partitions, parse_bound, UnsupportedPartitioning
+        for expression, bound in [
+            ('year(`created`)', '2021'),
+            ('((year(`created`) * 100) + month(`created`))', '202101'),
+            ('unix_timestamp(`created`)', '1609459200'),
+            # TO_DAYS() of another column
+            ('to_days(`updated`)', '737791'),
+        ]:
+            connection = self.fake_connection('mysql', [('p1', bound, 10, 'RANGE', expression), ('pmax', 'MAXVALUE', 0, 'RANGE', expression)])
+            with self.assertRaisesMessage(UnsupportedPartitioning, 'is not supported'):
+                list_partitions(connection, 't', 'created')
+            # Never read as dates
+            with self.assertRaises(UnsupportedPartitioning):
+                parse_bound(bound)
+        connection = self.fake_connection('postgresql', [('p1', "FOR VALUES FROM (1) TO (1000)", 10)], key=('RANGE (id)', ))
+        with self.assertRaisesMessage(UnsupportedPartitioning, 'is not supported'):
+            list_partitions(connection, 't', 'created')
+        connection = self.fake_connection('postgresql', [('p1', "FOR VALUES FROM ('2020-01-01') TO ('2020-01-02')", 10)], key=('RANGE (created)', ))
+        self.assertEqual([datetime.date(2020, 1, 2)], [p.upper_bound for p in list_partitions(connection, 't', 'created')])
+
+    def test_is_expired(self):
+        from tables_cleaner.partitions import Partition, is_expired
+        from tables_cleaner.planner import CleaningPlan
+        plan = CleaningPlan(Sample, 'created', threshold=datetime.datetime(2020, 1, 10, 12, 0))
+        self.assertTrue(is_expired(Partition('p1', datetime.date(2020, 1, 10)), plan))
+        self.assertFalse(is_expired(Partition('p2', datetime.date(2020, 1, 11)), plan))
+        self.assertFalse(is_expired(Partition('pmax', None), plan))
+        plan = CleaningPlan(Sample, 'created', threshold=datetime.datetime(2020, 1, 10, 12, 0), boundary=(datetime.datetime(2020, 1, 5), 1))
+        self.assertTrue(is_expired(Partition('p1', datetime.date(2020, 1, 5)), plan))
+        self.assertFalse(is_expired(Partition('p2', datetime.date(2020, 1, 6)), plan))
+        plan = CleaningPlan(Sample, 'created', cap=(datetime.datetime(2020, 1, 5), 1))
+        self.assertTrue(is_expired(Partition('p1', datetime.date(2020, 1, 5)), plan))
+        self.assertFalse(is_expired(Partition('p2', datetime.date(2020, 1, 6)), plan))
+        plan = CleaningPlan(Sample, 'created', threshold=datetime.datetime(2020, 1, 10, 12, 0), cap=(datetime.datetime(2020, 1, 5), 1))
+        self.assertTrue(is_expired(Partition('p1', datetime.date(2020, 1, 5)), plan))
+        self.assertTrue(is_expired(Partition('p2', datetime.date(2020, 1, 10)), plan))
+        plan = CleaningPlan(Sample, 'created', nothing_to_do=True)
+        self.assertFalse(is_expired(Partition('p1', datetime.date(2020, 1, 5)), plan))
+
+    def test_unsupported_backend(self):
+        with self.assertRaises(Exception):
+            tables_cleaner.clean_table(model_name='tests.sample', keep_records=0, keep_since_days=1, keep_since_hours=0, partitioned=True)
+
+
+class AdvisorTestCase(BaseTestCase):
+
+    def test_check_unindexed(self):
+        from tables_cleaner.advisor import check_table
+        check = check_table(model_name='tests.sample', keep_records=10, keep_since_days=0, keep_since_hours=0)
+        self.assertEqual('created', check.column)
+        self.assertFalse(check.indexed)
+        self.assertFalse(check.ok)
+        self.assertEqual(NUM_RECORDS - 10, check.rows)
+
+    def test_check_indexed(self):
+        from tables_cleaner.advisor import check_table
+        now = datetime.datetime.now()
+        for i in range(10):
+            Event.objects.create(timestamp=now - datetime.timedelta(days=i))
+        check = check_table(model_name='tests.event', keep_records=0, keep_since_days=5, keep_since_hours=0)
+        self.assertTrue(check.indexed)
+        self.assertTrue(check.filter_uses_index)
+        self.assertEqual(5, check.rows)
+
+    def test_index_migration_requires_migrations(self):
+        from tables_cleaner.advisor import index_migration
+        self.assertIsNone(index_migration(Sample, 'created'))
+
+    def test_command_check(self):
+        call_command('clean_tables', check=True, verbosity=0)
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+
+class CascadeTestCase(BaseTestCase):
+
+    TABLE = {'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, }
+
+    def setUp(self):
+        super().setUp()
+        for sample in Sample.objects.all():
+            attachment = Attachment.objects.create(sample=sample)
+            AttachmentLine.objects.create(attachment=attachment)
+            AttachmentLine.objects.create(attachment=attachment)
+            Note.objects.create(sample=sample)
+
+    def assertCleaned(self):
+        self.assertEqual(10, Sample.objects.count())
+        self.assertEqual(10, Attachment.objects.count())
+        self.assertEqual(20, AttachmentLine.objects.count())
+        self.assertEqual(NUM_RECORDS, Note.objects.count())
+        self.assertEqual(NUM_RECORDS - 10, Note.objects.filter(sample=None).count())
+
+    def test_plan_cascade(self):
+        from tables_cleaner.cascade import plan_cascade
+        steps = {step.model: step for step in plan_cascade(Sample)}
+        self.assertEqual('delete', steps[Attachment].action)
+        self.assertEqual([AttachmentLine], [step.model for step in steps[Attachment].children])
+        self.assertEqual('update', steps[Note].action)
+
+    def test_cascade(self):
+        counters = {}
+        from tables_cleaner.cascade import delete_cascade
+        n = delete_cascade(Sample.objects.order_by('created')[:NUM_RECORDS - 10], counters)
+        self.assertEqual(NUM_RECORDS - 10, n)
+        self.assertEqual({
+            'tests.Sample': NUM_RECORDS - 10,
+            'tests.Attachment': NUM_RECORDS - 10,
+            'tests.AttachmentLine': 2 * (NUM_RECORDS - 10),
+            'tests.Note.sample': NUM_RECORDS - 10,
+        }, counters)
+        self.assertCleaned()
+
+    def test_cascade_strategy_batches(self):
+        self.run_clean_table(dict(self.TABLE, delete_strategy='cascade', batch_size=30), NUM_RECORDS - 10)
+        self.assertCleaned()
+
+    def test_bulk_strategy(self):
+        self.run_clean_table(dict(self.TABLE, delete_strategy='bulk'), NUM_RECORDS - 10)
+        self.assertCleaned()
+
+    def test_cascade_dry_run(self):
+        logger = logging.getLogger('tests.cascade')
+        with self.assertLogs(logger, level='INFO') as cm:
+            n = tables_cleaner.clean_table(**self.TABLE, delete_strategy='cascade', dry_run=True, logger=logger)
+        self.assertEqual(NUM_RECORDS - 10, n)
+        self.assertIn('INFO:tests.cascade:DRY-RUN: %d related records would be removed from "tests.AttachmentLine"' % (2 * (NUM_RECORDS - 10)), cm.output)
+        self.assertEqual(2 * NUM_RECORDS, AttachmentLine.objects.count())
+
+    def test_cascade_dry_run_without_logger(self):
+        result = tables_cleaner.clean_table(**self.TABLE, delete_strategy='cascade', dry_run=True)
+        self.assertEqual(NUM_RECORDS - 10, result.deleted)
+        self.assertEqual(NUM_RECORDS - 10, result.related['tests.Attachment'])
+        self.assertEqual(2 * (NUM_RECORDS - 10), result.related['tests.AttachmentLine'])
+        self.assertNotIn('tests.Sample', result.related)
+        self.assertEqual(2 * NUM_RECORDS, AttachmentLine.objects.count())
+
+    def test_cascade_fallback_on_signals(self):
+        from django.db.models.signals import post_delete
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.pk)
+
+        post_delete.connect(receiver, sender=Attachment)
+        try:
+            self.run_clean_table(dict(self.TABLE, delete_strategy='cascade'), NUM_RECORDS - 10)
+        finally:
+            post_delete.disconnect(receiver, sender=Attachment)
+        self.assertEqual(NUM_RECORDS - 10, len(deleted))
+        self.assertCleaned()
+
+
+class ArchiveTestCase(BaseTestCase):
+
+    TABLE = {'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, }
+
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def archive_files(self):
+        return [os.path.join(self.archive_dir, name) for name in sorted(os.listdir(self.archive_dir))]
+
+    def test_archive_jsonl_gzip(self):
+        expected_ids = set(Sample.objects.order_by('created').values_list('id', flat=True)[:NUM_RECORDS - 10])
+        self.run_clean_table(dict(self.TABLE, archive_dir=self.archive_dir, batch_size=25), NUM_RECORDS - 10)
+        files = self.archive_files()
+        self.assertEqual(1, len(files))
+        self.assertTrue(files[0].endswith('.jsonl.gz'))
+        with gzip.open(files[0], 'rt') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(expected_ids, set(row['id'] for row in rows))
+        self.assertEqual(NUM_RECORDS - 10, len(rows))
+
+    def test_archive_csv_uncompressed(self):
+        self.run_clean_table(dict(self.TABLE, archive_dir=self.archive_dir, archive_format='csv', archive_compression=None), NUM_RECORDS - 10)
+        with open(self.archive_files()[0], newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(['id', 'created'], rows[0])
+        self.assertEqual(NUM_RECORDS - 10, len(rows) - 1)
+
+    def test_archive_dry_run(self):
+        n = tables_cleaner.clean_table(**self.TABLE, archive_dir=self.archive_dir, dry_run=True)
+        self.assertEqual(NUM_RECORDS - 10, n)
+        self.assertEqual([], self.archive_files())
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+    def test_archive_failure_prevents_deletion(self):
+        with mock.patch('tables_cleaner.archive.os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                tables_cleaner.clean_table(**self.TABLE, archive_dir=self.archive_dir)
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+
+class MetricsTestCase(BaseTestCase):
+
+    TABLE = {'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, }
+
+    def test_result(self):
+        result = tables_cleaner.clean_table(**self.TABLE, batch_size=40)
+        self.assertEqual(NUM_RECORDS - 10, result)
+        self.assertEqual(NUM_RECORDS - 10, result.deleted)
+        self.assertEqual(NUM_RECORDS - 10, result.scanned)
+        self.assertEqual(3, result.batches)
+        self.assertGreater(result.queries, 3)
+        self.assertEqual({'plan', 'delete'}, set(result.timings.keys()))
+        self.assertFalse(result.failed)
+
+    def test_result_as_int(self):
+        from tables_cleaner.metrics import CleanResult
+        result = tables_cleaner.clean_table(**self.TABLE)
+        empty = tables_cleaner.clean_table(**self.TABLE)
+        self.assertTrue(result)
+        self.assertFalse(empty)
+        self.assertEqual(0, empty)
+        self.assertGreater(result, 0)
+        self.assertLess(empty, result)
+        self.assertGreaterEqual(result, NUM_RECORDS - 10)
+        self.assertLessEqual(result, NUM_RECORDS - 10.0)
+        self.assertEqual(NUM_RECORDS - 9, result + 1)
+        self.assertEqual(NUM_RECORDS - 9, 1 + result)
+        self.assertEqual(NUM_RECORDS - 10, sum([result, empty]))
+        self.assertEqual(hash(NUM_RECORDS - 10), hash(result))
+        self.assertIn(result, {NUM_RECORDS - 10})
+        self.assertEqual(NUM_RECORDS - 10, max([empty, result]))
+        self.assertEqual(result, CleanResult('tests.other').add(result))
+        self.assertNotEqual(result, 'tests.sample')
+        with self.assertRaises(TypeError):
+            result < 'tests.sample'
+
+    def test_callback_and_signal(self):
+        from tables_cleaner.signals import table_cleaned
+        received = []
+        signalled = []
+
+        def receiver(sender, result, **kwargs):
+            signalled.append(result)
+
+        table_cleaned.connect(receiver)
+        try:
+            results = tables_cleaner.clean_tables(callback=received.append)
+        finally:
+            table_cleaned.disconnect(receiver)
+        self.assertEqual(results, received)
+        self.assertEqual(results, signalled)
+
+    def test_export(self):
+        from tables_cleaner.metrics import export_results
+        results = tables_cleaner.clean_tables()
+        directory = tempfile.mkdtemp()
+        try:
+            json_path = os.path.join(directory, 'metrics.json')
+            prometheus_path = os.path.join(directory, 'metrics.prom')
+            export_results(results, metrics_json=json_path, metrics_prometheus=prometheus_path)
+            with open(json_path) as f:
+                data = json.load(f)
+            self.assertEqual('tests.sample', data[0]['model_name'])
+            self.assertEqual(NUM_RECORDS - 50, data[0]['deleted'])
+            with open(prometheus_path) as f:
+                text = f.read()
+            self.assertIn('tables_cleaner_deleted_records{table="tests.sample"} %d\n' % (NUM_RECORDS - 50), text)
+            self.assertIn('tables_cleaner_phase_seconds{table="tests.sample",phase="delete"}', text)
+        finally:
+            shutil.rmtree(directory)
+
+
+class MaintenanceTestCase(TransactionTestCase):
+
+    TABLE = {'model_name': 'tests.event', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, }
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)])
+
+    def test_maintain_tables_sqlite(self):
+        from tables_cleaner.maintenance import maintain_tables
+        logger = logging.getLogger('tests.maintenance')
+        result = tables_cleaner.clean_table(**self.TABLE)
+        with self.assertLogs(logger, level='WARNING') as cm:
+            maintain_tables([result], logger=logger)
+        self.assertIn('incremental_vacuum skipped', cm.output[0])
+        self.assertIn('vacuum', result.timings)
+
+    def test_deleted_ratio(self):
+        from tables_cleaner.maintenance import deleted_ratio
+        result = tables_cleaner.clean_table(**self.TABLE)
+        self.assertIsNone(result.table_size)
+        self.assertEqual(0.9, deleted_ratio(result, Event))
+        # The size counted by the run
+        result.table_size = 180
+        self.assertEqual(0.5, deleted_ratio(result, Event))
+        result.table_size = None
+        # PostgreSQL: live + dead tuples, i.e. the size before the DELETE; the planner estimate isn't used
+        connection = mock.MagicMock(vendor='postgresql')
+        connection.cursor.return_value.__enter__.return_value.fetchone.return_value = (NUM_RECORDS, )
+        with mock.patch('tables_cleaner.maintenance.connections', {'default': connection}):
+            with mock.patch('tables_cleaner.maintenance.estimate_count') as estimate_count:
+                self.assertEqual(0.9, deleted_ratio(result, Event))
+        estimate_count.assert_not_called()
+        # MySQL: the statistics are refreshed before estimating
+        connection = mock.MagicMock(vendor='mysql')
+        with mock.patch('tables_cleaner.maintenance.connections', {'default': connection}):
+            with mock.patch('tables_cleaner.maintenance.estimate_count', return_value=10):
+                self.assertEqual(0.9, deleted_ratio(result, Event))
+        sql = connection.cursor.return_value.__enter__.return_value.execute.call_args[0][0]
+        self.assertTrue(sql.startswith('ANALYZE TABLE'))
+
+    def test_maintain_tables_skipped(self):
+        from tables_cleaner.maintenance import maintain_tables
+        result = tables_cleaner.clean_table(**self.TABLE)
+        dry_result = tables_cleaner.clean_table(**self.TABLE, dry_run=True)
+        maintain_tables([result, dry_result], budget=0, deadline=0)
+        self.assertNotIn('vacuum', result.timings)
+        self.assertNotIn('vacuum', dry_result.timings)
+
+    def test_maintain_tables_in_transaction(self):
+        from django.db import transaction
+        from tables_cleaner.maintenance import maintain_tables
+        logger = logging.getLogger('tests.maintenance')
+        with transaction.atomic():
+            result = tables_cleaner.clean_table(**self.TABLE)
+            with self.assertLogs(logger, level='WARNING') as cm:
+                maintain_tables([result], logger=logger)
+        self.assertIn('maintenance skipped inside a transaction', cm.output[0])
+
+    def test_command_vacuum(self):
+        with self.settings(TABLES_CLEANER_TABLES=[self.TABLE]):
+            call_command('clean_tables', vacuum=True, verbosity=0)
+        self.assertEqual(10, Event.objects.count())
+
+
+class DaemonTestCase(TransactionTestCase):
+
+    TABLES = [
+        {'model_name': 'tests.event', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, 'using': 'default', },
+    ]
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)])
+
+    def test_pacer(self):
+        from tables_cleaner.daemon import Pacer
+        pacer = Pacer(target_latency=1.0, max_lag=10.0, max_sleep=8.0)
+        self.assertEqual(0, pacer.update(0.5))
+        self.assertEqual(2.0, pacer.update(2.0))
+        self.assertEqual(4.0, pacer.update(0.5, lag=20.0))
+        self.assertEqual(8.0, pacer.update(2.0))
+        self.assertEqual(8.0, pacer.update(2.0))
+        self.assertEqual(4.0, pacer.update(0.5, lag=None))
+
+    def test_pacer_throttle(self):
+        from tables_cleaner.daemon import Pacer
+        self.assertEqual(0.5, Pacer.throttle(0, 100, 0.1, batch_sleep=0.5))
+        self.assertAlmostEqual(0.9, Pacer.throttle(0, 100, 0.1, max_rows_per_second=100))
+        self.assertEqual(2.0, Pacer.throttle(2.0, 100, 0.1, batch_sleep=0.5, max_rows_per_second=100))
+
+    def test_run_daemon_throttled(self):
+        import threading
+        import time
+        from tables_cleaner import daemon
+        stop = threading.Event()
+
+        def clean_table(**options):
+            result = tables_cleaner.clean_table(**options)
+            if not result.deleted:
+                # Everything removed
+                stop.set()
+            return result
+
+        for options, expected in [({'max_rows_per_second': 200}, 0.4), ({'batch_sleep': 0.1}, 0.85)]:
+            Event.objects.all().delete()
+            self.setUp()
+            stop.clear()
+            t0 = time.monotonic()
+            with mock.patch('tables_cleaner.daemon.clean_table', clean_table):
+                results = daemon.run_daemon([dict(self.TABLES[0], **options)], stop, batch_size=10, idle_sleep=10, max_duration=5)
+            elapsed = time.monotonic() - t0
+            self.assertEqual(NUM_RECORDS - 10, results[0].deleted)
+            self.assertGreaterEqual(elapsed, expected)
+            self.assertLess(elapsed, 3)
+
+    def test_run_daemon(self):
+        import threading
+        from tables_cleaner.daemon import run_daemon
+        stop = threading.Event()
+        results = run_daemon(self.TABLES, stop, batch_size=7, idle_sleep=0.01, max_duration=0.5)
+        self.assertEqual(10, Event.objects.count())
+        self.assertEqual(NUM_RECORDS - 10, results[0].deleted)
+        # One batch per turn
+        self.assertEqual(13, results[0].batches)
+
+    def test_run_daemon_plan_reused(self):
+        import threading
+        from tables_cleaner import clean
+        from tables_cleaner.daemon import run_daemon
+        stop = threading.Event()
+        with mock.patch('tables_cleaner.clean.plan_cleaning', wraps=clean.plan_cleaning) as plan_cleaning:
+            results = run_daemon(self.TABLES, stop, batch_size=7, idle_sleep=10, max_duration=0.5)
+        self.assertEqual(NUM_RECORDS - 10, results[0].deleted)
+        self.assertEqual(13, results[0].batches)
+        # Planned once; the plan is exhausted by the last turn, which removes nothing
+        self.assertEqual(1, plan_cleaning.call_count)
+
+    def test_run_daemon_batches_only(self):
+        import threading
+        from tables_cleaner.daemon import run_daemon
+        stop = threading.Event()
+        logger = logging.getLogger('tests.daemon')
+        tables = [dict(self.TABLES[0], delete_strategy='swap', partitioned=True)]
+        with self.assertLogs(logger, level='WARNING') as cm:
+            results = run_daemon(tables, stop, batch_size=7, idle_sleep=0.01, max_duration=0.5, logger=logger)
+        self.assertEqual(2, len(cm.output))
+        # Never swapped, nor partitioned (which would fail on SQLite): one batch per turn
+        self.assertFalse(results[0].failed)
+        self.assertEqual(NUM_RECORDS - 10, results[0].deleted)
+        self.assertEqual(13, results[0].batches)
+
+    def test_run_daemon_stopped(self):
+        import threading
+        from tables_cleaner.daemon import run_daemon
+        stop = threading.Event()
+        stop.set()
+        results = run_daemon(self.TABLES, stop, batch_size=7, idle_sleep=10)
+        self.assertEqual(0, results[0].deleted)
+        self.assertEqual(NUM_RECORDS, Event.objects.count())
+
+    def test_clean_tables_stopped(self):
+        import threading
+        stop = threading.Event()
+
+        def callback(result):
+            stop.set()
+
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES * 2):
+            results = tables_cleaner.clean_tables(batch_size=7, stop=stop, callback=callback)
+        stop.set()
+        self.assertEqual(NUM_RECORDS - 10, results[0].deleted)
+        self.assertEqual('skipped: interrupted', results[1].error)
+        n = tables_cleaner.clean_table(**self.TABLES[0], batch_size=7, stop=stop)
+        self.assertEqual(0, n)
+
+    def test_command_daemon(self):
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            call_command('clean_tables', daemon=True, batch_size=7, idle_sleep=0.01, max_duration=0.5, verbosity=0)
+        self.assertEqual(10, Event.objects.count())
+
+
+class AsyncTestCase(TransactionTestCase):
+
+    TABLES = [
+        {'model_name': 'tests.sample', 'keep_records': 10, 'keep_since_days': 0, 'keep_since_hours': 0, },
+        {'model_name': 'tests.event', 'keep_records': 0, 'keep_since_days': 5, 'keep_since_hours': 0, 'batch_size': 20, },
+    ]
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        Sample.objects.bulk_create([Sample(created=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)])
+        Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(days=i, minutes=1)) for i in range(NUM_RECORDS)])
+
+    def test_aclean_table(self):
+        import asyncio
+        from tables_cleaner.aio import aclean_table
+        events = []
+        n = asyncio.run(aclean_table('tests.event', 10, 0, 0, batch_size=30, progress=events.append))
+        self.assertEqual(NUM_RECORDS - 10, n)
+        self.assertEqual([30, 60, 90], [event.deleted for event in events])
+        self.assertEqual(10, Event.objects.count())
+
+    def test_aclean_tables(self):
+        import asyncio
+        from tables_cleaner.aio import aclean_tables
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            results = asyncio.run(aclean_tables(max_concurrency=2))
+        self.assertEqual([('tests.sample', NUM_RECORDS - 10), ('tests.event', NUM_RECORDS - 5)], [(result.model_name, result.deleted) for result in results])
+        self.assertEqual(10, Sample.objects.count())
+        self.assertEqual(5, Event.objects.count())
+
+    def test_astream_tables(self):
+        import asyncio
+        from tables_cleaner.aio import astream_tables
+
+        async def collect():
+            return [event async for event in astream_tables()]
+
+        with self.settings(TABLES_CLEANER_TABLES=self.TABLES):
+            events = asyncio.run(collect())
+        batches = [event.deleted for event in events if event.kind == 'batch' and event.model_name == 'tests.event']
+        self.assertEqual([20, 40, 60, 80, 95], batches)
+        results = [event.result for event in events if event.kind == 'table']
+        self.assertEqual({'tests.sample': NUM_RECORDS - 10, 'tests.event': NUM_RECORDS - 5}, {result.model_name: result.deleted for result in results})
+
+    def test_cancel(self):
+        import asyncio
+        from tables_cleaner.aio import aclean_table
+
+        async def cancel_after_first_batch():
+            first_batch = asyncio.Event()
+            task = asyncio.ensure_future(aclean_table('tests.event', 0, 0, 0, batch_size=10, batch_sleep=0.2, progress=lambda event: first_batch.set()))
+            await first_batch.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_after_first_batch())
+        # The pending batch is completed, the remaining ones are skipped
+        self.assertEqual(NUM_RECORDS - 10, Event.objects.count())
+
+
+class ProgressTestCase(BaseTestCase):
+
+    def test_progress_events(self):
+        events = []
+        n = tables_cleaner.clean_table('tests.sample', 10, 0, 0, batch_size=40, progress=events.append)
+        self.assertEqual(NUM_RECORDS - 10, n)
+        self.assertEqual([40, 80, 90], [event.deleted for event in events])
+        self.assertEqual([1, 2, 3], [event.batches for event in events])
+        self.assertEqual({NUM_RECORDS - 10}, {event.total for event in events})
+        self.assertEqual(0, events[-1].remaining)
+        self.assertEqual(0, events[-1].eta)
+
+    def test_progress_event(self):
+        from tables_cleaner.progress import ProgressEvent
+        event = ProgressEvent(ProgressEvent.BATCH, 'tests.sample', deleted=250, elapsed=5, total=1000)
+        self.assertEqual(50, event.rate)
+        self.assertEqual(25, event.percent)
+        self.assertEqual(15, event.eta)
+        self.assertEqual('"tests.sample": 250/1000 (25%) records removed, 50.0 records/s, ETA 0:00:15', str(event))
+        event = ProgressEvent(ProgressEvent.BATCH, 'tests.sample', deleted=250, elapsed=0)
+        self.assertIsNone(event.eta)
+
+    def test_clean_tables_progress(self):
+        events = []
+        tables_cleaner.clean_tables(batch_size=45, progress=events.append)
+        # TABLES_CLEANER_TABLES keeps 50 records
+        self.assertEqual(
+            [('batch', 45), ('batch', 50), ('table', 50)],
+            [(event.kind, event.deleted) for event in events],
+        )
+        self.assertEqual('tests.sample', events[-1].result.model_name)
+
+    def test_progress_line(self):
+        import io
+        from django.core.management.base import OutputWrapper
+        from tables_cleaner.progress import ProgressEvent, ProgressLine
+        out = io.StringIO()
+        line = ProgressLine(OutputWrapper(out), interval=0)
+        line(ProgressEvent(ProgressEvent.BATCH, 'tests.sample', deleted=250, elapsed=5, total=1000))
+        line(ProgressEvent(ProgressEvent.BATCH, 'tests.sample', deleted=500, elapsed=10, total=1000))
+        line(ProgressEvent(ProgressEvent.TABLE, 'tests.sample', deleted=1000, elapsed=20))
+        text = out.getvalue()
+        self.assertTrue(text.startswith('\r"tests.sample": 250/1000 (25%)'))
+        self.assertIn('\r"tests.sample": 500/1000 (50%)', text)
+        self.assertTrue(text.endswith('\r'))
+        self.assertNotIn('\n', text)
+
+    def test_progress_line_logging(self):
+        import io
+        from django.core.management.base import OutputWrapper
+        from tables_cleaner.progress import ProgressEvent, ProgressLine
+        out = io.StringIO()
+        line = ProgressLine(OutputWrapper(out), interval=0)
+        logger = logging.getLogger('tests.progress')
+        handler = logging.StreamHandler(out)
+        logger.addHandler(handler)
+        logger.addFilter(line)
+        try:
+            line(ProgressEvent(ProgressEvent.BATCH, 'tests.sample', deleted=250, elapsed=5, total=1000))
+            logger.warning('slow batch')
+            line(ProgressEvent(ProgressEvent.BATCH, 'tests.sample', deleted=500, elapsed=10, total=1000))
+            line(ProgressEvent(ProgressEvent.TABLE, 'tests.sample', deleted=1000, elapsed=20))
+            logger.warning('1000 records removed')
+        finally:
+            logger.removeFilter(line)
+            logger.removeHandler(handler)
+        # Each record on a line of its own, after the progress line has been cleared
+        lines = [text.split('\r')[-1] for text in out.getvalue().split('\n')]
+        self.assertEqual(['slow batch', '1000 records removed', ''], lines)
+
+
+
+class TimeoutsTestCase(BaseTestCase):
+
+    def flaky_strategy(self, failures):
+        from django.db import OperationalError
+        from tables_cleaner.strategies import get_delete_strategy
+        delete_records = get_delete_strategy('bulk')
+        self.batches = []
+
+        def delete(queryset, counters):
+            self.batches.append(queryset.count())
+            if len(self.batches) <= failures:
+                raise OperationalError('database is locked')
+            return delete_records(queryset, counters)
+
+        from contextlib import ExitStack
+        from tables_cleaner.tables import clear_cache
+        stack = ExitStack()
+        stack.enter_context(mock.patch('tables_cleaner.clean.get_delete_strategy', return_value=delete))
+        # The compiled tables hold their strategy
+        stack.enter_context(mock.patch('tables_cleaner.tables.get_delete_strategy', return_value=delete))
+        clear_cache()
+        stack.callback(clear_cache)
+        return stack
+
+    def test_timeouts_sqlite(self):
+        from django.db import connection
+        from tables_cleaner.timeouts import timeouts
+
+        def busy_timeout():
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA busy_timeout')
+                return cursor.fetchone()[0]
+
+        previous = busy_timeout()
+        with timeouts(connection, lock_timeout=0.25, statement_timeout=10):
+            self.assertEqual(250, busy_timeout())
+        self.assertEqual(previous, busy_timeout())
+
+    def test_retry_with_smaller_batch(self):
+        with self.flaky_strategy(failures=2):
+            result = tables_cleaner.clean_table(
+                'tests.sample', 10, 0, 0, batch_size=40, lock_timeout=1, retry_backoff=0,
+            )
+        self.assertFalse(result.failed)
+        self.assertEqual(NUM_RECORDS - 10, result.deleted)
+        self.assertEqual(10, Sample.objects.count())
+        # 40 records, then 20 and 10 after each timeout
+        self.assertEqual([40, 20, 10, 10], self.batches[:4])
+
+    def test_skip_after_max_retries(self):
+        with self.flaky_strategy(failures=100):
+            result = tables_cleaner.clean_table(
+                'tests.sample', 10, 0, 0, batch_size=40, max_retries=2, retry_backoff=0,
+            )
+        self.assertTrue(result.failed)
+        self.assertIn('skipped after 3 timeouts', result.error)
+        self.assertEqual(0, result.deleted)
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+    def test_skip_without_batches(self):
+        with self.flaky_strategy(failures=100), mock.patch('tables_cleaner.timeouts.time.sleep') as sleep:
+            results = tables_cleaner.clean_tables(atomic=True, lock_timeout=1)
+        self.assertEqual([mock.call(1), mock.call(2), mock.call(4)], sleep.call_args_list)
+        self.assertTrue(results[0].failed)
+        self.assertEqual(3 + 1, len(self.batches))
+        self.assertEqual(NUM_RECORDS, Sample.objects.count())
+
+    def test_other_errors_not_retried(self):
+        from django.db import IntegrityError
+        with mock.patch('tables_cleaner.clean.get_delete_strategy', return_value=mock.Mock(side_effect=IntegrityError('boom'))):
+            with self.assertRaises(IntegrityError):
+                tables_cleaner.clean_table('tests.sample', 10, 0, 0, batch_size=40, retry_backoff=0)
+
+
+class SwapTestCase(TestCase):
+
+    TABLE = {'model_name': 'tests.event', 'keep_records': 5, 'keep_since_days': 0, 'keep_since_hours': 0, 'delete_strategy': 'swap', }
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        Event.objects.bulk_create([Event(timestamp=now - datetime.timedelta(days=i)) for i in range(NUM_RECORDS)])
+
+    def test_swap(self):
+        newest = list(Event.objects.order_by('-timestamp').values_list('pk', 'timestamp')[:5])
+        logger = logging.getLogger('tests.swap')
+        with self.assertLogs(logger, level='INFO') as cm:
+            n = tables_cleaner.clean_table(**self.TABLE, logger=logger)
+        self.assertEqual(NUM_RECORDS - 5, n)
+        self.assertEqual(sorted(newest), sorted(Event.objects.values_list('pk', 'timestamp')))
+        self.assertIn('5 of 100 records copied aside', '\n'.join(cm.output))
+
+    def test_swap_below_threshold(self):
+        with mock.patch('tables_cleaner.clean.swap_table') as swap_table:
+            n = tables_cleaner.clean_table(**dict(self.TABLE, keep_records=50))
+        swap_table.assert_not_called()
+        self.assertEqual(NUM_RECORDS - 50, n)
+        self.assertEqual(50, Event.objects.count())
+
+    def test_truncate(self):
+        logger = logging.getLogger('tests.swap')
+        with self.assertLogs(logger, level='INFO') as cm:
+            n = tables_cleaner.clean_table(**dict(self.TABLE, keep_records=0), logger=logger)
+        self.assertEqual(NUM_RECORDS, n)
+        self.assertEqual(0, Event.objects.count())
+        self.assertIn('truncating 100 records', '\n'.join(cm.output))
+
+    def test_swap_dry_run(self):
+        logger = logging.getLogger('tests.swap')
+        with self.assertLogs(logger, level='INFO') as cm:
+            n = tables_cleaner.clean_table(**self.TABLE, logger=logger, dry_run=True)
+        self.assertEqual(NUM_RECORDS - 5, n)
+        self.assertEqual(NUM_RECORDS, Event.objects.count())
+        self.assertIn('DRY-RUN: table "tests.event" would be swapped', '\n'.join(cm.output))
+
+    def test_swap_refused(self):
+        # Sample is referenced by Attachment and Note
+        for i in range(10):
+            Sample.objects.create(created=datetime.datetime.now() - datetime.timedelta(days=i))
+        logger = logging.getLogger('tests.swap')
+        with self.assertLogs(logger, level='WARNING') as cm:
+            n = tables_cleaner.clean_table('tests.sample', 1, 0, 0, delete_strategy='swap', logger=logger)
+        self.assertEqual(9, n)
+        self.assertEqual(1, Sample.objects.count())
+        self.assertIn('swap refused (table referenced by foreign keys (tests.Attachment, tests.Note))', cm.output[0])
+
+
+class StateTestCase(BaseTestCase):
+
+    def test_state_saved(self):
+        from tables_cleaner.models import TableState
+        tables_cleaner.clean_tables()
+        tables_cleaner.clean_tables()
+        state = TableState.objects.get(model_name='tests.sample', using='default')
+        self.assertEqual(2, state.runs)
+        self.assertEqual(0, state.deleted)
+        self.assertEqual(NUM_RECORDS - 50, state.total_deleted)
+        self.assertIsNotNone(state.last_run)
+        self.assertEqual('', state.error)
+        # The boundary of keep_records: the 50th most recent record
+        self.assertTrue(state.cutoff.startswith(str(datetime.datetime.now().date() - datetime.timedelta(days=49))))
+
+    def test_state_not_saved(self):
+        from tables_cleaner.models import TableState
+        tables_cleaner.clean_tables(dry_run=True)
+        with self.settings(TABLES_CLEANER_STATE=False):
+            tables_cleaner.clean_tables()
+        self.assertFalse(TableState.objects.exists())
+
+    def test_nothing_to_do(self):
+        table = {'model_name': 'tests.sample', 'keep_records': 0, 'keep_since_days': NUM_RECORDS + 1, 'keep_since_hours': 0}
+        with self.assertNumQueries(1):
+            # The MIN() probe only, no counts
+            result = tables_cleaner.clean_table(**table, dry_run=True)
+        self.assertTrue(result.skipped)
+        self.assertEqual(0, result.deleted)
+        result = tables_cleaner.clean_table(**dict(table, keep_since_days=NUM_RECORDS - 1), dry_run=True)
+        self.assertFalse(result.skipped)
+        self.assertEqual(1, result.deleted)
+
+    def test_second_run_skipped(self):
+        from tables_cleaner.models import TableState
+        results = tables_cleaner.clean_tables()
+        self.assertFalse(results[0].skipped)
+        results = tables_cleaner.clean_tables()
+        self.assertTrue(results[0].skipped)
+        self.assertTrue(TableState.objects.get(model_name='tests.sample').skipped)
+        # Batches: skipped after the probe, before reading any batch
+        with self.assertNumQueries(1):
+            # The MIN() probe only
+            result = tables_cleaner.clean_table('tests.sample', 0, 60, 0, batch_size=10)
+        self.assertTrue(result.skipped)
+
+    def test_state_errors_logged(self):
+        logger = logging.getLogger('tests.state')
+        with mock.patch('tables_cleaner.state.format_cutoff', side_effect=ValueError('unexpected cutoff')):
+            with self.assertLogs(logger, level='WARNING') as cm:
+                results = tables_cleaner.clean_tables(logger=logger)
+        self.assertEqual(NUM_RECORDS - 50, results[0].deleted)
+        self.assertIn('state not saved (unexpected cutoff)', '\n'.join(cm.output))
+
+    def test_command_status(self):
+        import io
+        tables_cleaner.clean_tables()
+        out = io.StringIO()
+        call_command('clean_tables', status=True, stdout=out, verbosity=0)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('TABLE'))
+        self.assertEqual(['tests.sample', 'default'], lines[1].split()[:2])
+        self.assertTrue(lines[1].endswith('ok'))
+        self.assertIn(' %d ' % (NUM_RECORDS - 50), lines[1])
+
+
+
+class ProfilingTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def read_report(self):
+        names = os.listdir(self.directory)
+        self.assertEqual(1, len(names))
+        self.assertTrue(names[0].startswith('tests.sample-'))
+        with open(os.path.join(self.directory, names[0])) as f:
+            return f.read()
+
+    def test_report(self):
+        results = tables_cleaner.clean_tables(batch_size=20, profile_dir=self.directory)
+        self.assertEqual(NUM_RECORDS - 50, results[0].deleted)
+        self.assertEqual(50, Sample.objects.count())
+        report = self.read_report()
+        self.assertIn('Profile of "tests.sample"', report)
+        self.assertIn('Records removed: %d; batches: 3' % (NUM_RECORDS - 50), report)
+        self.assertIn('Statements (slowest first):', report)
+        # The DELETE of the first batch is explained; the others have the same statement
+        plans = report.split('Execution plans:')[1].split('Queries (in order):')[0]
+        self.assertEqual(1, plans.count('[default] DELETE FROM'))
+        self.assertNotIn('Python profile:', report)
+
+    def test_command(self):
+        call_command('clean_tables', profile=self.directory, profile_python=True, verbosity=0)
+        self.assertEqual(50, Sample.objects.count())
+        report = self.read_report()
+        self.assertIn('Python profile:', report)
+        self.assertIn('cumulative', report)
+
+    def test_command_errors(self):
+        from django.core.management.base import CommandError
+        with self.assertRaises(CommandError):
+            call_command('clean_tables', profile_python=True, verbosity=0)
+        with self.assertRaises(CommandError):
+            call_command('clean_tables', profile=os.path.join(self.directory, 'missing'), verbosity=0)